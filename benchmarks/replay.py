@@ -0,0 +1,136 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Replays smart collection over the recent history of a local git repository, without running any tests.
+
+Each of the last --commits commits on the first parent chain of --rev is checked out in a temporary worktree and the
+selection pipeline of SmartCollector.run is run against its parent, over the tests found statically in the usual
+pytest files (test_*.py and *_test.py).  For each commit, the analysis time, the peak memory allocated during the
+analysis and the share of the tests that would have been selected are written as one JSON object per line.
+
+    $ python benchmarks/replay.py ~/src/my_project --commits 50 --output replay.jsonl
+"""
+import os
+import sys
+import json
+import time
+import shutil
+import fnmatch
+import logging
+import argparse
+import resource
+import tempfile
+import tracemalloc
+import subprocess
+from pytest_smartcollect.helpers import SmartCollector
+
+TEST_FILE_PATTERNS = ("test_*.py", "*_test.py")
+
+
+def git(repo_path, *args):
+    return subprocess.check_output(["git"] + list(args), cwd=repo_path, stderr=subprocess.DEVNULL).decode('utf-8').strip()
+
+
+def find_tests(smart_collector, worktree):
+    # (path, test name, node id) for the test functions and methods pytest would collect by default
+    tests = []
+    for path in smart_collector.find_project_files(worktree):
+        if not any(fnmatch.fnmatch(os.path.basename(path), pattern) for pattern in TEST_FILE_PATTERNS):
+            continue
+
+        relpath = os.path.relpath(path, worktree).replace(os.sep, '/')
+        summary = smart_collector.get_summary(path)
+        test_classes = set(d.name for d in summary.definitions if d.kind == 'class' and d.toplevel and d.name.startswith('Test'))
+
+        for definition in summary.definitions:
+            if definition.kind != 'function' or not definition.name.startswith('test'):
+                continue
+
+            if definition.toplevel:
+                tests.append((path, definition.name, "%s::%s" % (relpath, definition.name)))
+
+            elif definition.parent in test_classes:
+                tests.append((path, definition.name, "%s::%s::%s" % (relpath, definition.parent, definition.name)))
+
+    return tests
+
+
+def replay_commit(worktree, commit, parent, cache_dir, memory):
+    logger = logging.getLogger("smartcollect.replay")
+    logger.setLevel(logging.ERROR)
+    smart_collector = SmartCollector(worktree, {}, [], 0, parent, False, logger, cache_dir=cache_dir)
+
+    if memory:
+        tracemalloc.start()
+
+    start, cpu_start = time.perf_counter(), time.process_time()
+    selection = smart_collector.prepare_selection()
+    tests = find_tests(smart_collector, worktree)
+    selected = 0
+    for path, name, nodeid in tests:
+        if smart_collector.select_test(selection, path, name, nodeid)[0]:
+            selected += 1
+
+    wall, cpu = time.perf_counter() - start, time.process_time() - cpu_start
+    peak = None
+    if memory:
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+
+    smart_collector.summary_cache.save()
+    smart_collector.record_stats(selection, selected, len(tests))
+
+    return {
+        "commit": commit,
+        "parent": parent,
+        "subject": git(worktree, "log", "-1", "--format=%s", commit),
+        "changed_files": len(selection.changed_files),
+        "analysis_wall": wall,
+        "analysis_cpu": cpu,
+        "peak_memory": peak,
+        "max_rss_kb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+        "selected": selected,
+        "total": len(tests),
+        "selected_ratio": float(selected) / len(tests) if tests else None,
+        "stats": smart_collector.stats.to_dict()
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("repo", help="path to a local git repository")
+    parser.add_argument("--commits", type=int, default=20, help="number of commits to replay")
+    parser.add_argument("--rev", default="HEAD", help="the newest commit to replay. Default is HEAD.")
+    parser.add_argument("--cold", action="store_true", help="start every commit with an empty analysis cache")
+    parser.add_argument("--no-memory", dest="memory", action="store_false", help="don't trace memory allocations, which slows the analysis down")
+    parser.add_argument("--output", default="-", help="file to write the results to, one JSON object per line. Default is stdout.")
+    args = parser.parse_args(argv)
+
+    repo = git(os.path.abspath(args.repo), "rev-parse", "--show-toplevel")
+    commits = git(repo, "rev-list", "--first-parent", "-n", str(args.commits), args.rev).split()
+    workdir = tempfile.mkdtemp(prefix="smartcollect-replay-")
+    worktree = os.path.join(workdir, "worktree")
+    output = sys.stdout if args.output == "-" else open(args.output, "w")
+
+    git(repo, "worktree", "add", "--detach", worktree, commits[-1])
+    try:
+        for n, commit in enumerate(reversed(commits)):  # oldest first, so that the analysis cache warms up as it would
+            parents = git(repo, "rev-list", "--parents", "-n", "1", commit).split()[1:]
+            if not parents:  # a root commit has nothing to diff against
+                continue
+
+            git(worktree, "checkout", "-q", "--detach", commit)
+            cache_dir = os.path.join(workdir, "cache-%d" % n if args.cold else "cache")
+            output.write(json.dumps(replay_commit(worktree, commit, parents[0], cache_dir, args.memory)) + "\n")
+            output.flush()
+
+    finally:
+        if output is not sys.stdout:
+            output.close()
+
+        git(repo, "worktree", "remove", "--force", worktree)
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,258 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Benchmarks smart collection on generated git repositories of a configurable shape.
+
+Each run generates a package of --modules modules arranged in --depth layers, where every function calls --fanout
+functions of the next layer and every class inherits from a class of the next layer, up to --class-depth classes deep.
+A share of the imports between modules (--star-imports) are star imports.  --tests tests call into the first layer.
+
+One branch is created off the initial commit for each of the --changes sizes, editing that many modules, and
+SmartCollector.run and find_changed_files are timed against each, with the time of each phase of run in its stats.
+Results are written as one JSON object per line.  Everything runs offline, in a temporary directory.
+
+    $ python benchmarks/synthetic.py --modules 500 --tests 2000 --changes 1,10,100 --output results.jsonl
+"""
+import io
+import os
+import sys
+import json
+import time
+import random
+import shutil
+import logging
+import argparse
+import tempfile
+import contextlib
+import subprocess
+import pytest
+from git import Repo
+from pytest_smartcollect.helpers import SmartCollector
+
+FUNCTIONS_PER_MODULE = 4
+TESTS_PER_FILE = 20
+GIT_ENV = dict(
+    os.environ,
+    GIT_AUTHOR_NAME="benchmark",
+    GIT_AUTHOR_EMAIL="benchmark@example.com",
+    GIT_COMMITTER_NAME="benchmark",
+    GIT_COMMITTER_EMAIL="benchmark@example.com"
+)
+
+
+def git(repo_path, *args):
+    subprocess.check_call(["git"] + list(args), cwd=repo_path, env=GIT_ENV, stdout=subprocess.DEVNULL)
+
+
+def module_source(i, layers, args, rnd):
+    layer = layers[i]
+    next_layer = [j for j, l in enumerate(layers) if l == layer + 1]
+    lines = []
+    calls = {}
+
+    for k in range(FUNCTIONS_PER_MODULE):
+        calls[k] = rnd.sample(next_layer, min(args.fanout, len(next_layer))) if next_layer else []
+
+    imported = sorted(set(j for callees in calls.values() for j in callees))
+    base = rnd.choice(next_layer) if next_layer and layer + 1 < args.class_depth else None
+    if base is not None and base not in imported:
+        imported.append(base)
+
+    for j in imported:
+        if rnd.random() < args.star_imports:
+            lines.append("from pkg.mod_%d import *" % j)
+
+        else:
+            names = ["m%d_f%d" % (j, k) for k in range(FUNCTIONS_PER_MODULE)] + ["M%dClass" % j]
+            lines.append("from pkg.mod_%d import %s" % (j, ", ".join(names)))
+
+    lines.append("")
+    for k, callees in calls.items():
+        lines.append("")
+        lines.append("def m%d_f%d(x=0):" % (i, k))
+        lines.append("    value = x + %d" % k)
+        for j in callees:
+            lines.append("    value += m%d_f%d(x)" % (j, rnd.randrange(FUNCTIONS_PER_MODULE)))
+
+        lines.append("    return value")
+        lines.append("")
+
+    lines.append("")
+    lines.append("class M%dClass(%s):" % (i, "M%dClass" % base if base is not None else "object"))
+    lines.append("    def run(self):")
+    lines.append("        return m%d_f0()" % i)
+    lines.append("")
+    return "\n".join(lines)
+
+
+def test_file_source(t, first_layer, rnd):
+    lines = []
+    targets = [rnd.choice(first_layer) for _ in range(TESTS_PER_FILE)]
+    for j in sorted(set(targets)):
+        lines.append("from pkg.mod_%d import *" % j)
+
+    lines.append("")
+    for n, j in enumerate(targets):
+        lines.append("")
+        if n % 2:
+            lines.append("def test_%d_%d():" % (t, n))
+            lines.append("    assert m%d_f%d() >= 0" % (j, rnd.randrange(FUNCTIONS_PER_MODULE)))
+
+        else:
+            lines.append("def test_%d_%d():" % (t, n))
+            lines.append("    assert M%dClass().run() >= 0" % j)
+
+        lines.append("")
+
+    return "\n".join(lines)
+
+
+def generate_repo(repo_path, args):
+    # creates the repository at its initial commit, on branch master
+    rnd = random.Random(args.seed)
+    layers = [i % args.depth for i in range(args.modules)]
+    first_layer = [i for i, l in enumerate(layers) if l == 0]
+
+    os.makedirs(os.path.join(repo_path, "pkg"))
+    os.makedirs(os.path.join(repo_path, "tests"))
+    open(os.path.join(repo_path, "pkg", "__init__.py"), "w").close()
+    open(os.path.join(repo_path, "conftest.py"), "w").close()  # puts the repository root on sys.path for the tests
+
+    for i in range(args.modules):
+        with open(os.path.join(repo_path, "pkg", "mod_%d.py" % i), "w") as f:
+            f.write(module_source(i, layers, args, rnd))
+
+    test_files = (args.tests + TESTS_PER_FILE - 1) // TESTS_PER_FILE
+    for t in range(test_files):
+        with open(os.path.join(repo_path, "tests", "test_%d.py" % t), "w") as f:
+            f.write(test_file_source(t, first_layer, rnd))
+
+    git(repo_path, "init", "-q")
+    git(repo_path, "checkout", "-q", "-b", "master")
+    git(repo_path, "add", "-A")
+    git(repo_path, "commit", "-q", "-m", "initial commit")
+
+
+def make_change(repo_path, size, rnd):
+    # creates a branch off master that edits the first function of size modules
+    branch = "change-%d" % size
+    git(repo_path, "checkout", "-q", "-b", branch, "master")
+
+    modules = sorted(os.listdir(os.path.join(repo_path, "pkg")))
+    modules.remove("__init__.py")
+    for module in rnd.sample(modules, min(size, len(modules))):
+        path = os.path.join(repo_path, "pkg", module)
+        with open(path) as f:
+            contents = f.read()
+
+        with open(path, "w") as f:
+            f.write(contents.replace("value = x + 0", "value = x + 1", 1))
+
+    git(repo_path, "commit", "-q", "-a", "-m", "change %d modules" % size)
+    return branch
+
+
+class ItemCollector(object):
+    def __init__(self):
+        self.items = []
+
+    def pytest_collection_modifyitems(self, items):
+        self.items = list(items)
+
+
+def collect_items(repo_path):
+    collector = ItemCollector()
+    with contextlib.redirect_stdout(io.StringIO()):
+        exit_code = pytest.main(["--collect-only", "-p", "no:cacheprovider", "-p", "no:smartcollect", repo_path], plugins=[collector])
+
+    if exit_code != 0:
+        raise Exception("Couldn't collect the tests of the generated repository (exit code %d)" % exit_code)
+
+    return collector.items
+
+
+def make_collector(repo_path, cache_dir, workers):
+    logger = logging.getLogger("smartcollect.benchmark")
+    logger.setLevel(logging.ERROR)
+    return SmartCollector(repo_path, {}, [], 0, "master", False, logger, cache_dir=cache_dir, workers=workers)
+
+
+def timed(f, *args):
+    start = time.perf_counter()
+    result = f(*args)
+    return time.perf_counter() - start, result
+
+
+def benchmark_branch(repo_path, branch, cache_dir, args):
+    git(repo_path, "checkout", "-q", branch)
+    results = []
+
+    for repetition in range(args.repeat):
+        smart_collector = make_collector(repo_path, cache_dir, args.workers)
+        find_changed_files_time, _ = timed(smart_collector.find_changed_files, Repo(repo_path), repo_path)
+
+        run_items = collect_items(repo_path)  # run() adds skip markers, so each repetition gets items of its own
+        run_time, deselected = timed(smart_collector.run, run_items)
+        skipped = sum(1 for item in run_items if item.get_marker('skip'))
+
+        results.append({
+            "branch": branch,
+            "repetition": repetition,
+            "cache": "cold" if repetition == 0 else "warm",
+            "find_changed_files": find_changed_files_time,
+            "run": run_time,
+            "tests": len(run_items),
+            "selected": len(run_items) - skipped - len(deselected),
+            "stats": smart_collector.stats.to_dict()
+        })
+
+    return results
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--modules", type=int, default=200, help="number of modules in the generated package")
+    parser.add_argument("--tests", type=int, default=500, help="number of tests")
+    parser.add_argument("--depth", type=int, default=5, help="length of the call chains between modules")
+    parser.add_argument("--fanout", type=int, default=3, help="functions of the next layer called by each function")
+    parser.add_argument("--class-depth", type=int, default=3, help="depth of the class hierarchies")
+    parser.add_argument("--star-imports", type=float, default=0.2, help="share of the imports between modules that are star imports")
+    parser.add_argument("--changes", default="1,10,50", help="comma separated numbers of modules edited by each benchmarked commit")
+    parser.add_argument("--repeat", type=int, default=2, help="runs per commit; the first starts with an empty analysis cache")
+    parser.add_argument("--workers", type=int, default=0, help="passed on as --smart-collect-workers")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", default="-", help="file to write the results to, one JSON object per line. Default is stdout.")
+    parser.add_argument("--keep", action="store_true", help="keep the generated repository and print its path")
+    args = parser.parse_args(argv)
+
+    shape = {k: getattr(args, k) for k in ("modules", "tests", "depth", "fanout", "class_depth", "star_imports", "seed")}
+    workdir = tempfile.mkdtemp(prefix="smartcollect-benchmark-")
+    repo_path = os.path.join(workdir, "repo")
+    output = sys.stdout if args.output == "-" else open(args.output, "w")
+
+    try:
+        os.makedirs(repo_path)
+        generate_repo(repo_path, args)
+        rnd = random.Random(args.seed)
+
+        for size in (int(s) for s in args.changes.split(",")):
+            branch = make_change(repo_path, size, rnd)
+            cache_dir = os.path.join(workdir, "cache-%s" % branch)
+            for result in benchmark_branch(repo_path, branch, cache_dir, args):
+                result.update(shape=shape, changed_modules=size)
+                output.write(json.dumps(result) + "\n")
+                output.flush()
+
+    finally:
+        if output is not sys.stdout:
+            output.close()
+
+        if args.keep:
+            sys.stderr.write("generated repository kept at %s\n" % repo_path)
+
+        else:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    main()
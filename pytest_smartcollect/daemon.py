@@ -0,0 +1,533 @@
+# -*- coding: utf-8 -*-
+"""
+A long running process that keeps the analysis of a repository warm between pytest runs.
+
+The daemon watches the working tree, with inotify where it is available and by polling modification times elsewhere,
+and throws away the summaries of the files that change, so that each run only re-reads and re-parses those.  The
+selection for the commits being compared is kept until HEAD, the diff base, the test impact database or a python file
+changes.  pytest --smart-collect asks it for the analysis of the collected tests over a unix socket, and does the
+analysis itself when the daemon isn't running.
+
+    $ python -m pytest_smartcollect.daemon ~/src/my_project &
+    $ python -m pytest_smartcollect.daemon ~/src/my_project --stop
+"""
+import os
+import sys
+import abc
+import json
+import stat
+import errno
+import select
+import signal
+import struct
+import ctypes
+import ctypes.util
+import logging
+import argparse
+import typing
+import threading
+import subprocess
+import socketserver
+from pytest_smartcollect import __version__
+from pytest_smartcollect.helpers import SmartCollector, find_daemon_socket, is_owned_by_user, query_daemon, DAEMON_PROTOCOL_VERSION, DAEMON_SUPPORTED
+
+DEFAULT_POLL_INTERVAL = 1.0  # seconds
+IGNORED_DIRS = ('.git', '__pycache__', '.pytest_cache')
+REQUEST_OPTIONS = ('rootdir', 'cache_dir', 'ignore_source', 'commit_range', 'diff_current_head_with_branch', 'untracked', 'source_roots')
+
+IN_MODIFY = 0x00000002
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ISDIR = 0x40000000
+
+
+def is_source_file(path: str) -> bool:
+    return os.path.splitext(path)[-1] == ".py"
+
+
+def make_socket_directory(directory: str):
+    # the directory of the socket keeps other users from connecting to the daemon, or from taking its place
+    try:
+        os.mkdir(directory, stat.S_IRWXU)
+
+    except OSError as e:
+        if e.errno != errno.EEXIST:
+            raise
+
+    st = os.lstat(directory)
+    if not stat.S_ISDIR(st.st_mode) or st.st_uid != os.getuid() or st.st_mode & (stat.S_IRWXG | stat.S_IRWXO):
+        raise Exception("%s must be a directory that only the current user can access" % directory)
+
+
+def find_ignored_directories(root: str) -> set:
+    # the directories git ignores, like virtualenvs, node_modules and build output, which aren't watched
+    try:
+        output = subprocess.check_output(
+            ["git", "ls-files", "-z", "--others", "--ignored", "--exclude-standard", "--directory"], cwd=root, stderr=subprocess.DEVNULL
+        )
+
+    except (OSError, subprocess.CalledProcessError):
+        return set()
+
+    return set(os.path.join(root, *p.rstrip('/').split('/')) for p in os.fsdecode(output).split('\0') if p.endswith('/'))
+
+
+def is_ignored(root: str, path: str) -> bool:
+    return subprocess.call(["git", "check-ignore", "-q", path], cwd=root, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL) == 0
+
+
+class Watcher(object, metaclass=abc.ABCMeta):
+    # Calls back with the python files that were created, changed or deleted, or with None when it lost track and
+    # anything may have changed, from a thread of its own, or from the thread that calls sync.  Only the directories
+    # that git doesn't ignore are watched.
+    def __init__(self, root: str, callback: typing.Callable):
+        self.root = root
+        self.callback = callback
+        self.stopped = threading.Event()
+        self.thread = None
+        self.lock = threading.Lock()
+        self.ignored = find_ignored_directories(root)
+
+    def walk(self, top: str, new: bool=False):
+        # the directories of the tree under top, with the names of their files.  new trees weren't there when the
+        # ignored directories were listed, so each of their directories is checked with git instead.
+        def watched(path):
+            if os.path.basename(path) in IGNORED_DIRS or path in self.ignored:
+                return False
+
+            return not (new and is_ignored(self.root, path))
+
+        if top != self.root and not watched(top):
+            return
+
+        for dirpath, dirnames, filenames in os.walk(top):
+            dirnames[:] = [d for d in dirnames if watched(os.path.join(dirpath, d))]
+            yield dirpath, filenames
+
+    def start(self):
+        self.thread = threading.Thread(target=self.run, name="smartcollect-watcher")
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self):
+        self.stopped.set()
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+
+    @abc.abstractmethod
+    def wait(self) -> bool:
+        # blocks until there may be changes to poll for, and returns False once the watcher is stopped
+        pass
+
+    @abc.abstractmethod
+    def poll(self) -> typing.Union[list, None]:
+        # the python files that changed since the last poll, or None when it lost track
+        pass
+
+    def sync(self):
+        # reports every change made up to now, so that the callback is done with them by the time this returns
+        with self.lock:
+            changed = self.poll()
+            if changed is None or changed:
+                self.callback(changed)
+
+    def run(self):
+        while self.wait():
+            self.sync()
+
+
+class PollingWatcher(Watcher):
+    # Compares the modification time and size of every python file in the tree every interval seconds.  Directories are
+    # only listed again when their own modification time changes, as it does when entries are added or removed.
+    def __init__(self, root: str, callback: typing.Callable, interval: float=DEFAULT_POLL_INTERVAL):
+        super(PollingWatcher, self).__init__(root, callback)
+        self.interval = interval
+        self.directories = {}  # directory -> modification time
+        self.snapshot = {}
+
+    def scan(self, top: str, new: bool=False) -> set:
+        # records the directories under top, and returns the python files in them
+        found = set()
+        for dirpath, filenames in self.walk(top, new):
+            try:
+                self.directories[dirpath] = os.stat(dirpath).st_mtime_ns
+
+            except OSError:  # deleted since it was listed
+                continue
+
+            found.update(os.path.join(dirpath, f) for f in filenames if is_source_file(f))
+
+        return found
+
+    def forget(self, directory: str, files: set):
+        prefix = directory + os.sep
+        for d in [d for d in self.directories if d == directory or d.startswith(prefix)]:
+            del self.directories[d]
+
+        files.difference_update([f for f in files if f.startswith(prefix)])
+
+    def take_snapshot(self) -> dict:
+        if not self.directories:
+            files = self.scan(self.root)
+
+        else:
+            files = set(self.snapshot)
+            for directory, mtime in list(self.directories.items()):
+                if directory not in self.directories:  # forgotten along with a parent
+                    continue
+
+                try:
+                    current = os.stat(directory).st_mtime_ns
+                    names = os.listdir(directory) if current != mtime else None
+
+                except OSError:
+                    self.forget(directory, files)
+                    continue
+
+                if names is None:
+                    continue
+
+                self.directories[directory] = current
+                files.difference_update([f for f in files if os.path.dirname(f) == directory])
+                for name in names:
+                    path = os.path.join(directory, name)
+                    if os.path.isdir(path):
+                        if path not in self.directories:
+                            files.update(self.scan(path, new=True))
+
+                    elif is_source_file(name):
+                        files.add(path)
+
+        snapshot = {}
+        for path in files:
+            try:
+                st = os.stat(path)
+                snapshot[path] = (st.st_mtime_ns, st.st_size)
+
+            except OSError:  # deleted since it was listed
+                pass
+
+        return snapshot
+
+    def start(self):
+        self.snapshot = self.take_snapshot()  # before serving, so that nothing changed after the first request is missed
+        super(PollingWatcher, self).start()
+
+    def wait(self) -> bool:
+        return not self.stopped.wait(self.interval)
+
+    def poll(self) -> list:
+        current = self.take_snapshot()
+        changed = [p for p in set(self.snapshot) | set(current) if self.snapshot.get(p) != current.get(p)]
+        self.snapshot = current
+        return sorted(changed)
+
+
+class InotifyWatcher(Watcher):
+    # Watches the directories of the tree with inotify, adding watches for directories as they are created
+    MASK = IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE
+    EVENT = struct.Struct('iIII')  # wd, mask, cookie, length of the name that follows
+
+    def __init__(self, root: str, callback: typing.Callable):
+        super(InotifyWatcher, self).__init__(root, callback)
+        self.libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        self.fd = self.libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), "Couldn't initialise inotify")
+
+        self.watches = {}  # watch descriptor -> directory
+        try:
+            self.add_tree(root)
+
+        except OSError:
+            os.close(self.fd)
+            raise
+
+    def add_tree(self, top: str, new: bool=False) -> list:
+        # watches top and every directory under it, and returns the python files already in them
+        found = []
+        for dirpath, filenames in self.walk(top, new):
+            wd = self.libc.inotify_add_watch(self.fd, os.fsencode(dirpath), self.MASK)
+            if wd < 0:  # most likely fs.inotify.max_user_watches
+                raise OSError(ctypes.get_errno(), "Couldn't watch '%s'" % dirpath)
+
+            self.watches[wd] = dirpath
+            found.extend(os.path.join(dirpath, f) for f in filenames if is_source_file(f))
+
+        return found
+
+    def rewatch(self):
+        # a directory was moved or deleted, so the paths of the watches under it no longer hold
+        for wd in list(self.watches):
+            self.libc.inotify_rm_watch(self.fd, wd)
+
+        self.watches = {}
+        self.ignored = find_ignored_directories(self.root)
+        self.add_tree(self.root)
+
+    def read_events(self, changed: set) -> typing.Union[bool, None]:
+        # adds the python files named by the events read in one go to changed, and returns False once there are no
+        # more events to read, or None when it lost track
+        try:
+            data = os.read(self.fd, 64 * 1024)
+
+        except BlockingIOError:
+            return False
+
+        offset = 0
+        while offset + self.EVENT.size <= len(data):
+            wd, mask, _, length = self.EVENT.unpack_from(data, offset)
+            name = os.fsdecode(data[offset + self.EVENT.size:offset + self.EVENT.size + length].rstrip(b'\0'))
+            offset += self.EVENT.size + length
+
+            if mask & IN_Q_OVERFLOW:
+                return None
+
+            if mask & IN_IGNORED:
+                self.watches.pop(wd, None)
+                continue
+
+            directory = self.watches.get(wd)
+            if directory is None:
+                continue
+
+            path = os.path.join(directory, name)
+            if mask & IN_ISDIR:
+                if name in IGNORED_DIRS:
+                    continue
+
+                if mask & (IN_MOVED_FROM | IN_DELETE):
+                    self.rewatch()
+                    return None
+
+                if mask & (IN_CREATE | IN_MOVED_TO):
+                    changed.update(self.add_tree(path, new=True))
+
+            elif is_source_file(name):
+                changed.add(path)
+
+        return True
+
+    def wait(self) -> bool:
+        while not self.stopped.is_set():
+            if select.select([self.fd], [], [], 0.2)[0]:
+                return True
+
+        return False
+
+    def poll(self) -> typing.Union[list, None]:
+        # drains every event queued so far, which includes those of every change made before the call
+        changed = set()
+        try:
+            while True:
+                more = self.read_events(changed)
+                if more is None:
+                    return None
+
+                if not more:
+                    return sorted(changed)
+
+        except OSError as e:
+            logging.getLogger("smartcollect.daemon").warning("Lost track of the working tree -- %s" % str(e))
+            return None
+
+    def stop(self):
+        super(InotifyWatcher, self).stop()
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
+
+
+def make_watcher(root: str, callback: typing.Callable, poll_interval: typing.Union[float, None], logger: logging.Logger) -> Watcher:
+    if poll_interval is None and sys.platform.startswith('linux'):
+        try:
+            return InotifyWatcher(root, callback)
+
+        except (OSError, AttributeError) as e:
+            logger.warning("Couldn't watch the working tree with inotify, polling it instead -- %s" % str(e))
+
+    return PollingWatcher(root, callback, poll_interval or DEFAULT_POLL_INTERVAL)
+
+
+class DaemonRequestHandler(socketserver.StreamRequestHandler):
+    def handle(self):
+        try:
+            response = self.server.smartcollect_daemon.handle(json.loads(self.rfile.readline().decode('utf-8')))
+
+        except Exception as e:
+            response = {'error': str(e)}
+
+        self.wfile.write(json.dumps(response).encode('utf-8') + b"\n")
+
+
+class SmartCollectDaemon(object):
+    # Answers the analysis of tests over a unix socket, from module summaries, a symbol graph and a diff that are kept
+    # in memory for as long as their inputs stay the same
+    def __init__(self, repo_root: str, poll_interval: typing.Union[float, None]=None, logger: typing.Union[logging.Logger, None]=None):
+        self.repo_root = os.path.realpath(repo_root)
+        self.logger = logger or logging.getLogger("smartcollect.daemon")
+        self.socket_path = find_daemon_socket(self.repo_root)
+        self.lock = threading.Lock()
+        self.summaries = {}  # shared by the collectors of every set of options
+        self.roots = set()  # the repository root, as spelled by each client
+        self.selections = {}  # options -> (state, collector, selection)
+        self.generation = 0  # incremented whenever a python file changes
+        self.watcher = make_watcher(self.repo_root, self.invalidate, poll_interval, self.logger)
+
+        make_socket_directory(os.path.dirname(self.socket_path))
+        self.remove_stale_socket()
+        self.server = socketserver.UnixStreamServer(self.socket_path, DaemonRequestHandler)
+        self.server.smartcollect_daemon = self
+        os.chmod(self.socket_path, stat.S_IRUSR | stat.S_IWUSR)
+
+    def remove_stale_socket(self):
+        if not os.path.lexists(self.socket_path):
+            return
+
+        if not is_owned_by_user(self.socket_path):
+            raise Exception("%s belongs to another user, so it won't be replaced" % self.socket_path)
+
+        try:
+            query_daemon(self.socket_path, {'command': 'ping'}, timeout=5)
+
+        except Exception:
+            os.unlink(self.socket_path)  # left behind by a daemon that didn't shut down cleanly
+
+        else:
+            raise Exception("A smart collection daemon is already running for '%s' at %s" % (self.repo_root, self.socket_path))
+
+    def invalidate(self, paths: typing.Union[list, None]):
+        with self.lock:
+            if paths is None:
+                self.summaries.clear()
+
+            else:
+                for path in paths:
+                    relpath = os.path.relpath(path, self.repo_root)
+                    for root in self.roots:
+                        self.summaries.pop(os.path.join(root, relpath), None)
+
+            self.generation += 1
+            self.selections.clear()
+
+        self.logger.info("%s changed" % (', '.join(os.path.relpath(p, self.repo_root) for p in paths) if paths else "The working tree"))
+
+    def find_selection(self, request: dict) -> tuple:
+        # the collector and selection for the options of the request, prepared again only when their inputs changed
+        collector = SmartCollector(
+            request['rootdir'],
+            [],  # the client handles the tests that failed last time, and skip markers
+            request['ignore_source'],
+            request['commit_range'],
+            request['diff_current_head_with_branch'],
+            False,
+            self.logger,
+            cache_dir=request['cache_dir'],
+            untracked=request['untracked'],
+            source_roots=request['source_roots']
+        )
+        collector.summaries = self.summaries
+        self.roots.add(collector.git_repo_root)
+        if os.path.realpath(collector.git_repo_root) != self.repo_root:
+            raise Exception("The smart collection daemon serves '%s', not '%s'" % (self.repo_root, collector.git_repo_root))
+
+        commits = collector.find_commit_range(collector.git_repo_root)
+        impact_db = None
+        if collector.impact_db_path and os.path.isfile(collector.impact_db_path):
+            st = os.stat(collector.impact_db_path)
+            impact_db = (st.st_mtime_ns, st.st_size)
+
+        key = json.dumps([request[option] for option in REQUEST_OPTIONS])
+        state = (commits.head, commits.base, self.generation, impact_db)
+        cached = self.selections.get(key)
+        if cached is not None and cached[0] == state:
+            return cached[1], cached[2]
+
+        self.logger.info("Preparing the selection of %s against %s" % (commits.head[:12], commits.base[:12]))
+        selection = collector.prepare_selection()
+        self.selections[key] = (state, collector, selection)
+        return collector, selection
+
+    def handle(self, request: dict) -> dict:
+        command = request.get('command', 'analyse')
+        if command == 'ping':
+            return {}
+
+        if command == 'stop':
+            threading.Thread(target=self.server.shutdown).start()  # shutdown waits for this request to be answered
+            return {}
+
+        if request.get('version') != DAEMON_PROTOCOL_VERSION or request.get('smartcollect') != __version__:
+            return {'error': "The smart collection daemon runs pytest-smartcollect %s and needs restarting" % __version__}
+
+        self.watcher.sync()  # the watcher thread may not have caught up with the working tree yet
+        with self.lock:
+            collector, selection = self.find_selection(request)
+            decisions = {}
+            for path, test_name, nodeid, fixtures, node_name in request['tests']:
+                fixtures = [tuple(fixture) for fixture in fixtures] if fixtures is not None else None
+                decisions[nodeid] = collector.analyse_test(selection, path, test_name, nodeid, fixtures, node_name)
+
+            collector.summary_cache.save()
+
+        self.logger.info("Analysed %d tests" % len(decisions))
+        return {'decisions': decisions}
+
+    def serve_forever(self):
+        self.watcher.start()
+        self.logger.info("Serving smart collection for '%s' at %s" % (self.repo_root, self.socket_path))
+        try:
+            self.server.serve_forever()
+
+        finally:
+            self.close()
+
+    def shutdown(self):
+        # from any thread but the one serving
+        self.server.shutdown()
+
+    def close(self):
+        self.watcher.stop()
+        self.server.server_close()
+        try:
+            os.unlink(self.socket_path)
+
+        except OSError as e:
+            if e.errno != errno.ENOENT:
+                raise
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("path", nargs="?", default=".", help="a path in the git repository to serve. Default is the current directory.")
+    parser.add_argument("--poll-interval", type=float, default=None, metavar="SECONDS", help="poll the working tree for changes every SECONDS, even where inotify is available")
+    parser.add_argument("--stop", action="store_true", help="stop the daemon serving the repository")
+    args = parser.parse_args(argv)
+    if not DAEMON_SUPPORTED:
+        parser.error("the smart collection daemon needs unix sockets, which aren't available on this platform")
+
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(message)s")
+    repo_root = subprocess.check_output(["git", "rev-parse", "--show-toplevel"], cwd=os.path.abspath(args.path)).decode('utf-8').strip()
+
+    if args.stop:
+        query_daemon(find_daemon_socket(repo_root), {'command': 'stop'})
+        return
+
+    daemon = SmartCollectDaemon(repo_root, poll_interval=args.poll_interval)
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    try:
+        daemon.serve_forever()
+
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
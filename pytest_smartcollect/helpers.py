@@ -1,33 +1,243 @@
 import re
 import os
+import csv
 import sys
+import io
 import ast
+import json
+import time
+import array
+import bisect
 import pytest
 import typing
+import socket
+import sqlite3
+import tempfile
+import contextlib
+import hashlib
 import logging
+import fnmatch
+import inspect
+import tokenize
+import subprocess
 from git import Repo
-from importlib import import_module
+from collections import OrderedDict, deque
+from concurrent.futures import ProcessPoolExecutor
 from chardet import UniversalDetector
+from pytest_smartcollect import __version__
 
 ListOrNone = typing.Union[list, None]
 StrOrNone = typing.Union[str, None]
 ListOfString = typing.List[str]
 DictOfListOfString = typing.Dict[str, ListOfString]
 DictOfString = typing.Dict[str, str]
+Node = typing.Tuple[str, str]  # (path, object name)
+ListOfNode = typing.List[Node]
+DictOfListOfNode = typing.Dict[str, ListOfNode]
 ListOfTestItem = typing.List[pytest.Item]
 
+SUMMARY_FORMAT_VERSION = 7
+DEFAULT_CACHE_MAX_SIZE = 256 * 1024 * 1024  # bytes
+DEFAULT_CACHE_MAX_AGE = 30 * 24 * 60 * 60  # seconds
+CACHE_EVICTION_INTERVAL = 24 * 60 * 60  # seconds
+IMPACT_DB_FORMAT_VERSION = 1
+IMPACT_DB_NAME = "impact.db"
+WHOLE_FILE = range(1, 2 ** 31)
+EXPLICIT_METHOD_DECORATORS = ('staticmethod', 'classmethod')
+DAEMON_PROTOCOL_VERSION = 5
+DAEMON_TIMEOUT = 60  # seconds
+DAEMON_SUPPORTED = os.name == 'posix' and hasattr(socket, 'AF_UNIX')  # the daemon is served over a unix socket
+GLOB_CHARACTERS = re.compile(r'[*?\[]')
+ASSIGNMENT_NODES = tuple(getattr(ast, name) for name in ('Assign', 'AugAssign', 'AnnAssign') if hasattr(ast, name))
+
 
 class ChangedFile(object):
-    def __init__(self, change_type: str, current_filepath: str, old_filepath: StrOrNone=None, changed_lines: ListOrNone=None):
+    def __init__(self, change_type: str, current_filepath: str, old_filepath: StrOrNone=None, changed_lines: ListOrNone=None, removed_lines: ListOrNone=None, base_lines: ListOrNone=None):
         self.change_type = change_type
         self.old_filepath = old_filepath
         self.current_filepath = current_filepath
-        self.changed_lines = changed_lines
+        self.changed_lines = changed_lines  # line ranges of the current file that were added or changed, or next to removed lines
+        self.removed_lines = removed_lines  # line ranges of the old file that were removed or changed
+        self.base_lines = base_lines  # line ranges of the old file that were removed or changed, or next to added lines
 
 
 DictOfChangedFile = typing.Dict[str, ChangedFile]
 
 
+class LineIntervals(object):
+    # Sorted, merged half open intervals of line numbers, kept in two arrays so that memory grows with the number of
+    # hunks rather than the number of lines, and overlaps are found by bisection
+    def __init__(self, line_ranges: typing.Iterable[range]=()):
+        self.starts = array.array('l')
+        self.ends = array.array('l')
+
+        for r in sorted((r for r in line_ranges if len(r)), key=lambda r: r.start):
+            if self.ends and r.start <= self.ends[-1]:
+                self.ends[-1] = max(self.ends[-1], r.stop)
+
+            else:
+                self.starts.append(r.start)
+                self.ends.append(r.stop)
+
+    def __len__(self) -> int:
+        return len(self.starts)
+
+    def __iter__(self):
+        return (range(start, end) for start, end in zip(self.starts, self.ends))
+
+    def overlaps(self, start: int, end: int) -> bool:
+        # whether any of the lines from start up to (but not including) end is in one of the intervals
+        idx = bisect.bisect_left(self.starts, end) - 1
+        return idx >= 0 and self.ends[idx] > start
+
+
+class GitDiffReader(object):
+    # Stream parser for the output of 'git diff --raw -p -z -U0', which is the NUL separated raw listing of changed paths
+    # followed by the patches.  Only the hunk headers of the patches are kept, the patch text itself is discarded as it
+    # is read.
+    HUNK_HEADER = re.compile(br'^@@ -(\d+)(?:,(\d+))? \+(\d+)(?:,(\d+))? @@')
+
+    def __init__(self, stream: typing.BinaryIO, chunk_size: int=64 * 1024):
+        self.stream = stream
+        self.chunk_size = chunk_size
+        self._buffer = b''
+        self._offset = 0  # where the next token starts in the buffer, which is only compacted when it's refilled
+        self._eof = False
+
+    def _read_until(self, delimiter: bytes) -> typing.Union[bytes, None]:
+        start = self._offset
+        while True:
+            idx = self._buffer.find(delimiter, start)
+            if idx >= 0:
+                token = self._buffer[self._offset:idx]
+                self._offset = idx + 1
+                return token
+
+            if self._eof:
+                token, self._buffer, self._offset = self._buffer[self._offset:], b'', 0
+                return token if token else None
+
+            chunk = self.stream.read1(self.chunk_size) if hasattr(self.stream, 'read1') else self.stream.read(self.chunk_size)
+            if not chunk:
+                self._eof = True
+
+            self._buffer = self._buffer[self._offset:] + chunk
+            self._offset = 0
+            start = len(self._buffer) - len(chunk)  # the rest was searched already
+
+    @staticmethod
+    def decode_path(raw: bytes) -> str:
+        path = raw.decode('utf-8', 'surrogateescape')
+        if path.startswith('"') and path.endswith('"'):  # C style quoting, used for unusual characters
+            path = path[1:-1].encode('latin-1', 'backslashreplace').decode('unicode_escape').encode('latin-1').decode('utf-8', 'surrogateescape')
+
+        return path
+
+    def read(self) -> typing.List[tuple]:
+        # returns (change type, old path, new path, [(old start, old count, new start, new count)]) for each changed path
+        entries = []
+        hunks = {}
+
+        # the raw listing of changed paths
+        while True:
+            token = self._read_until(b'\0')
+            if not token:  # an empty token separates the listing from the patches
+                break
+
+            status = token.decode('ascii').split(' ')[-1]
+            old_path = self.decode_path(self._read_until(b'\0'))
+            new_path = old_path
+            if status[0] in ('R', 'C'):
+                new_path = self.decode_path(self._read_until(b'\0'))
+
+            entries.append((status[0], old_path, new_path))
+
+        # the patches, from which only the hunk headers are kept
+        current_path = None
+        while True:
+            line = self._read_until(b'\n')
+            if line is None:
+                break
+
+            if line.startswith(b'diff --git '):
+                current_path = None
+
+            elif line.startswith(b'+++ '):
+                path = line[4:].rstrip(b'\t\r')
+                current_path = None if path == b'/dev/null' else self.decode_path(path)[2:]
+
+            elif line.startswith(b'@@ ') and current_path is not None:
+                match = self.HUNK_HEADER.match(line)
+                old_start, old_count, new_start, new_count = match.groups()
+                hunks.setdefault(current_path, []).append((
+                    int(old_start),
+                    1 if old_count is None else int(old_count),
+                    int(new_start),
+                    1 if new_count is None else int(new_count)
+                ))
+
+        return [(change_type, old_path, new_path, hunks.get(new_path, [])) for change_type, old_path, new_path in entries]
+
+
+class CollectionStats(object):
+    # Wall and CPU time spent in each phase of smart collection, and counters of the work done in them
+    def __init__(self):
+        self.phases = OrderedDict()  # phase -> [wall seconds, cpu seconds]
+        self.counters = OrderedDict()
+
+    @contextlib.contextmanager
+    def phase(self, name: str):
+        wall, cpu = time.perf_counter(), time.process_time()
+        try:
+            yield
+
+        finally:
+            totals = self.phases.setdefault(name, [0.0, 0.0])
+            totals[0] += time.perf_counter() - wall
+            totals[1] += time.process_time() - cpu
+
+    def count(self, name: str, n: int=1):
+        self.counters[name] = self.counters.get(name, 0) + n
+
+    def set(self, name: str, value: int):
+        self.counters[name] = value
+
+    def to_dict(self) -> dict:
+        return {
+            'phases': OrderedDict((name, {'wall': wall, 'cpu': cpu}) for name, (wall, cpu) in self.phases.items()),
+            'counters': self.counters
+        }
+
+
+class SelectionReport(object):
+    # Streams each selection decision to a CSV or JSON lines file as it is made, rather than holding them until the end
+    FORMATS = ('csv', 'jsonl')
+    EXTENSIONS = {'.csv': 'csv', '.jsonl': 'jsonl', '.json': 'jsonl'}
+
+    def __init__(self, path: str, report_format: StrOrNone=None):
+        self.path = path
+        self.format = report_format or self.find_format(path)
+        if self.format not in self.FORMATS:
+            raise Exception("Couldn't determine the report format of '%s' -- use a .csv or .jsonl file" % path)
+
+        self.file = open(path, "w", newline='' if self.format == 'csv' else None)
+        self.writer = csv.writer(self.file) if self.format == 'csv' else None
+
+    @classmethod
+    def find_format(cls, path: str) -> StrOrNone:
+        return cls.EXTENSIONS.get(os.path.splitext(path)[-1].lower())
+
+    def write(self, decision: str, nodeid: str, reason: str):
+        if self.writer is not None:
+            self.writer.writerow([decision, nodeid, reason])
+
+        else:
+            self.file.write(json.dumps({'decision': decision, 'nodeid': nodeid, 'reason': reason}) + "\n")
+
+    def close(self):
+        self.file.close()
+
+
 class GenericVisitor(ast.NodeVisitor):
     def __init__(self):
         super(GenericVisitor, self).__init__()
@@ -69,6 +279,18 @@ class ObjectNameExtractor(GenericVisitor):
                 self.cache.append(child.id)
 
 
+class AttributeCallExtractor(GenericVisitor):
+    # the attribute names involved in calls, like 'method' in obj.method() and Class.method(), which are matched against
+    # the methods of the project's classes
+    def __init__(self):
+        super(AttributeCallExtractor, self).__init__()
+
+    def visit_Call(self, node):
+        for child in ast.walk(node):
+            if isinstance(child, ast.Attribute):
+                self.cache.append(child.attr)
+
+
 class DefinitionNodeExtractor(GenericVisitor):
     def __init__(self):
         super(DefinitionNodeExtractor, self).__init__()
@@ -93,6 +315,19 @@ class ImportModuleNameExtractor(GenericVisitor):
         self.cache.append((node.module, names, node.level))
 
 
+class ImportAliasExtractor(GenericVisitor):
+    def __init__(self):
+        super(ImportAliasExtractor, self).__init__()
+
+    def visit_Import(self, node):
+        for alias in node.names:
+            self.cache.append((alias.name, [], 0))
+
+    def visit_ImportFrom(self, node):
+        names = [(alias.name, alias.asname) for alias in node.names]
+        self.cache.append((node.module, names, node.level))
+
+
 class FixtureExtractor(GenericVisitor):
     def __init__(self):
         super(FixtureExtractor, self).__init__()
@@ -109,47 +344,1267 @@ class FixtureExtractor(GenericVisitor):
                         self.cache.append(node)
 
 
+class DefinitionSummary(object):
+    def __init__(self, name: str, kind: str, lineno: int, parent: StrOrNone=None, toplevel: bool=False, used_names: ListOrNone=None, base_names: ListOrNone=None, arg_names: ListOrNone=None, used_attributes: ListOrNone=None, first_lineno: typing.Union[int, None]=None, parent_toplevel: bool=False):
+        self.name = name
+        self.kind = kind
+        self.lineno = lineno
+        self.first_lineno = first_lineno or lineno  # the line of the first decorator, like co_firstlineno
+        self.parent = parent  # the name of the enclosing class, if any
+        self.parent_toplevel = parent_toplevel  # whether the enclosing class is defined at module level
+        self.toplevel = toplevel
+        self.used_names = used_names or []  # for classes, only the names used outside of their methods
+        self.base_names = base_names or []
+        self.arg_names = arg_names or []
+        self.used_attributes = used_attributes or []
+
+    @property
+    def qualified_name(self) -> str:
+        return "%s.%s" % (self.parent, self.name) if self.parent else self.name
+
+    def to_dict(self) -> dict:
+        return {
+            'name': self.name,
+            'kind': self.kind,
+            'lineno': self.lineno,
+            'first_lineno': self.first_lineno,
+            'parent': self.parent,
+            'parent_toplevel': self.parent_toplevel,
+            'toplevel': self.toplevel,
+            'used_names': self.used_names,
+            'base_names': self.base_names,
+            'arg_names': self.arg_names,
+            'used_attributes': self.used_attributes
+        }
+
+    @classmethod
+    def from_dict(cls, d: dict):
+        return cls(**d)
+
+
+class ModuleSummary(object):
+    def __init__(self, path: str, digest: str, linecount: int, definitions: ListOrNone=None, imports: ListOrNone=None, members: ListOrNone=None, fixtures: ListOrNone=None, top_level_names: ListOrNone=None, all_names: ListOrNone=None, reexports: ListOrNone=None, module_imports: ListOrNone=None, member_parts: typing.Union[dict, None]=None):
+        self.path = path
+        self.digest = digest
+        self.linecount = linecount
+        self.definitions = definitions or []  # every function and class definition, in the same order as DefinitionNodeExtractor
+        self.imports = imports or []  # (module name, [(imported name, alias)], import level), as produced by ImportAliasExtractor
+        self.members = members or []  # (names, first line, last line + 1) for each top level member that find_changed_members cares about
+        self.fixtures = fixtures or []
+        self.top_level_names = top_level_names or []  # names defined or assigned at module level
+        self.all_names = all_names  # the contents of __all__, if it is a literal
+        self.reexports = reexports or []  # (module name, import level, [(name, asname)]) for each module level 'from x import y'
+        self.module_imports = module_imports or []  # (bound name, module name) for each module level 'import x'
+        self.member_parts = member_parts or {}  # top level class name -> (Class.method or Class, first line, last line + 1, implicit)
+        self._definitions_by_name = None
+        self._line_index = None
+
+    @property
+    def line_index(self) -> dict:
+        # first line (as in co_firstlineno) -> function definition, to find a test from its code object
+        if self._line_index is None:
+            self._line_index = {d.first_lineno: d for d in self.definitions if d.kind == 'function'}
+
+        return self._line_index
+
+    def find_definition(self, name: str):
+        # methods are found by their qualified name (Class.method), as well as their own name if nothing else has it
+        if self._definitions_by_name is None:
+            self._definitions_by_name = {}
+            for definition in sorted(self.definitions, key=lambda d: not d.toplevel):  # module level definitions first
+                self._definitions_by_name.setdefault(definition.name, definition)
+                if definition.parent:
+                    self._definitions_by_name.setdefault(definition.qualified_name, definition)
+
+        return self._definitions_by_name.get(name)
+
+    def find_methods(self, class_name: str) -> ListOfString:
+        # the Class.method parts of a top level class
+        return [name for name, _, _, _ in self.member_parts.get(class_name, []) if name != class_name]
+
+    def implicit_methods(self, class_name: str) -> ListOfString:
+        # the methods of a top level class that can run without being called by name, like __init__ and properties
+        return [name for name, _, _, implicit in self.member_parts.get(class_name, []) if implicit]
+
+    def to_dict(self) -> dict:
+        return {
+            'linecount': self.linecount,
+            'definitions': [d.to_dict() for d in self.definitions],
+            'imports': self.imports,
+            'members': self.members,
+            'fixtures': self.fixtures,
+            'top_level_names': self.top_level_names,
+            'all_names': self.all_names,
+            'reexports': self.reexports,
+            'module_imports': self.module_imports,
+            'member_parts': self.member_parts
+        }
+
+    @classmethod
+    def from_dict(cls, path: str, digest: str, d: dict):
+        return cls(
+            path,
+            digest,
+            d['linecount'],
+            definitions=[DefinitionSummary.from_dict(x) for x in d['definitions']],
+            imports=[(m, [tuple(n) for n in names], l) for m, names, l in d['imports']],
+            members=[tuple(x) for x in d['members']],
+            fixtures=d['fixtures'],
+            top_level_names=d['top_level_names'],
+            all_names=d['all_names'],
+            reexports=[(m, l, [tuple(n) for n in names]) for m, l, names in d['reexports']],
+            module_imports=[tuple(x) for x in d['module_imports']],
+            member_parts={k: [tuple(x) for x in v] for k, v in d['member_parts'].items()}
+        )
+
+    @classmethod
+    def from_source(cls, path: str, digest: str, contents: str, linecount: int):
+        module_ast = ast.parse(contents)
+        definitions = []
+
+        def first_line(node):
+            return min([node.lineno] + [d.lineno for d in getattr(node, 'decorator_list', [])])
+
+        def summarise_definitions(node, parent, toplevel, parent_toplevel=False):
+            # mirrors the traversal order of DefinitionNodeExtractor, but keeps track of the enclosing class
+            for child in ast.iter_child_nodes(node):
+                if isinstance(child, ast.FunctionDef):
+                    definitions.append(DefinitionSummary(
+                        child.name,
+                        'function',
+                        child.lineno,
+                        parent=parent,
+                        toplevel=toplevel,
+                        used_names=ObjectNameExtractor().extract(child),
+                        arg_names=[a.arg for a in child.args.args],
+                        used_attributes=list(OrderedDict.fromkeys(AttributeCallExtractor().extract(child))),
+                        first_lineno=first_line(child),
+                        parent_toplevel=parent_toplevel
+                    ))
+
+                elif isinstance(child, ast.ClassDef):
+                    # the methods are definitions in their own right, so only the rest of the class body counts here
+                    shell = [n for n in child.body if not isinstance(n, ast.FunctionDef)]
+                    shell.extend(ast.Expr(value=n) for n in child.decorator_list + child.bases + child.keywords)
+                    shell = ast.Module(body=shell)
+
+                    definitions.append(DefinitionSummary(
+                        child.name,
+                        'class',
+                        child.lineno,
+                        parent=parent,
+                        toplevel=toplevel,
+                        used_names=ObjectNameExtractor().extract(shell),
+                        base_names=BaseClassNameExtractor().extract(child),
+                        used_attributes=list(OrderedDict.fromkeys(AttributeCallExtractor().extract(shell))),
+                        first_lineno=first_line(child),
+                        parent_toplevel=parent_toplevel
+                    ))
+                    summarise_definitions(child, child.name, False, toplevel)
+
+                else:
+                    summarise_definitions(child, parent, False)
+
+        summarise_definitions(module_ast, None, True)
+
+        def decorator_name(node):
+            node = node.func if isinstance(node, ast.Call) else node
+            return node.attr if isinstance(node, ast.Attribute) else getattr(node, 'id', None)
+
+        def class_parts(node, start, end):
+            # splits a class into its methods and the rest of its body, including the header up to the first statement
+            parts = [(node.name, start, first_line(node.body[0]), False)]
+            for idx, child in enumerate(node.body):
+                if getattr(child, 'end_lineno', None) is not None:  # python 3.8+
+                    child_end = child.end_lineno + 1
+
+                elif idx + 1 < len(node.body):
+                    child_end = first_line(node.body[idx + 1])
+
+                else:
+                    child_end = end
+
+                if isinstance(child, ast.FunctionDef):
+                    # dunder methods and properties run without being called by name, so they are part of the class
+                    implicit = (child.name.startswith('__') and child.name.endswith('__')) or any(
+                        decorator_name(d) not in EXPLICIT_METHOD_DECORATORS for d in child.decorator_list
+                    )
+                    parts.append(("%s.%s" % (node.name, child.name), first_line(child), child_end, implicit))
+
+                else:
+                    parts.append((node.name, first_line(child), child_end, False))
+
+            return parts
+
+        members = []
+        member_parts = {}
+        direct_children = list(ast.iter_child_nodes(module_ast))
+        for idx, node in enumerate(direct_children):
+            if isinstance(node, ast.Assign) or isinstance(node, ast.FunctionDef) or isinstance(node, ast.ClassDef):
+                if getattr(node, 'end_lineno', None) is not None:  # python 3.8+
+                    end = node.end_lineno + 1
+
+                elif idx + 1 < len(direct_children):
+                    end = direct_children[idx + 1].lineno
+
+                else:
+                    end = linecount + 1
+
+                if isinstance(node, ast.Assign):
+                    names = ObjectNameExtractor().extract(node)
+
+                else:
+                    names = [node.name]
+
+                start = first_line(node)
+                members.append((names, start, end))
+
+                if isinstance(node, ast.ClassDef):
+                    member_parts[node.name] = class_parts(node, start, end)
+
+        top_level_names = []
+        all_names = None
+        reexports = []
+        module_imports = []
+
+        def module_level_statements(body):
+            # statements that bind module level names, including those guarded by if or try blocks
+            for node in body:
+                if isinstance(node, ast.If):
+                    yield from module_level_statements(node.body)
+                    yield from module_level_statements(node.orelse)
+
+                elif isinstance(node, ast.Try):
+                    yield from module_level_statements(node.body)
+                    for handler in node.handlers:
+                        yield from module_level_statements(handler.body)
+
+                    yield from module_level_statements(node.orelse)
+                    yield from module_level_statements(node.finalbody)
+
+                else:
+                    yield node
+
+        for node in module_level_statements(module_ast.body):
+            if isinstance(node, (ast.FunctionDef, ast.ClassDef)):
+                top_level_names.append(node.name)
+
+            elif isinstance(node, ASSIGNMENT_NODES):
+                targets = node.targets if isinstance(node, ast.Assign) else [node.target]
+                for target in targets:
+                    for n in ast.walk(target):
+                        if isinstance(n, ast.Name):
+                            top_level_names.append(n.id)
+
+                        if isinstance(n, ast.Name) and n.id == '__all__' and node.value is not None:
+                            try:
+                                value = list(ast.literal_eval(node.value))
+
+                            except (ValueError, TypeError, SyntaxError):
+                                continue
+
+                            if isinstance(node, ast.AugAssign):
+                                all_names = (all_names or []) + value
+
+                            else:
+                                all_names = value
+
+            elif isinstance(node, ast.ImportFrom):
+                reexports.append((node.module, node.level, [(a.name, a.asname) for a in node.names]))
+
+            elif isinstance(node, ast.Import):
+                for a in node.names:
+                    if a.asname is not None:
+                        module_imports.append((a.asname, a.name))
+
+                    else:
+                        module_imports.append((a.name.split('.')[0], a.name.split('.')[0]))
+
+        return cls(
+            path,
+            digest,
+            linecount,
+            definitions=definitions,
+            imports=ImportAliasExtractor().extract(module_ast),
+            members=members,
+            member_parts=member_parts,
+            fixtures=[f.name for f in FixtureExtractor().extract(module_ast)],
+            top_level_names=list(OrderedDict.fromkeys(top_level_names)),
+            all_names=all_names,
+            reexports=reexports,
+            module_imports=module_imports
+        )
+
+    def exported_names(self) -> ListOfString:
+        # names bound at module level by this module itself, excluding star imports
+        names = list(self.top_level_names)
+        for _, _, imported_names in self.reexports:
+            names.extend(asname or name for name, asname in imported_names if name != '*')
+
+        names.extend(bound for bound, _ in self.module_imports)
+        return list(OrderedDict.fromkeys(names))
+
+
+class SummaryCache(object):
+    # Content addressed store of ModuleSummary objects, kept in the pytest cache directory.  Summaries are keyed by the
+    # git blob SHA of the source file, and the stat index used to skip hashing unchanged files is keyed by repo relative
+    # path, so the cache remains valid when the checkout moves.  Subprojects of a monorepo share the summaries, but each
+    # keeps a stat index of its own.
+    def __init__(self, cache_dir: StrOrNone, repo_root: str, max_size: int=DEFAULT_CACHE_MAX_SIZE, max_age: int=DEFAULT_CACHE_MAX_AGE, index_name: str="index.json"):
+        self.cache_dir = cache_dir
+        self.repo_root = repo_root
+        self.max_size = max_size
+        self.max_age = max_age
+        self.hits = 0
+        self.misses = 0
+        self._index = None
+        self._last_evicted = 0
+        self._dirty = False
+
+        if self.cache_dir is not None:
+            self.summary_dir = os.path.join(self.cache_dir, "summaries", "v%d" % SUMMARY_FORMAT_VERSION)
+            self.index_path = os.path.join(self.cache_dir, index_name)
+
+    @property
+    def index(self) -> dict:
+        # loaded lazily, since worker processes only ever need the summaries themselves
+        if self._index is None:
+            self._index = {}
+
+            if self.cache_dir is not None:
+                try:
+                    with open(self.index_path) as f:
+                        index = json.load(f)
+
+                    if index.get('version') == SUMMARY_FORMAT_VERSION:
+                        self._index = index['files']
+                        self._last_evicted = index['last_evicted']
+
+                except (IOError, OSError, ValueError, KeyError):
+                    pass
+
+        return self._index
+
+    def relpath(self, fpath: str) -> str:
+        return os.path.relpath(fpath, self.repo_root).replace(os.sep, '/')
+
+    @staticmethod
+    def blob_sha(data: bytes) -> str:
+        h = hashlib.sha1(b"blob %d\0" % len(data))
+        h.update(data)
+        return h.hexdigest()
+
+    def lookup_digest(self, fpath: str) -> StrOrNone:
+        # returns the digest recorded for fpath if the file hasn't changed on disk since it was recorded
+        entry = self.index.get(self.relpath(fpath))
+        if entry is None:
+            return None
+
+        st = os.stat(fpath)
+        size, mtime, digest = entry
+        if size == st.st_size and mtime == st.st_mtime_ns:
+            return digest
+
+        return None
+
+    def record_digest(self, fpath: str, digest: str):
+        st = os.stat(fpath)
+        if time.time() - st.st_mtime < 2:  # the file might be modified again within the mtime resolution, so don't trust the stat
+            mtime = -1
+
+        else:
+            mtime = st.st_mtime_ns
+
+        self.index[self.relpath(fpath)] = [st.st_size, mtime, digest]
+        self._dirty = True
+
+    def _summary_path(self, digest: str) -> str:
+        return os.path.join(self.summary_dir, digest[:2], digest[2:] + ".json")
+
+    def get(self, fpath: str, digest: str, count: bool=True):
+        if self.cache_dir is None:
+            return None
+
+        summary_path = self._summary_path(digest)
+        try:
+            with open(summary_path) as f:
+                summary = ModuleSummary.from_dict(fpath, digest, json.load(f))
+
+        except (IOError, OSError, ValueError, KeyError, TypeError):
+            return None
+
+        try:
+            os.utime(summary_path, None)  # keeps recently used entries from being evicted
+
+        except OSError:
+            pass
+
+        if count:
+            self.hits += 1
+
+        return summary
+
+    def put(self, summary: ModuleSummary):
+        if self.cache_dir is None:
+            return
+
+        summary_path = self._summary_path(summary.digest)
+        os.makedirs(os.path.dirname(summary_path), exist_ok=True)
+
+        tmp_path = "%s.%d.tmp" % (summary_path, os.getpid())
+        with open(tmp_path, "w") as f:
+            json.dump(summary.to_dict(), f, separators=(',', ':'))
+
+        os.replace(tmp_path, summary_path)
+
+    def save(self):
+        if self.cache_dir is None:
+            return
+
+        index = self.index
+        now = time.time()
+        if now - self._last_evicted > CACHE_EVICTION_INTERVAL:
+            self.evict(now)
+            self._last_evicted = now
+            self._dirty = True
+
+        if not self._dirty:
+            return
+
+        os.makedirs(self.cache_dir, exist_ok=True)
+        tmp_path = "%s.%d.tmp" % (self.index_path, os.getpid())
+        with open(tmp_path, "w") as f:
+            json.dump({'version': SUMMARY_FORMAT_VERSION, 'last_evicted': self._last_evicted, 'files': index}, f, separators=(',', ':'))
+
+        os.replace(tmp_path, self.index_path)
+        self._dirty = False
+
+    def evict(self, now: float):
+        # drop entries that haven't been used within max_age, then the least recently used ones until under max_size
+        entries = []
+        for root, _, files in os.walk(os.path.join(self.cache_dir, "summaries")):
+            for f in files:
+                fpath = os.path.join(root, f)
+                try:
+                    st = os.stat(fpath)
+
+                except OSError:
+                    continue
+
+                if now - st.st_mtime > self.max_age or not root.startswith(self.summary_dir):
+                    self._remove(fpath)
+
+                else:
+                    entries.append((st.st_mtime, st.st_size, fpath))
+
+        total_size = sum(e[1] for e in entries)
+        for _, size, fpath in sorted(entries):
+            if total_size <= self.max_size:
+                break
+
+            self._remove(fpath)
+            total_size -= size
+
+    @staticmethod
+    def _remove(fpath: str):
+        try:
+            os.remove(fpath)
+
+        except OSError:
+            pass
+
+
+class LineTracer(object):
+    # Records the lines of the files under root that are executed between start() and stop(), with sys.monitoring where
+    # it is available (python 3.12+) and sys.settrace otherwise.  A trace function that was already set, such as
+    # coverage's, keeps seeing every event through this one, and is set again by stop().
+    def __init__(self, root: str):
+        self.root = os.path.join(os.path.abspath(root), '')
+        self.lines = {}
+        self._wanted = {}
+        self._tool_id = None
+        self._previous_trace = None
+        self._trace = None
+
+    def wants(self, filename: str) -> bool:
+        wanted = self._wanted.get(filename)
+        if wanted is None:
+            path = os.path.abspath(filename)
+            wanted = self._wanted[filename] = path.startswith(self.root) and "site-packages" not in path.split(os.sep)
+
+        return wanted
+
+    def start(self):
+        self.lines = {}
+        if not self._start_monitoring():
+            self._previous_trace = sys.gettrace()
+            self._trace = self._trace_call
+            sys.settrace(self._trace)
+
+    def stop(self) -> typing.Dict[str, set]:
+        if self._tool_id is not None:
+            monitoring = sys.monitoring
+            monitoring.set_events(self._tool_id, 0)
+            monitoring.register_callback(self._tool_id, monitoring.events.LINE, None)
+            monitoring.register_callback(self._tool_id, monitoring.events.PY_START, None)
+            monitoring.free_tool_id(self._tool_id)
+            self._tool_id = None
+
+        else:
+            sys.settrace(self._previous_trace)
+            self._previous_trace = None
+            self._trace = None
+
+        return self.lines
+
+    def _start_monitoring(self) -> bool:
+        monitoring = getattr(sys, "monitoring", None)
+        if monitoring is None:
+            return False
+
+        # 0, 1, 2 and 5 are the ids of debuggers, coverage tools, profilers and optimizers, which leaves 3 and 4
+        for tool_id in (3, 4):
+            if monitoring.get_tool(tool_id) is None:
+                break
+
+        else:
+            return False
+
+        monitoring.use_tool_id(tool_id, "pytest-smartcollect")
+        monitoring.register_callback(tool_id, monitoring.events.LINE, self._on_line)
+        monitoring.register_callback(tool_id, monitoring.events.PY_START, self._on_start)
+        monitoring.set_events(tool_id, monitoring.events.LINE | monitoring.events.PY_START)
+        monitoring.restart_events()  # each line only needs to be seen once per recording
+        self._tool_id = tool_id
+        return True
+
+    def _on_line(self, code, line_number):
+        if self.wants(code.co_filename):
+            self.lines.setdefault(code.co_filename, set()).add(line_number)
+
+        return sys.monitoring.DISABLE
+
+    def _on_start(self, code, instruction_offset):
+        if self.wants(code.co_filename):
+            self.lines.setdefault(code.co_filename, set()).add(code.co_firstlineno)
+
+        return sys.monitoring.DISABLE
+
+    def _trace_call(self, frame, event, arg):
+        previous_trace = None
+        if self._previous_trace is not None:
+            previous_trace = self._previous_trace(frame, event, arg)
+            if sys.gettrace() is not self._trace:  # coverage's tracer sets itself again when it's called
+                sys.settrace(self._trace)
+
+        filename = frame.f_code.co_filename
+        if not self.wants(filename):
+            return previous_trace
+
+        self.lines.setdefault(filename, set()).add(frame.f_lineno)
+        return self._trace_lines(filename, previous_trace)
+
+    def _trace_lines(self, filename: str, previous_trace: typing.Union[typing.Callable, None]) -> typing.Callable:
+        # the local trace function of a frame, which hands every event on to the one the previous trace function returned
+        lines = self.lines[filename]
+
+        def trace_line(frame, event, arg):
+            nonlocal previous_trace
+            if event == 'line':
+                lines.add(frame.f_lineno)
+
+            if previous_trace is not None:
+                previous_trace = previous_trace(frame, event, arg)
+
+            return trace_line
+
+        return trace_line
+
+
+class ImpactDatabase(object):
+    # SQLite database of the spans of lines of each project file that each recorded test executed, as of one commit.
+    # Spans are indexed by file and first line, so the tests that executed a range of lines are found with one lookup.
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT);
+        CREATE TABLE IF NOT EXISTS files (id INTEGER PRIMARY KEY, path TEXT UNIQUE);
+        CREATE TABLE IF NOT EXISTS tests (id INTEGER PRIMARY KEY, nodeid TEXT UNIQUE);
+        CREATE TABLE IF NOT EXISTS spans (test_id INTEGER, file_id INTEGER, first INTEGER, last INTEGER);
+        CREATE INDEX IF NOT EXISTS spans_by_file ON spans (file_id, first, last);
+        CREATE INDEX IF NOT EXISTS spans_by_test ON spans (test_id);
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self.connection = sqlite3.connect(path, timeout=60)
+        self.connection.executescript(self.SCHEMA)
+        if self.get_meta("version") != str(IMPACT_DB_FORMAT_VERSION):
+            self.reset(None)
+
+    def get_meta(self, key: str) -> StrOrNone:
+        row = self.connection.execute("SELECT value FROM meta WHERE key = ?", (key,)).fetchone()
+        return row[0] if row else None
+
+    def set_meta(self, key: str, value: str):
+        self.connection.execute("INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)", (key, value))
+
+    @property
+    def commit(self) -> StrOrNone:
+        # the commit the recorded line numbers refer to
+        return self.get_meta("commit")
+
+    def reset(self, commit: StrOrNone):
+        with self.connection:
+            for table in ("meta", "files", "tests", "spans"):
+                self.connection.execute("DELETE FROM %s" % table)
+
+            self.set_meta("version", str(IMPACT_DB_FORMAT_VERSION))
+            if commit is not None:
+                self.set_meta("commit", commit)
+
+    def _id(self, table: str, column: str, value: str) -> int:
+        self.connection.execute("INSERT OR IGNORE INTO %s (%s) VALUES (?)" % (table, column), (value,))
+        return self.connection.execute("SELECT id FROM %s WHERE %s = ?" % (table, column), (value,)).fetchone()[0]
+
+    @staticmethod
+    def spans(lines: typing.Iterable[int]) -> typing.List[typing.Tuple[int, int]]:
+        # collapse line numbers into (first, last) spans of consecutive lines
+        spans = []
+        for line in sorted(lines):
+            if spans and line == spans[-1][1] + 1:
+                spans[-1][1] = line
+
+            else:
+                spans.append([line, line])
+
+        return [tuple(span) for span in spans]
+
+    def record(self, nodeid: str, lines: typing.Dict[str, typing.Iterable[int]]):
+        # replace the spans recorded for nodeid with lines, a mapping of repo relative paths to executed line numbers
+        with self.connection:
+            test_id = self._id("tests", "nodeid", nodeid)
+            self.connection.execute("DELETE FROM spans WHERE test_id = ?", (test_id,))
+            rows = []
+            for path, file_lines in lines.items():
+                file_id = self._id("files", "path", path)
+                rows.extend((test_id, file_id, first, last) for first, last in self.spans(file_lines))
+
+            self.connection.executemany("INSERT INTO spans (test_id, file_id, first, last) VALUES (?, ?, ?, ?)", rows)
+
+    def recorded_tests(self) -> typing.Set[str]:
+        return set(row[0] for row in self.connection.execute("SELECT nodeid FROM tests"))
+
+    def find_tests(self, path: str, line_ranges: typing.List[range]) -> typing.Dict[range, typing.Set[str]]:
+        # the tests that executed any of each of the line ranges of the file at path (repo relative)
+        found = {r: set() for r in line_ranges}
+        row = self.connection.execute("SELECT id FROM files WHERE path = ?", (path,)).fetchone()
+        if row is None:
+            return found
+
+        for r in line_ranges:
+            found[r].update(nodeid for nodeid, in self.connection.execute(
+                "SELECT DISTINCT tests.nodeid FROM spans JOIN tests ON tests.id = spans.test_id "
+                "WHERE spans.file_id = ? AND spans.first <= ? AND spans.last >= ?",
+                (row[0], r.stop - 1, r.start)
+            ))
+
+        return found
+
+    def close(self):
+        self.connection.close()
+
+
+class CommitRange(object):
+    # Works out which commits to diff using git plumbing whose cost doesn't depend on the length of the history
+    def __init__(self, repo_path: str, branch: str, commit_range: int):
+        self.repo_path = repo_path
+        self.branch = branch
+        self.commit_range = commit_range
+        self._head = None
+        self._merge_base = None
+        self._base = None
+
+    def git(self, *args) -> str:
+        proc = subprocess.Popen(["git"] + list(args), cwd=self.repo_path, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        stdout, stderr = proc.communicate()
+        if proc.returncode != 0:
+            raise Exception("git %s failed -- %s" % (' '.join(args), stderr.decode('utf-8', 'replace').strip()))
+
+        return stdout.decode('utf-8').strip()
+
+    def rev_parse(self, rev: str) -> str:
+        return self.git("rev-parse", "--verify", "--quiet", "%s^{commit}" % rev)
+
+    @property
+    def head(self) -> str:
+        if self._head is None:
+            self._head = self.rev_parse("HEAD")
+
+        return self._head
+
+    def is_root_commit(self, rev: str) -> bool:
+        try:
+            self.rev_parse("%s^" % rev)
+
+        except Exception:
+            return True
+
+        return False
+
+    @property
+    def merge_base(self) -> str:
+        # the commit at which HEAD diverged from the branch, so that changes made on the branch since aren't included
+        if self._merge_base is None:
+            self._merge_base = self.git("merge-base", self.rev_parse(self.branch), self.head)
+
+        return self._merge_base
+
+    @property
+    def base(self) -> str:
+        if self._base is None:
+            self._base = self.rev_parse("%s~%d" % (self.merge_base, self.commit_range))
+
+        return self._base
+
+    def diff_everything(self) -> bool:
+        # if HEAD is a root commit that the branch also points to, every path in the repo is considered to be changed
+        return self.is_root_commit(self.head) and self.merge_base == self.head
+
+
+class ModuleResolver(object):
+    # Maps module names to source files by looking for them on disk, without importing anything
+    def __init__(self, search_paths: ListOfString):
+        self.search_paths = list(OrderedDict.fromkeys(os.path.abspath(p) for p in search_paths if os.path.isdir(p)))
+        self.resolved = 0
+        self._module_files = {}
+
+    @staticmethod
+    def find_module_file_in(base: str) -> StrOrNone:
+        if os.path.isfile(base + ".py"):
+            return base + ".py"
+
+        init = os.path.join(base, "__init__.py")
+        if os.path.isfile(init):
+            return init
+
+        return None
+
+    def find_module_file(self, module_name: str) -> StrOrNone:
+        if module_name in self._module_files:
+            return self._module_files[module_name]
+
+        module_file = None
+        if module_name not in sys.builtin_module_names:
+            parts = module_name.split('.')
+            for search_path in self.search_paths:
+                module_file = self.find_module_file_in(os.path.join(search_path, *parts))
+                if module_file is not None:
+                    break
+
+        self._module_files[module_name] = module_file
+        return module_file
+
+    def resolve_import(self, path: str, module_name: StrOrNone, import_level: int) -> StrOrNone:
+        # returns the file of the module imported by an import statement in path
+        self.resolved += 1
+        if import_level == 0:
+            return self.find_module_file(module_name)
+
+        base = os.path.dirname(path)
+        for _ in range(1, import_level):
+            base = os.path.dirname(base)
+
+        if module_name is None:
+            return self.find_module_file_in(base)
+
+        return self.find_module_file_in(os.path.join(base, *module_name.split('.')))
+
+
+class PathTrie(object):
+    # The files of a repository as nested dicts of path components, with None for files, so that questions about the
+    # layout of the tree are answered without touching the file system
+    def __init__(self, root: str, relpaths: typing.Iterable[str]=()):
+        self.root = root
+        self.tree = {}
+        for relpath in relpaths:
+            self.add(relpath)
+
+    def add(self, relpath: str):
+        # relpath is relative to the root, with / as separator, as git lists it
+        node = self.tree
+        parts = relpath.split('/')
+        for part in parts[:-1]:
+            child = node.get(part)
+            if child is None:
+                child = node[part] = {}
+
+            node = child
+
+        node.setdefault(parts[-1], None)
+
+    def _parts(self, path: str) -> typing.Union[ListOfString, None]:
+        relpath = os.path.relpath(path, self.root)
+        if relpath == os.curdir:
+            return []
+
+        parts = relpath.split(os.sep)
+        return None if parts[0] == os.pardir else parts
+
+    def directory(self, path: str) -> typing.Union[dict, None]:
+        parts = self._parts(path)
+        node = self.tree if parts is not None else None
+        for part in parts or []:
+            node = node.get(part)
+            if not isinstance(node, dict):
+                return None
+
+        return node
+
+    def __contains__(self, path: str) -> bool:
+        directory = self.directory(os.path.dirname(path))
+        return directory is not None and os.path.basename(path) in directory and directory[os.path.basename(path)] is None
+
+    def is_package(self, path: str) -> bool:
+        directory = self.directory(path)
+        return directory is not None and '__init__.py' in directory and directory['__init__.py'] is None
+
+    def walk(self, skip: typing.Union[typing.Callable, None]=None):
+        # (absolute directory, subdirectory names, file names) for every directory, like os.walk, leaving out the
+        # directories that skip returns True for
+        stack = [(self.root, self.tree)]
+        while stack:
+            dirpath, node = stack.pop()
+            if skip is not None and skip(dirpath):
+                continue
+
+            dirnames = [name for name, child in node.items() if child is not None]
+            yield dirpath, dirnames, [name for name, child in node.items() if child is None]
+            stack.extend((os.path.join(dirpath, name), node[name]) for name in reversed(dirnames))
+
+    def files(self, extension: str, skip: typing.Union[typing.Callable, None]=None) -> ListOfString:
+        return [os.path.join(dirpath, f) for dirpath, _, files in self.walk(skip) for f in files if os.path.splitext(f)[-1] == extension]
+
+    def packages(self) -> ListOfString:
+        return [dirpath for dirpath, _, files in self.walk() if '__init__.py' in files]
+
+    def module_name(self, path: str) -> StrOrNone:
+        # the dotted name of the module at path, or None if it isn't in the tree or its root is a package itself, in
+        # which case the name depends on what is above it
+        parts = self._parts(path)
+        if parts is None or path not in self:
+            return None
+
+        names = [os.path.splitext(parts[-1])[0]]
+        nodes = [self.tree]
+        for part in parts[:-1]:
+            nodes.append(nodes[-1][part])
+
+        for i in range(len(parts) - 1, -1, -1):
+            if '__init__.py' not in nodes[i]:
+                return ".".join(names)
+
+            if i == 0:
+                return None
+
+            names.insert(0, parts[i - 1])
+
+
+class SourceFilter(object):
+    # The --ignore-source entries, normalised once.  Paths are kept in a sorted index of directory prefixes that is
+    # searched by bisection, and entries with glob characters are matched with fnmatch: against the file name when they
+    # have no separator (like *_pb2.py), and against the whole path otherwise.  Relative entries are taken relative to
+    # the current directory, like pytest's --ignore.
+    def __init__(self, entries: typing.Iterable):
+        prefixes = set()
+        self.path_globs = []
+        self.name_globs = []
+
+        for entry in entries:
+            if not isinstance(entry, str) or not entry:  # --ignore-source given without a path
+                continue
+
+            if GLOB_CHARACTERS.search(entry):
+                if os.sep in entry or (os.altsep and os.altsep in entry):
+                    self.path_globs.append(os.path.normpath(os.path.abspath(entry)))
+
+                else:
+                    self.name_globs.append(entry)
+
+            else:
+                prefixes.add(os.path.normpath(os.path.abspath(entry)))
+
+        # with a trailing separator, a path under a prefix sorts right after it, unless a nested prefix sorts in between,
+        # so nested prefixes are dropped
+        self.prefixes = []
+        for prefix in sorted(p.rstrip(os.sep) + os.sep for p in prefixes):
+            if not self.prefixes or not prefix.startswith(self.prefixes[-1]):
+                self.prefixes.append(prefix)
+
+        self.entries = [p.rstrip(os.sep) or os.sep for p in self.prefixes] + self.path_globs + self.name_globs
+
+    def __bool__(self) -> bool:
+        return bool(self.entries)
+
+    def matches_prefix(self, path: str) -> bool:
+        path = path.rstrip(os.sep) + os.sep
+        i = bisect.bisect_right(self.prefixes, path) - 1
+        return i >= 0 and path.startswith(self.prefixes[i])
+
+    def matches(self, path: str) -> bool:
+        if self.matches_prefix(path):
+            return True
+
+        name = os.path.basename(path)
+        return any(fnmatch.fnmatchcase(name, g) for g in self.name_globs) or any(fnmatch.fnmatchcase(path, g) for g in self.path_globs)
+
+    def pathspecs(self, repo_path: str) -> ListOfString:
+        # git pathspecs that exclude the ignored paths under repo_path, for commands run from there.  git's * doesn't
+        # match a /, so the pathspecs never exclude more than matches does.  They need a pathspec that includes something
+        # to go with them.
+        specs = []
+        for prefix in self.prefixes:
+            relpath = os.path.relpath(prefix, repo_path)
+            if relpath.split(os.sep)[0] != os.pardir:
+                specs.append(":(top,exclude,literal)%s" % relpath.replace(os.sep, '/'))
+
+        for path_glob in self.path_globs:
+            relpath = os.path.relpath(path_glob, repo_path)
+            if relpath.split(os.sep)[0] != os.pardir:
+                specs.append(":(top,exclude,glob)%s" % relpath.replace(os.sep, '/'))
+
+        specs.extend(":(top,exclude,glob)**/%s" % name_glob for name_glob in self.name_globs)
+        return specs
+
+
+class SymbolGraph(object):
+    # Project wide graph of (path, object name) nodes, with an edge from each definition to every name it uses or
+    # inherits from, plus the reverse index needed to propagate changes forward to everything that depends on them
+    def __init__(self):
+        self.dependencies = {}
+        self.dependents = {}
+
+    def add(self, node: Node, dependencies: ListOfNode):
+        self.dependencies[node] = dependencies
+        for dependency in dependencies:
+            self.dependents.setdefault(dependency, []).append(node)
+
+    def __contains__(self, node: Node) -> bool:
+        return node in self.dependencies
+
+    def propagate(self, changed: ListOfNode) -> dict:
+        # breadth first search from the changed nodes along the reverse index.  Returns a map from each affected node to
+        # the node it was reached from (None for the changed nodes themselves), from which the chain can be rebuilt.
+        affected = OrderedDict((node, None) for node in changed)
+        queue = deque(affected.keys())
+
+        while queue:
+            node = queue.popleft()
+            for dependent in self.dependents.get(node, []):
+                if dependent not in affected:
+                    affected[dependent] = node
+                    queue.append(dependent)
+
+        return affected
+
+    @staticmethod
+    def chain(affected: dict, node: Node) -> ListOfString:
+        chain = []
+        while node is not None:
+            chain.append("%s::%s" % node)
+            node = affected[node]
+
+        return chain
+
+
+def decode_source(data: bytes) -> (str, int):
+    # Python source encodings are defined by PEP 263 and the BOM, so chardet is only needed for files that don't follow it
+    try:
+        encoding, _ = tokenize.detect_encoding(io.BytesIO(data).readline)
+        contents = data.decode(encoding)
+
+    except (SyntaxError, LookupError, UnicodeDecodeError):
+        encoding_detector = UniversalDetector()
+        encoding_detector.feed(data)
+        encoding_detector.close()
+        contents = data.decode((encoding_detector.result['encoding'] or 'utf-8').lower())
+
+    if '\r' in contents:  # universal newlines, as when reading in text mode
+        contents = contents.replace('\r\n', '\n').replace('\r', '\n')
+
+    linecount = contents.count('\n') + (1 if contents and not contents.endswith('\n') else 0)
+    return contents, linecount
+
+
+def summarise_source(fpath: str, digest: str, data: bytes) -> ModuleSummary:
+    try:
+        contents, linecount = decode_source(data)
+        return ModuleSummary.from_source(fpath, digest, contents, linecount)
+
+    except Exception as e:
+        raise Exception("Couldn't read file '%s' -- %s" % (fpath, str(e)))
+
+
+_worker_summary_caches = {}
+
+
+def summarise_file(args: tuple) -> tuple:
+    # Runs in a worker process when --smart-collect-workers is used.  Only the compact, picklable summary is sent back to
+    # the collector, never the AST.
+    fpath, digest, cache_dir = args
+
+    if cache_dir not in _worker_summary_caches:
+        _worker_summary_caches[cache_dir] = SummaryCache(cache_dir, os.path.dirname(fpath))
+
+    with open(fpath, "rb") as f:
+        data = f.read()
+
+    summary = None
+    if digest is None:  # the collector couldn't look this file up in the cache without hashing it
+        digest = SummaryCache.blob_sha(data)
+        summary = _worker_summary_caches[cache_dir].get(fpath, digest)
+
+    hit = summary is not None
+    if not hit:
+        summary = summarise_source(fpath, digest, data)
+
+    return fpath, digest, summary.to_dict(), hit
+
+
+def find_daemon_directory() -> str:
+    # a socket is only as private as the directory it's in, so the daemon's lives in a directory of the user's own:
+    # the runtime directory where there is one, otherwise one named after the user in the temporary directory
+    runtime_dir = os.environ.get('XDG_RUNTIME_DIR')
+    if runtime_dir and os.path.isdir(runtime_dir):
+        return os.path.join(runtime_dir, "pytest-smartcollect")
+
+    return os.path.join(tempfile.gettempdir(), "pytest-smartcollect-%d" % os.getuid())
+
+
+def find_daemon_socket(git_repo_root: str) -> str:
+    # unix socket paths are limited to about a hundred bytes, so the socket is named after a digest of the repository
+    # it serves rather than living in the repository
+    digest = hashlib.sha1(os.path.realpath(git_repo_root).encode('utf-8')).hexdigest()[:16]
+    return os.path.join(find_daemon_directory(), "%s.sock" % digest)
+
+
+def is_owned_by_user(path: str) -> bool:
+    # without following symlinks, so that a link planted by another user doesn't count as the user's own
+    return os.lstat(path).st_uid == os.getuid()
+
+
+def query_daemon(socket_path: str, request: dict, timeout: float=DAEMON_TIMEOUT) -> dict:
+    # one JSON request and one JSON response, each on a line of its own.  Only daemons run by the same user are trusted.
+    if not is_owned_by_user(socket_path):
+        raise Exception("%s belongs to another user" % socket_path)
+
+    with contextlib.closing(socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)) as sock:
+        sock.settimeout(timeout)
+        sock.connect(socket_path)
+        sock.sendall(json.dumps(request).encode('utf-8') + b"\n")
+        with sock.makefile("rb") as f:
+            response = json.loads(f.readline().decode('utf-8') or 'null')
+
+    if not isinstance(response, dict):
+        raise Exception("The smart collection daemon closed the connection without answering")
+
+    if 'error' in response:
+        raise Exception(response['error'])
+
+    return response
+
+
+class Selection(object):
+    # The changes between the commits being compared, and what they affect, as needed to decide on each test
+    def __init__(self, changed_files: DictOfChangedFile, graph: SymbolGraph, affected: dict):
+        self.changed_files = changed_files
+        self.graph = graph
+        self.affected = affected
+        self.recorded = set()  # tests in the test impact database
+        self.impacted = set()  # recorded tests that executed changed lines
+        self.recorded_affected = affected  # what the changes the test impact database can't account for affect
+        self.fixture_verdicts = {}  # (fixture definition node, recorded) -> whether it is affected, shared by every test
+
+    @staticmethod
+    def _affected_to_list(affected: dict) -> list:
+        return [list(node) + (list(parent) if parent is not None else [None, None]) for node, parent in affected.items()]
+
+    @staticmethod
+    def _affected_from_list(entries: list) -> dict:
+        return OrderedDict(((path, name), (parent_path, parent_name) if parent_path is not None else None) for path, name, parent_path, parent_name in entries)
+
+    def to_dict(self) -> dict:
+        # only what select_test needs, so that pytest-xdist workers can apply a selection prepared by the controller.
+        # The graph is reduced to its nodes, which is enough to tell whether a node was part of it.
+        nodes = {}
+        for path, name in self.graph.dependencies:
+            nodes.setdefault(path, []).append(name)
+
+        return {
+            'changed_files': {path: ch.change_type for path, ch in self.changed_files.items()},
+            'nodes': nodes,
+            'affected': self._affected_to_list(self.affected),
+            'recorded': sorted(self.recorded),
+            'impacted': sorted(self.impacted),
+            'recorded_affected': None if self.recorded_affected is self.affected else self._affected_to_list(self.recorded_affected)
+        }
+
+    @classmethod
+    def from_dict(cls, d: dict):
+        graph = SymbolGraph()
+        for path, names in d['nodes'].items():
+            for name in names:
+                graph.dependencies[(path, name)] = []
+
+        selection = cls(
+            {path: ChangedFile(change_type, path) for path, change_type in d['changed_files'].items()},
+            graph,
+            cls._affected_from_list(d['affected'])
+        )
+        selection.recorded = set(d['recorded'])
+        selection.impacted = set(d['impacted'])
+        if d['recorded_affected'] is not None:
+            selection.recorded_affected = cls._affected_from_list(d['recorded_affected'])
+
+        return selection
+
+
 class SmartCollector(object):
-    def __init__(self, rootdir: str, lastfailed: ListOfString, ignore_source: ListOfString, commit_range: int, diff_current_head_with_branch: str, allow_preemptive_failures: bool, logger: logging.Logger):
+    def __init__(self, rootdir: str, lastfailed: ListOfString, ignore_source: ListOfString, commit_range: int, diff_current_head_with_branch: str, allow_preemptive_failures: bool, logger: logging.Logger, cache_dir: StrOrNone=None, cache_max_size: int=DEFAULT_CACHE_MAX_SIZE, cache_max_age: int=DEFAULT_CACHE_MAX_AGE, workers: int=0, deselect: bool=False, report: StrOrNone=None, cached_selection: typing.Union[dict, None]=None, use_daemon: bool=False, shared_selection: typing.Union[Selection, None]=None, untracked: bool=True, source_roots: ListOrNone=None):
         self.rootdir = rootdir
         self.lastfailed = lastfailed
         self.ignore_source = ignore_source
+        self.source_filter = SourceFilter(ignore_source or [])
         self.commit_range = commit_range
         self.diff_current_head_with_branch = diff_current_head_with_branch
         self.allow_preemptive_failures = allow_preemptive_failures
         self.logger = logger
+        self.cache_dir = cache_dir
+        self.cache_max_size = cache_max_size
+        self.cache_max_age = cache_max_age
+        self.workers = workers
+        self.deselect = deselect
+        self.report = report
+        self.cached_selection = cached_selection  # the fingerprint and decisions of the last run, updated by run()
+        self.use_daemon = use_daemon and DAEMON_SUPPORTED
+        self.shared_selection = shared_selection  # prepared by the pytest-xdist controller, when this is one of its workers
+        self.untracked = untracked  # whether files that aren't tracked by git, nor ignored, are part of the project
+        # in monorepo mode, only the rootdir and the declared source roots (relative to it) are analysed
+        self.scope = None
+        if source_roots is not None:
+            self.scope = list(OrderedDict.fromkeys(os.path.normpath(os.path.join(rootdir, r)) for r in [rootdir] + list(source_roots)))
         self.packages = []
-        self.encoding_detector = UniversalDetector()
+        self.summaries = {}
+        self._summary_cache = None
+        self._git_repo_root = None
+        self._imported_names = {}
+        self._exported_names = {}
+        self._repo_files = {}
+        self._resolver = None
+        self._commit_range = None
+        self._changed_modules = None
+        self._deleted_modules = None
+        self._class_hierarchies = {}
+        self.graph = None
+        self.stats = CollectionStats()
+
+    @property
+    def resolver(self) -> ModuleResolver:
+        if self._resolver is None:
+            self._resolver = ModuleResolver([self.git_repo_root] + (self.scope or []) + self.packages + [os.path.dirname(p) for p in self.packages] + sys.path)
+
+        return self._resolver
+
+    @property
+    def git_repo_root(self) -> str:
+        if self._git_repo_root is None:
+            self._git_repo_root = self.find_git_repo_root(self.rootdir)
+
+        return self._git_repo_root
+
+    @property
+    def impact_db_path(self) -> StrOrNone:
+        return os.path.join(self.cache_dir, IMPACT_DB_NAME) if self.cache_dir else None
+
+    @property
+    def summary_cache(self) -> SummaryCache:
+        if self._summary_cache is None:
+            index_name = "index.json"
+            if self.scope is not None:
+                scope = sorted(os.path.relpath(root, self.git_repo_root).replace(os.sep, '/') for root in self.scope)
+                index_name = "index-%s.json" % hashlib.sha1(json.dumps(scope).encode('utf-8')).hexdigest()[:12]
+
+            self._summary_cache = SummaryCache(
+                self.cache_dir,
+                self.git_repo_root,
+                max_size=self.cache_max_size,
+                max_age=self.cache_max_age,
+                index_name=index_name
+            )
+
+        return self._summary_cache
+
+    def get_summary(self, fpath: str) -> ModuleSummary:
+        if fpath not in self.summaries:
+            self.prefetch_summaries([fpath])
+
+        return self.summaries[fpath]
+
+    def prefetch_summaries(self, paths: ListOfString):
+        # loads the summaries of all of paths, parsing the ones that aren't cached in parallel if workers were requested
+        summary_cache = self.summary_cache
+        pending = []
+
+        for fpath in paths:
+            if fpath in self.summaries:
+                continue
 
-    def read_file(self, fpath):
-        self.encoding_detector.reset()
+            digest = summary_cache.lookup_digest(fpath)
+            if digest is not None:
+                summary = summary_cache.get(fpath, digest)
+                if summary is not None:
+                    self.summaries[fpath] = summary
+                    continue
 
-        f = open(fpath, "rb")
-        for line in f.readlines():
-            self.encoding_detector.feed(line)
-            if self.encoding_detector.done:
-                break
-        f.close()
+            pending.append((fpath, digest, summary_cache.cache_dir))
 
-        if self.encoding_detector.result['encoding'] is None:
-            enc = 'utf-8'
+        self.stats.count("files read", len(pending))
+        if self.workers > 1 and len(pending) > 1:
+            with ProcessPoolExecutor(max_workers=self.workers) as executor:
+                chunksize = max(1, len(pending) // (self.workers * 4))
+                results = list(executor.map(summarise_file, pending, chunksize=chunksize))
 
         else:
-            enc = self.encoding_detector.result['encoding'].lower()
+            results = [self._summarise_file(fpath, digest) for fpath, digest, _ in pending]
 
-        with open(fpath, encoding=enc) as f:
-            lines = f.readlines()
+        for fpath, digest, summary, hit in results:
+            if not isinstance(summary, ModuleSummary):
+                summary = ModuleSummary.from_dict(fpath, digest, summary)
 
-        contents = ''.join(lines)
-        linecount = len(lines)
+            summary_cache.record_digest(fpath, digest)
+            if hit:
+                summary_cache.hits += 1
 
-        try:
-            ast.parse(contents)
+            else:
+                summary_cache.misses += 1
+                summary_cache.put(summary)
+                self.stats.count("asts parsed")
 
-        except Exception as e:
-            raise Exception("Couldn't read file '%s' -- %s" % (fpath, str(e)))
+            self.summaries[fpath] = summary
+
+    def _summarise_file(self, fpath: str, digest: StrOrNone) -> tuple:
+        # the file is read once, and the same buffer is hashed, decoded and parsed
+        with open(fpath, "rb") as f:
+            data = f.read()
+
+        summary = None
+        if digest is None:
+            digest = self.summary_cache.blob_sha(data)
+            summary = self.summary_cache.get(fpath, digest, count=False)
 
-        return contents, linecount
+        hit = summary is not None
+        if not hit:
+            summary = summarise_source(fpath, digest, data)
+
+        return fpath, digest, summary, hit
 
     def find_git_repo_root(self, dir: str) -> str:
         if ".git" in os.listdir(dir):
@@ -162,32 +1617,76 @@ class SmartCollector(object):
             else:
                 return self.find_git_repo_root(os.path.dirname(dir))
 
-    @staticmethod
-    def find_packages(dir: str) -> ListOfString:
-        packages = []
-        is_valid_package = lambda x: True if os.path.isdir(x) and '__init__.py' in os.listdir(x) else False
+    def find_repo_files(self, repo_path: str) -> PathTrie:
+        # a single git ls-files lists the tree, rather than walking it, so virtualenvs, build output and anything else git
+        # ignores are never visited.  Tracked files deleted from the working tree are left out.
+        if repo_path in self._repo_files:
+            return self._repo_files[repo_path]
 
-        for root, _, _ in os.walk(dir):
-            abs_root = os.path.abspath(root)
+        args = ["git", "ls-files", "-z", "-t", "--cached", "--deleted"]
+        if self.untracked:
+            args += ["--others", "--exclude-standard"]
 
-            if is_valid_package(abs_root):
-                packages.append(abs_root)
+        args += self.find_pathspecs(repo_path, exclude_ignored=False)
 
-        return packages
+        proc = subprocess.Popen(args, cwd=repo_path, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        stdout, stderr = proc.communicate()
+        if proc.returncode != 0:
+            raise Exception("git ls-files failed -- %s" % stderr.decode('utf-8', 'replace').strip())
+
+        listed = []
+        deleted = set()
+        for entry in stdout.split(b'\0'):
+            if not entry:
+                continue
+
+            tag, relpath = entry[:1], os.fsdecode(entry[2:])
+            if tag == b'R':
+                deleted.add(relpath)
+
+            else:
+                listed.append(relpath)
+
+        repo_files = self._repo_files[repo_path] = PathTrie(os.path.abspath(repo_path), (p for p in listed if p not in deleted))
+        return repo_files
+
+    def find_pathspecs(self, repo_path: str, exclude_ignored: bool=True) -> ListOfString:
+        # git pathspecs for the part of the repository that is analysed, for commands run from repo_path
+        includes = []
+        for root in self.scope or []:
+            relpath = os.path.relpath(root, repo_path)
+            if relpath == os.curdir:
+                includes.append(":/")
+
+            elif relpath.split(os.sep)[0] != os.pardir:
+                includes.append(":(top,literal)%s" % relpath.replace(os.sep, '/'))
+
+        excludes = self.source_filter.pathspecs(repo_path) if exclude_ignored else []
+        if not includes and not excludes:
+            return []
+
+        return ["--"] + (includes or ["."]) + excludes
+
+    def find_packages(self, dir: str) -> ListOfString:
+        return self.find_repo_files(dir).packages()
+
+    def find_project_files(self, repo_path: str) -> ListOfString:
+        return self.find_repo_files(repo_path).files(".py")
 
     def find_all_files(self, repo_path: str) -> DictOfChangedFile:
         all_files = {}
-        for root, _, files in os.walk(repo_path):
-            for f in files:
-                fpath = os.path.join(root, f)
-                if os.path.splitext(f)[-1] == ".py" and not self.should_ignore_source_file(fpath):
-                    contents, linecount = self.read_file(fpath)
-                    all_files[fpath] = ChangedFile(
-                        change_type='A',
-                        old_filepath=None,
-                        current_filepath=fpath,
-                        changed_lines=[range(1, linecount)]
-                    )
+        project_files = self.find_repo_files(repo_path).files(".py", skip=self.source_filter.matches_prefix)
+        project_files = [f for f in project_files if not self.should_ignore_source_file(f)]
+        self.prefetch_summaries(project_files)
+
+        for fpath in project_files:
+            linecount = self.get_summary(fpath).linecount
+            all_files[fpath] = ChangedFile(
+                change_type='A',
+                old_filepath=None,
+                current_filepath=fpath,
+                changed_lines=[range(1, linecount + 1)]
+            )
 
         return all_files
 
@@ -200,143 +1699,257 @@ class SmartCollector(object):
             'T': {}
         }
 
-        current_head = repo.head.commit
-        previous_commits = repo.commit("%s~%d" % (self.diff_current_head_with_branch, self.commit_range))
-        diffs = previous_commits.diff(current_head)
-        diffs_with_patch = previous_commits.diff(current_head, create_patch=True)
+        commits = self.find_commit_range(repo_path)
 
-        for idx, d in enumerate(diffs):
-            diff_text = diffs_with_patch[idx].diff.decode('utf-8').replace('\r', '')
-            if re.match('^Binary files.*', diff_text) or len(diff_text) == 0:  # TODO: figure out if there are any other special cases where the diff information is non-standard
-                continue
-            diff_lines_spec = diff_text.split('\n')[0].split('@@')[1].strip().replace('+', '').replace('-', '')
+        # ignored paths, and paths outside of the scope of a monorepo, are left out of the diff itself, so they are never
+        # diffed, decoded or read
+        diff = self.read_diff(repo_path, commits.base, commits.head, self.find_pathspecs(repo_path))
+        for change_type, a_path, b_path, hunks in diff:
             changed_lines = None
+            removed_lines = None
+            base_lines = None
             old_filepath = None
 
-            if d.change_type == 'A':  # added paths
-                filepath = os.path.join(repo_path, d.a_path)
-                if os.path.splitext(filepath)[-1] != '.py':
-                    continue
-
-                _, linecount = self.read_file(filepath)
-                changed_lines = [range(1, linecount)]
-
-            elif d.change_type == 'M':  # modified paths
-                filepath = os.path.join(repo_path, d.a_path)
-                if os.path.splitext(filepath)[-1] != '.py':
-                    continue
-                ranges = diff_lines_spec.split(' ')
-                if len(ranges) < 2:
-                    start, count = ranges[0].split(',')
-                    changed_lines = [range(start, start + count)]
+            if change_type == 'A':  # added paths
+                filepath = os.path.join(repo_path, *b_path.split('/'))
+                changed_lines = [range(new_start, new_start + new_count) for _, _, new_start, new_count in hunks]
 
-                else:
-                    preimage = [int(x) for x in ranges[0].split(',')]
-                    preimage_start = preimage[0]
-                    if len(preimage) > 1:
-                        preimage_count = preimage[1]
-                    else:
-                        preimage_count = 0
+            elif change_type == 'M':  # modified paths
+                filepath = os.path.join(repo_path, *b_path.split('/'))
+                changed_lines = []
+                removed_lines = []
+                base_lines = []
+                for old_start, old_count, new_start, new_count in hunks:
+                    if new_count > 0:
+                        changed_lines.append(range(new_start, new_start + new_count))
 
-                    postimage = [int(x) for x in ranges[1].split(',')]
-                    postimage_start = postimage[0]
-                    if len(postimage) > 1:
-                        postimage_count = postimage[1]
+                    else:  # lines were only removed, after line new_start of the current file
+                        changed_lines.append(range(max(new_start, 1), new_start + 2))
 
-                    else:
-                        postimage_count = 0
+                    if old_count > 0:
+                        removed_lines.append(range(old_start, old_start + old_count))
+                        base_lines.append(range(old_start, old_start + old_count))
 
-                    changed_lines = [
-                        range(preimage_start, preimage_start + preimage_count),
-                        range(postimage_start, postimage_start + postimage_count)
-                    ]
+                    else:  # lines were only added, after line old_start of the old file
+                        base_lines.append(range(max(old_start, 1), old_start + 2))
 
-            elif d.change_type == 'D':  # deleted paths
-                filepath = os.path.join(repo_path, d.a_path)
-                if os.path.splitext(filepath)[-1] != '.py':
-                    continue
+            elif change_type == 'D':  # deleted paths
+                filepath = os.path.join(repo_path, *a_path.split('/'))
+                base_lines = [WHOLE_FILE]
 
-            elif d.change_type == 'R':  # renamed paths
-                filepath = os.path.join(repo_path, d.b_path)
+            elif change_type in ('R', 'T'):  # renamed paths and changed file types
+                filepath = os.path.join(repo_path, *b_path.split('/'))
                 if os.path.splitext(filepath)[-1] != '.py':
                     continue
-                old_filepath = os.path.join(repo_path, d.a_path)
-                _, linecount = self.read_file(filepath)
-                changed_lines = [range(1, linecount)]
 
-            elif d.change_type == 'T':  # changed file types
-                filepath = os.path.join(repo_path, d.b_rawpath)
-                if os.path.splitext(filepath)[-1] != '.py':
-                    continue
-                old_filepath = os.path.join(repo_path, d.a_path)
-                _, linecount = self.read_file(filepath)
-                changed_lines = [range(1, linecount)]
+                old_filepath = os.path.join(repo_path, *a_path.split('/'))
+                linecount = self.get_summary(filepath).linecount
+                changed_lines = [range(1, linecount + 1)]
+                base_lines = [WHOLE_FILE]
 
             else:  # something is seriously wrong...
-                raise Exception("Unknown change type '%s'" % d.change_type)
+                raise Exception("Unknown change type '%s'" % change_type)
 
             # we only care about python files here
             if os.path.splitext(filepath)[-1] == ".py":
-                if os.sep == "\\":
-                    filepath = filepath.replace('/', os.sep)
-
-                    if old_filepath is not None:
-                        old_filepath = old_filepath.replace('/', os.sep)
-
-                changed_files[d.change_type][filepath] = ChangedFile(
-                    d.change_type,
+                changed_files[change_type][filepath] = ChangedFile(
+                    change_type,
                     filepath,
                     old_filepath=old_filepath,
-                    changed_lines=changed_lines
+                    changed_lines=changed_lines,
+                    removed_lines=removed_lines,
+                    base_lines=base_lines
                 )
 
         return changed_files['A'], changed_files['M'], changed_files['D'], changed_files['R'], changed_files['T']
 
-    def should_ignore_source_file(self, source_file: str) -> bool:
-        if self.ignore_source is not None:
-            for ign in self.ignore_source:
-                if os.path.commonpath([source_file, ign]) == ign:
-                    return True
+    def find_changed_modules(self, repo: Repo, repo_path: str) -> DictOfChangedFile:
+        # all added, modified, renamed and (to python) changed file type modules that aren't ignored
+        if self._changed_modules is not None:
+            return self._changed_modules
+
+        if self.find_commit_range(repo_path).diff_everything():
+            added_files = self.find_all_files(repo_path)
+            modified_files = {}
+            deleted_files = {}
+            renamed_files = {}
+            changed_filetype_files = {}
+
+        else:  # inspect the diff
+            added_files, modified_files, deleted_files, renamed_files, changed_filetype_files = self.find_changed_files(repo, repo_path)
+
+        changed_to_py = {}
+        for changed_filetype in changed_filetype_files.values():
+            if os.path.splitext(changed_filetype.current_filepath)[-1] == ".py":
+                changed_to_py[changed_filetype.current_filepath] = changed_filetype
+
+        changed_files = {}
+        changed_files.update(changed_to_py)
+        changed_files.update(modified_files)
+        changed_files.update(renamed_files)
+        changed_files.update(added_files)
+
+        # ignore anything explicitly set in --ignore-source flags
+        self._changed_modules = {k: v for k, v in changed_files.items() if not self.should_ignore_source_file(k)}
+        self._deleted_modules = {k: v for k, v in deleted_files.items() if not self.should_ignore_source_file(k)}
+        return self._changed_modules
+
+    def find_selection_fingerprint(self) -> str:
+        # a digest of everything the selection depends on besides the last failed tests: the commits being compared, the
+        # options, the uncommitted python files and the test impact database
+        git_repo_root = self.git_repo_root
+        commits = self.find_commit_range(git_repo_root)
+
+        dirty = []
+        entries = iter(commits.git("status", "--porcelain", "-z", "--untracked-files=all").split('\0'))
+        for entry in entries:
+            if entry[:1] in ('R', 'C'):  # renames and copies are followed by the path they came from
+                next(entries, None)
+
+            path = entry[3:]
+            if os.path.splitext(path)[-1] != '.py':
+                continue
 
-        return False
+            try:
+                st = os.stat(os.path.join(git_repo_root, path))
+                dirty.append((path, st.st_mtime_ns, st.st_size))
+
+            except OSError:  # deleted
+                dirty.append((path, None, None))
+
+        impact_db = None
+        if self.impact_db_path and os.path.isfile(self.impact_db_path):
+            st = os.stat(self.impact_db_path)
+            impact_db = (st.st_mtime_ns, st.st_size)
+
+        return hashlib.sha1(json.dumps([
+            __version__,
+            SUMMARY_FORMAT_VERSION,
+            self.rootdir,
+            commits.head,
+            commits.base,
+            self.commit_range,
+            self.diff_current_head_with_branch,
+            self.untracked,
+            self.source_filter.entries,
+            self.scope,
+            sorted(dirty),
+            impact_db
+        ]).encode('utf-8')).hexdigest()
+
+    def find_commit_range(self, repo_path: str) -> CommitRange:
+        if self._commit_range is None or self._commit_range.repo_path != repo_path:
+            self._commit_range = CommitRange(repo_path, self.diff_current_head_with_branch, self.commit_range)
+
+        return self._commit_range
+
+    @staticmethod
+    def read_diff(repo_path: str, base: str, head: str, pathspecs: ListOrNone=None) -> typing.List[tuple]:
+        # a single git diff that lists every changed path along with every hunk of its patch
+        args = [
+            "git", "-c", "core.quotepath=off", "diff", "--no-color", "--no-ext-diff", "-M",
+            "--src-prefix=a/", "--dst-prefix=b/", "-U0", "-z", "--raw", "-p", base, head
+        ] + (pathspecs or [])
+        proc = subprocess.Popen(args, cwd=repo_path, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+
+        try:
+            diff = GitDiffReader(proc.stdout).read()
+
+        finally:
+            proc.stdout.close()
+            stderr = proc.stderr.read()
+            proc.stderr.close()
+
+        if proc.wait() != 0:
+            raise Exception("git diff failed -- %s" % stderr.decode('utf-8', 'replace').strip())
+
+        return diff
+
+    def should_ignore_source_file(self, source_file: str) -> bool:
+        return self.source_filter.matches(source_file)
 
     def find_changed_members(self, changed_module: ChangedFile, repo_path: str) -> ListOfString:
         # find all changed members of changed_module
         changed_members = []
-        name_extractor = ObjectNameExtractor()
+        summary = self.get_summary(os.path.join(repo_path, changed_module.current_filepath))
 
-        contents, total_lines = self.read_file(os.path.join(repo_path, changed_module.current_filepath))
-        module_ast = ast.parse(contents)
-        direct_children = list(ast.iter_child_nodes(module_ast))
-
-        # get a set of all changed lines in changed_module
-        changed_lines = set()
-        for ch in changed_module.changed_lines:
-            changed_lines.update(set(ch))
+        changed_lines = LineIntervals(changed_module.changed_lines)
 
         # the direct children of the module correspond to the imported names in test files
-        for idx, node in enumerate(direct_children):
-            if isinstance(node, ast.Assign) or isinstance(node, ast.FunctionDef) or isinstance(node, ast.ClassDef):
-                try:
-                    r = range(node.lineno, direct_children[idx + 1].lineno)
+        for names, start, end in summary.members:
+            if not changed_lines.overlaps(start, end):
+                continue
 
-                except IndexError:
-                    r = range(node.lineno, total_lines)
+            parts = summary.member_parts.get(names[0]) if len(names) == 1 else None
+            if not parts:
+                changed_members.extend(names)
+                continue
 
-                if set(changed_lines).intersection(set(r)):
-                    if isinstance(node, ast.Assign):
-                        changed_members.extend(name_extractor.extract(node))
+            # classes are split into their methods (Class.method) and the rest of the class body (Class)
+            for part_name, part_start, part_end, _ in parts:
+                if part_name not in changed_members and changed_lines.overlaps(part_start, part_end):
+                    changed_members.append(part_name)
 
-                    elif isinstance(node, ast.FunctionDef):
-                        changed_members.append(node.name)
+        # removed lines can take whole members with them, which only the old version of the file still shows
+        base_summary = self.find_base_summary(changed_module, repo_path) if changed_module.removed_lines else None
+        if base_summary is not None:
+            removed_lines = LineIntervals(changed_module.removed_lines)
+            current_parts = set(part[0] for parts in summary.member_parts.values() for part in parts)
 
-                    else:
-                        changed_members.append(node.name)
+            for names, start, end in base_summary.members:
+                if not removed_lines.overlaps(start, end):
+                    continue
+
+                parts = base_summary.member_parts.get(names[0]) if len(names) == 1 else None
+                if not parts:
+                    changed_members.extend(name for name in names if name not in changed_members)
+                    continue
+
+                for part_name, part_start, part_end, _ in parts:
+                    if not removed_lines.overlaps(part_start, part_end):
+                        continue
+
+                    # calls to a method that no longer exists can't be followed to it, so its class counts as changed
+                    if part_name not in current_parts:
+                        part_name = names[0]
+
+                    if part_name not in changed_members:
+                        changed_members.append(part_name)
 
         return changed_members
 
-    @staticmethod
-    def find_fully_qualified_module_name(path: str) -> str:
+    def find_base_summary(self, changed_module: ChangedFile, repo_path: str) -> typing.Union[ModuleSummary, None]:
+        # the summary of the file as it was in the base commit, or None if it can't be read
+        fpath = changed_module.old_filepath or changed_module.current_filepath
+        relpath = os.path.relpath(fpath, repo_path).replace(os.sep, '/')
+        try:
+            data = subprocess.check_output(
+                ["git", "cat-file", "blob", "%s:%s" % (self.find_commit_range(repo_path).base, relpath)], cwd=repo_path, stderr=subprocess.DEVNULL
+            )
+
+        except (OSError, subprocess.CalledProcessError):
+            return None
+
+        digest = self.summary_cache.blob_sha(data)
+        summary = self.summary_cache.get(fpath, digest, count=False)
+        if summary is None:
+            try:
+                summary = summarise_source(fpath, digest, data)
+
+            except Exception:
+                return None
+
+            self.summary_cache.put(summary)
+
+        return summary
+
+    def find_fully_qualified_module_name(self, path: str) -> str:
+        # answered from the files listed by git when the tree has been listed already
+        for repo_files in self._repo_files.values():
+            name = repo_files.module_name(path)
+            if name is not None:
+                return name
+
         parts = [os.path.splitext(os.path.basename(path))[0]]
 
         while "__init__.py" in os.listdir(os.path.dirname(path)):
@@ -352,305 +1965,673 @@ class SmartCollector(object):
 
         return True
 
-    def dependencies_changed(self, path: str, object_name: str, change_map: DictOfListOfString, chain: ListOfString) -> bool:
-        git_repo_root = self.find_git_repo_root(self.rootdir)
+    def in_scope(self, path: str) -> bool:
+        # whether path is part of the project: anywhere in the repository, or under one of the roots in monorepo mode.
+        # Anything else is treated like third party code.
+        if self.scope is None:
+            return self.file_in_project(self.git_repo_root, path)
 
-        if path in change_map.keys() and object_name in change_map[path]: # if we've seen this file before and already know it to be changed, just return True
-            chain.insert(0, "%s::%s" % (path, object_name))
-            return True
+        return any(self.file_in_project(root, path) for root in self.scope)
 
-        if not self.file_in_project(git_repo_root, path):  # if the file is outside of the project, don't bother checking it or any of its dependencies
-            return False
+    def find_imported_names(self, path: str) -> DictOfListOfNode:
+        # map each name imported by the module at path to the (file, name) pairs in the project it could refer to
+        if path in self._imported_names:
+            return self._imported_names[path]
 
-        # otherwise, recursively check the dependencies of this file for other known changes
-        contents, _ = self.read_file(path)
-        module_ast = ast.parse(contents)
+        summary = self.get_summary(path)
+        imported_names_and_modules = {}
 
-        # find locally changed members
-        locally_changed = []
-        if path in change_map.keys():
-            locally_changed = change_map[path]
+        for (module_name, imported_names, import_level) in summary.imports:
+            module_file = self.resolver.resolve_import(path, module_name, import_level)
 
-        # find the object of interest in the ast
-        obj = None
-        definition_extractor = DefinitionNodeExtractor()
-        definition_nodes = definition_extractor.extract(module_ast)
+            if module_file is None or not self.in_scope(module_file):  # builtin, third party and unresolvable modules aren't relevant
+                continue
 
-        for child in definition_nodes:
-            if child.name == object_name:
-                obj = child
-                break
+            if len(imported_names) == 0:
+                imported_names = [(n, None) for n in self.find_exported_names(module_file, False)]
 
-            else:
-                continue
+            elif ('*', None) in imported_names:
+                imported_names = [(n, None) for n in self.find_exported_names(module_file, True)]
 
-        if obj is None:  # if the object wasn't a definition and is unchanged, assume that there are no further dependencies in the chain
-            return False
+            for imported_name, alias in imported_names:
+                module_paths = imported_names_and_modules.setdefault(alias or imported_name, [])
+                for node in [(module_file, imported_name)] + self.find_defining_files(module_file, imported_name):
+                    if node not in module_paths and self.in_scope(node[0]):
+                        module_paths.append(node)
 
-        # extract imports
-        imported_names_and_modules = {}
-        imne = ImportModuleNameExtractor()
-        extracted_imports = imne.extract(module_ast)
+        self._imported_names[path] = imported_names_and_modules
+        return imported_names_and_modules
 
-        for (module_name, imported_names, import_level) in extracted_imports:
-            if module_name in sys.builtin_module_names: # we can safely assume that builtin module changes aren't relevant
-                continue
+    def find_exported_names(self, module_file: str, star: bool, seen: typing.Union[set, None]=None) -> ListOfString:
+        # the names that 'from module import *' (star=True) or dir(module) (star=False) would produce
+        key = (module_file, star)
+        if key in self._exported_names:
+            return self._exported_names[key]
 
-            if module_name is None:  # here we need to find the fully qualified module name for a package relative import
-                assert import_level > 0
-                module_name = self.find_fully_qualified_module_name(os.path.dirname(path))
+        if seen is None:
+            seen = set()
 
-            else:
-                if import_level > 0: # another package relative import situation
-                    module_name = [module_name]
-                    src_path = path
-                    while import_level > 0:
-                        src_path = os.path.dirname(src_path)
-                        module_name.insert(0, os.path.basename(src_path))
-                        import_level -= 1
+        seen.add(key)
+        summary = self.get_summary(module_file)
 
-                    module_name = '.'.join(module_name)
+        if star and summary.all_names is not None:
+            names = list(summary.all_names)
 
-            if len(imported_names) == 0 or '*' in imported_names:
-                imp = import_module(module_name)
-                imported_names = dir(imp)
+        else:
+            names = summary.exported_names()
+            for reexported_module, import_level, imported_names in summary.reexports:
+                if ('*', None) not in imported_names:
+                    continue
 
-            i = import_module(module_name)
+                reexported_file = self.resolver.resolve_import(module_file, reexported_module, import_level)
+                if reexported_file is not None and self.in_scope(reexported_file) and (reexported_file, True) not in seen:
+                    names.extend(self.find_exported_names(reexported_file, True, seen))
 
-            for imported_name in imported_names:
-                o = getattr(i, imported_name)
+            if star:
+                names = [n for n in names if not n.startswith('_')]
 
-                if hasattr(o, '__module__') and o.__module__ not in sys.builtin_module_names and o.__module__ is not None:
-                    f = import_module(o.__module__).__file__
+        names = list(OrderedDict.fromkeys(names))
+        self._exported_names[key] = names
+        return names
 
-                else:
-                    f = None
+    def find_defining_files(self, module_file: str, name: str, seen: typing.Union[set, None]=None) -> ListOfNode:
+        # follows re-exports (from x import y as z) statically to find the project files and names that name really refers to
+        if seen is None:
+            seen = set()
 
-                if imported_name in imported_names_and_modules.keys():
-                    if hasattr(i, '__file__') and i.__file__ not in imported_names_and_modules[imported_name] and self.file_in_project(git_repo_root, i.__file__):
-                        imported_names_and_modules[imported_name].append(i.__file__)
+        if (module_file, name) in seen or not self.in_scope(module_file):
+            return []
 
-                    if f is not None and f not in imported_names_and_modules[imported_name] and self.file_in_project(git_repo_root, f):
-                        imported_names_and_modules[imported_name].append(f)
+        seen.add((module_file, name))
+        summary = self.get_summary(module_file)
 
-                else:
-                    if hasattr(i, '__file__') and self.file_in_project(git_repo_root, i.__file__):
-                        imported_names_and_modules[imported_name] = [i.__file__]
-
-                    if f is not None and self.file_in_project(git_repo_root, f):
-                        imported_names_and_modules[imported_name].append(f)
-
-        # check base classes recursively
-        base_class_name_extractor = BaseClassNameExtractor()
-        if isinstance(obj, ast.ClassDef):
-            for base_name in base_class_name_extractor.extract(obj):
-                if base_name in imported_names_and_modules.keys():
-                    base_class_module_paths = imported_names_and_modules[base_name]
-                    for path in base_class_module_paths:
-                        if self.dependencies_changed(path, base_name, change_map, chain):
-                            if path in change_map.keys():
-                                change_map[path].append(base_name)
+        if name in summary.top_level_names:
+            return [(module_file, name)]
 
-                            else:
-                                change_map[path] = [base_name]
+        defining_files = []
+        for reexported_module, import_level, imported_names in summary.reexports:
+            for imported_name, asname in imported_names:
+                if imported_name == '*' or (asname or imported_name) == name:
+                    reexported_file = self.resolver.resolve_import(module_file, reexported_module, import_level)
+                    if reexported_file is None:
+                        continue
+
+                    if imported_name == '*':
+                        if name in self.find_exported_names(reexported_file, True):
+                            defining_files.extend(self.find_defining_files(reexported_file, name, seen))
+
+                        continue
+
+                    found = self.find_defining_files(reexported_file, imported_name, seen)
+                    if not found:  # from package import submodule
+                        submodule_file = self.resolver.resolve_import(module_file, '.'.join(x for x in [reexported_module, imported_name] if x), import_level)
+                        if submodule_file is not None:
+                            found = [(submodule_file, imported_name)]
+
+                    defining_files.extend(found)
+
+        for bound, imported_module in summary.module_imports:
+            if bound == name:
+                imported_file = self.resolver.find_module_file(imported_module)
+                if imported_file is not None:
+                    defining_files.append((imported_file, name))
+
+        if not defining_files and os.path.basename(module_file) == "__init__.py":  # a submodule of a package
+            submodule_file = ModuleResolver.find_module_file_in(os.path.join(os.path.dirname(module_file), name))
+            if submodule_file is not None:
+                defining_files.append((submodule_file, name))
+
+        return list(OrderedDict.fromkeys(defining_files))
 
-                            return True
+    def find_dependencies(self, path: str, object_name: str) -> typing.Union[ListOfNode, None]:
+        # returns the (path, name) pairs that the named object depends on, or None if it isn't defined in path
+        obj = self.get_summary(path).find_definition(object_name)
 
-        # extract call objects from obj
-        object_name_extractor = ObjectNameExtractor()
-        used_names = object_name_extractor.extract(obj)
+        if obj is None:
+            return None
 
-        for name in used_names:
-            if name == object_name:  # to avoid infinite recursion when a class invokes it's own class methods or if a recursive function calls itself
+        imported_names_and_modules = self.find_imported_names(path)
+        dependencies = []
+
+        # base classes come first, so that changes in inheritance are reported in preference to changes in composition
+        names = list(obj.base_names) if obj.kind == 'class' else []
+        if obj.parent:  # methods depend on the rest of their class
+            names.append(obj.parent)
+
+        names.extend(obj.used_names)
+
+        for name in names:
+            if name == object_name:  # a class invoking it's own class methods, or a recursive function calling itself
                 continue
 
-            if name in locally_changed:
-                if path in change_map.keys() and name in change_map[path]:
-                    return True
+            dependencies.extend(imported_names_and_modules.get(name, []))
+
+            dependencies.append((path, name))  # locally defined (or locally changed) names
+
+        # a class is changed by the methods that run without being called by name, and everything else by the methods it
+        # calls as attributes (obj.method(), Class.method()) of the classes it refers to, and the classes they inherit from
+        if obj.used_attributes:
+            classes = OrderedDict()
+            for node in dependencies:
+                classes.update((c, None) for c in self.find_class_hierarchy(node))
+
+            for attribute in obj.used_attributes:
+                for class_path, class_name in classes:
+                    method = "%s.%s" % (class_name, attribute)
+                    if (class_path, method) != (path, obj.qualified_name) and method in self.get_summary(class_path).find_methods(class_name):
+                        dependencies.append((class_path, method))
+
+        if obj.kind == 'class' and obj.toplevel:
+            dependencies.extend((path, method) for method in self.get_summary(path).implicit_methods(obj.name))
+
+        seen = set()
+        return [d for d in dependencies if not (d in seen or seen.add(d))]
+
+    def find_class_hierarchy(self, node: Node) -> ListOfNode:
+        # the top level class that node refers to, followed by the project classes it inherits from, or nothing if node
+        # isn't a class of the project
+        if node not in self._class_hierarchies:
+            hierarchy = []
+            stack = [node]
+            while stack:
+                class_node = stack.pop()
+                class_path, class_name = class_node
+                if class_node in hierarchy or not self.in_scope(class_path) or not os.path.isfile(class_path):
+                    continue
 
-            if name in imported_names_and_modules.keys():
-                for module_path in imported_names_and_modules[name]:
-                    if self.dependencies_changed(module_path, name, change_map, chain):
-                        if module_path in change_map.keys():
-                            change_map[module_path].append(name)
-                        else:
-                            change_map[module_path] = [name]
+                definition = self.get_summary(class_path).find_definition(class_name)
+                if definition is None or definition.kind != 'class' or not definition.toplevel:
+                    continue
 
-                        return True
+                hierarchy.append(class_node)
+                imported_names_and_modules = self.find_imported_names(class_path)
+                for base in reversed(definition.base_names):
+                    stack.append((class_path, base))
+                    stack.extend(reversed(imported_names_and_modules.get(base, [])))
 
-                    else:
-                        continue
+            self._class_hierarchies[node] = hierarchy
+
+        return self._class_hierarchies[node]
+
+    def build_symbol_graph(self, paths: ListOfString) -> SymbolGraph:
+        graph = SymbolGraph()
+        self.prefetch_summaries(paths)
+
+        for path in paths:
+            for definition in self.get_summary(path).definitions:
+                for name in OrderedDict.fromkeys([definition.name, definition.qualified_name]):
+                    node = (path, name)
+                    if node not in graph:  # only the first definition of a name is considered, as in find_dependencies
+                        graph.add(node, self.find_dependencies(path, name))
+
+        return graph
+
+    def find_affected(self, graph: SymbolGraph, change_map: DictOfListOfString) -> dict:
+        changed = [(path, name) for path, names in change_map.items() for name in names]
+        return graph.propagate(changed)
+
+    def is_affected(self, node: Node, graph: SymbolGraph, affected: dict) -> bool:
+        if node in affected:
+            return True
+
+        if node in graph or not self.in_scope(node[0]):
+            return False
+
+        # the node's file wasn't part of the graph, so check its direct dependencies instead
+        dependencies = self.find_dependencies(*node) or []
+        for dependency in dependencies:
+            if dependency in affected:
+                affected[node] = dependency
+                return True
 
         return False
 
-    def run(self, items):
-        log_records = []
-        git_repo_root = self.find_git_repo_root(self.rootdir)
-        self.packages = self.find_packages(git_repo_root)
+    def find_impacted_tests(self, changed_files: DictOfChangedFile, deleted_files: DictOfChangedFile) -> typing.Union[tuple, None]:
+        # look up the tests that executed the changed lines of the diff base in the test impact database.  Returns the
+        # recorded tests, the ones among them that are impacted and the changed files that the database can't account for,
+        # or None if there is no database recorded at the diff base.
+        if not self.impact_db_path or not os.path.isfile(self.impact_db_path):
+            return None
+
+        base = self.find_commit_range(self.git_repo_root).base
+        impact_db = ImpactDatabase(self.impact_db_path)
+        try:
+            if impact_db.commit != base:
+                self.logger.info("The test impact database wasn't recorded at the diff base (%s), so it won't be used" % base)
+                return None
+
+            recorded = impact_db.recorded_tests()
+            impacted = set()
+            unaccounted = set()
+            relpath = self.summary_cache.relpath
+
+            for fpath, changed_file in list(changed_files.items()) + list(deleted_files.items()):
+                if changed_file.base_lines is None:  # added, so nothing could have executed it
+                    unaccounted.add(fpath)
+                    continue
+
+                found = impact_db.find_tests(relpath(changed_file.old_filepath or fpath), changed_file.base_lines)
+                for nodeids in found.values():
+                    impacted.update(nodeids)
+
+                    # lines that no recorded test executed, like module level code run at import time, are left to the
+                    # static analysis
+                    if not nodeids:
+                        unaccounted.add(fpath)
+
+            return recorded, impacted, unaccounted
+
+        finally:
+            impact_db.close()
+
+    def find_test_file_dependencies(self, graph: SymbolGraph, test_file: str) -> ListOfString:
+        # every project file that the definitions in test_file, or in the conftest.py files that apply to it, can reach.
+        # The conftest definitions are included as a whole, since any of their fixtures may be used by the tests.
+        sources = [test_file]
+        directory = os.path.dirname(test_file)
+        while self.file_in_project(self.git_repo_root, directory):
+            conftest = os.path.join(directory, "conftest.py")
+            if os.path.isfile(conftest):
+                sources.append(conftest)
+
+            if os.path.dirname(directory) == directory:
+                break
+
+            directory = os.path.dirname(directory)
+
+        stack = []
+        for source in sources:
+            definitions = self.get_summary(source).definitions
+            stack.extend(set((source, d.name) for d in definitions) | set((source, d.qualified_name) for d in definitions))
 
-        for p in self.packages:
-            sys.path.insert(0, p)
+        seen = set(stack)
+        files = set(sources)
+
+        while stack:
+            node = stack.pop()
+            files.add(node[0])
+            for dependency in graph.dependencies.get(node, []):
+                if dependency not in seen:
+                    seen.add(dependency)
+                    stack.append(dependency)
+
+        return sorted(f for f in files if os.path.isfile(f))
+
+    def build_test_file_index(self, graph: SymbolGraph, test_files: ListOfString, index: typing.Union[dict, None]=None) -> dict:
+        # maps each test file (repo relative) to the digests of the files it depends on, as they were when it was indexed
+        index = dict(index or {})
+        relpath = self.summary_cache.relpath
+
+        for test_file in test_files:
+            index[relpath(test_file)] = {
+                relpath(f): self.get_summary(f).digest for f in self.find_test_file_dependencies(graph, test_file)
+            }
+
+        self.summary_cache.save()
+        return index
+
+    def find_current_digest(self, fpath: str) -> StrOrNone:
+        if not os.path.isfile(fpath):
+            return None
+
+        digest = self.summary_cache.lookup_digest(fpath)
+        if digest is None:
+            with open(fpath, "rb") as f:
+                digest = self.summary_cache.blob_sha(f.read())
+
+            self.summary_cache.record_digest(fpath, digest)
+
+        return digest
+
+    def find_prunable_test_files(self, index: dict) -> set:
+        # test files whose dependencies are all unchanged, both in the diff and since the index was built, so that none of
+        # their tests can be affected and they don't need to be collected at all
+        git_repo_root = self.git_repo_root
+        with self.stats.phase("diff"):
+            changed_files = self.find_changed_modules(Repo(git_repo_root), git_repo_root)
+
+        lastfailed_files = set(os.path.join(self.rootdir, *nodeid.split("::")[0].split('/')) for nodeid in self.lastfailed)
+        prunable = set()
+
+        for test_file, dependencies in index.items():
+            test_file = os.path.join(git_repo_root, *test_file.split('/'))
+            if test_file in lastfailed_files:
+                continue
+
+            for dependency, digest in dependencies.items():
+                dependency = os.path.join(git_repo_root, *dependency.split('/'))
+                if dependency in changed_files or self.find_current_digest(dependency) != digest:
+                    break
+
+            else:
+                prunable.add(test_file)
+
+        self.summary_cache.save()
+        return prunable
+
+    def find_daemon_decisions(self, tests: typing.List[tuple]) -> dict:
+        # asks the smart collection daemon of the repository, if one is running, for the analysis of each of the
+        # (path, test name, node id, fixtures, node name) tests.  Anything short of a full answer leaves the analysis to this process.
+        request = {
+            'version': DAEMON_PROTOCOL_VERSION,
+            'smartcollect': __version__,
+            'rootdir': self.rootdir,
+            'cache_dir': self.cache_dir,
+            'ignore_source': self.source_filter.entries,
+            'commit_range': self.commit_range,
+            'diff_current_head_with_branch': self.diff_current_head_with_branch,
+            'untracked': self.untracked,
+            'source_roots': self.scope,
+            'tests': tests
+        }
 
         try:
-            repo = Repo(git_repo_root)
+            socket_path = find_daemon_socket(self.git_repo_root)
+            if not os.path.exists(socket_path):
+                return {}
 
-            total_commits_on_head = len(list(repo.iter_commits("HEAD")))
+            with self.stats.phase("daemon"):
+                decisions = query_daemon(socket_path, request)['decisions']
 
-            if self.diff_current_head_with_branch == repo.active_branch.name and total_commits_on_head < 2:
-                added_files = self.find_all_files(git_repo_root)
-                modified_files = {}
-                deleted_files = {}
-                renamed_files = {}
-                changed_filetype_files = {}
+        except Exception as e:
+            self.logger.info("Couldn't use the smart collection daemon, analysing in process instead -- %s" % str(e))
+            return {}
 
-            else:  # inspect the diff
-                added_files, modified_files, deleted_files, renamed_files, changed_filetype_files = self.find_changed_files(repo, git_repo_root)
+        self.stats.count("daemon decisions", len(decisions))
+        return {nodeid: tuple(analysis) for nodeid, analysis in decisions.items()}
 
-            changed_to_py = {}
-            for changed_filetype in changed_filetype_files.values():
-                if os.path.splitext(changed_filetype.current_filepath) == ".py":
-                    changed_to_py[changed_filetype.current_filepath] = changed_filetype
+    def prepare_selection(self) -> Selection:
+        # everything about the change that doesn't depend on the individual tests, worked out once for all of them
+        stats = self.stats
+        with stats.phase("repo discovery"):
+            git_repo_root = self.git_repo_root
 
-            changed_files = {}
-            changed_files.update(changed_to_py)
-            changed_files.update(modified_files)
-            changed_files.update(renamed_files)
-            changed_files.update(added_files)
+        with stats.phase("find_packages"):
+            self.packages = self.find_packages(git_repo_root)
 
-            # ignore anything explicitly set in --ignore-source flags
-            changed_files = {k: v for k, v in changed_files.items() if not self.should_ignore_source_file(k)}
+        with stats.phase("diff"):
+            changed_files = self.find_changed_modules(Repo(git_repo_root), git_repo_root)
 
-            # determine all changed members of each of the changed files (if applicable)
+        # determine all changed members of each of the changed files (if applicable)
+        with stats.phase("changed members"):
             changed_members_and_modules = {
                 path: self.find_changed_members(ch, git_repo_root) for path, ch in changed_files.items()
             }
 
-            test_count = 0
-            fixture_map = {}
-            ast_map = {}
+        # propagate the changed members forward through the project's symbol graph, once for all tests
+        with stats.phase("symbol graph"):
+            graph = self.graph = self.build_symbol_graph(self.find_project_files(git_repo_root))
+            affected = self.find_affected(graph, changed_members_and_modules)
 
-            for test in items:
-                test_name = test.name.split('[')[0]  # TODO: figure out a better way to handle test names of parameterized tests
+        selection = Selection(changed_files, graph, affected)
 
-                # if the test is new, run it anyway
-                if str(test.fspath) in changed_files.keys() and changed_files[str(test.fspath)].change_type == 'A':
-                    log_records.append(
-                        ('RUN', test.nodeid, "New test")
-                    )
-                    self.logger.info("Test '%s' is new, so will be run regardless of changes to the code it tests" % test.nodeid)
-                    test_count += 1
-                    continue
+        # tests recorded in the test impact database only need the static analysis for the changes it can't account for
+        with stats.phase("impact database"):
+            impact = self.find_impacted_tests(changed_files, self._deleted_modules)
+            if impact is not None:
+                selection.recorded, selection.impacted, unaccounted = impact
+                selection.recorded_affected = self.find_affected(
+                    graph, {path: members for path, members in changed_members_and_modules.items() if path in unaccounted}
+                )
 
-                # if the test failed in the last run, run it anyway
-                if test.nodeid in self.lastfailed:
-                    log_records.append(
-                        ('RUN', test.nodeid, "Failed on last run")
-                    )
-                    self.logger.info(
-                        "Test '%s' failed on the last run, so will be run regardless of changes" % test.nodeid)
-                    test_count += 1
-                    continue
+        return selection
 
-                # if the test is already skipped, just ignore it
-                if test.get_marker('skip'):
-                    log_records.append(
-                        ('SKIP', test.nodeid, "Found skip marker")
-                    )
-                    self.logger.info("Found skip marker on test '%s' -- ignoring" % test.nodeid)
-                    continue
+    def select_test(self, selection: typing.Union[Selection, None], path: str, test_name: str, nodeid: str, skip_marked: bool=False, decisions: typing.Union[dict, None]=None, fixtures: typing.Union[ListOfNode, None]=None, node_name: StrOrNone=None) -> typing.Tuple[typing.Union[bool, None], str]:
+        # decides whether the test should run.  Returns True or False with the reason, or None for tests that are skipped
+        # already.  decisions holds the analysis of each test by node id, for as long as the changes stay the same, and
+        # selection is only needed for the tests that aren't in it.
+        # if the test failed in the last run, run it anyway
+        if nodeid in self.lastfailed:
+            self.logger.info("Test '%s' failed on the last run, so will be run regardless of changes" % nodeid)
+            return True, "Failed on last run"
 
-                # check dependencies within any defined fixtures
-                if str(test.fspath) in ast_map.keys():
-                    test_file_ast = ast_map[str(test.fspath)]
+        # if the test is already skipped, just ignore it
+        if skip_marked:
+            self.logger.info("Found skip marker on test '%s' -- ignoring" % nodeid)
+            return None, "Found skip marker"
 
-                else:
-                    contents, _ = self.read_file(str(test.fspath))
-                    test_file_ast = ast.parse(contents)
-                    ast_map[str(test.fspath)] = test_file_ast
+        if decisions is not None and nodeid in decisions:
+            return tuple(decisions[nodeid])
 
-                test_node = None
-                for child in ast.iter_child_nodes(test_file_ast):
-                    if isinstance(child, ast.ClassDef):
-                        for subchild in ast.iter_child_nodes(child):
-                            if isinstance(subchild, ast.FunctionDef) and subchild.name == test_name:
-                                test_node = subchild
-                                break
+        analysis = self.analyse_test(selection, path, test_name, nodeid, fixtures, node_name)
+        if decisions is not None:
+            decisions[nodeid] = analysis
 
-                        if test_node is not None:
-                            break
+        return analysis
 
-                    elif isinstance(child, ast.FunctionDef) and child.name == test_name:
-                        test_node = child
-                        break
+    def needs_analysis(self, item, decisions: dict) -> bool:
+        # tests that failed last time or are skip marked are decided without analysing them
+        return item.nodeid not in decisions and item.nodeid not in self.lastfailed and not item.get_marker('skip')
 
+    @staticmethod
+    def find_item_fixtures(item) -> typing.Union[ListOfNode, None]:
+        # the (path, name) nodes of the definitions of every fixture the item uses, as pytest resolved them: requested by
+        # the test or by other fixtures, autouse or through usefixtures, wherever they are defined.  None for items that
+        # pytest didn't resolve fixtures for.
+        fixtureinfo = getattr(item, '_fixtureinfo', None)
+        if fixtureinfo is None:
+            return None
+
+        nodes = []
+        for name in fixtureinfo.names_closure:
+            for fixturedef in fixtureinfo.name2fixturedefs.get(name, ()):
+                code = getattr(fixturedef.func, '__code__', None)
+                if code is None:
+                    continue
+
+                qualified_name = getattr(fixturedef.func, '__qualname__', fixturedef.func.__name__).split('.<locals>')[0]
+                node = (os.path.abspath(code.co_filename), qualified_name)
+                if node not in nodes:
+                    nodes.append(node)
+
+        return nodes
+
+    def find_test_node_name(self, item) -> StrOrNone:
+        # the graph node of the item's test, found from the first line of its code object through the line index of its
+        # file, so that a same named function elsewhere in the file can't be mistaken for it.  Tests defined in nested
+        # classes or inherited from another file, as unittest style tests often are, fall back to their top level
+        # class.  None if neither applies, in which case analyse_test looks the test up by name.
+        path = str(item.fspath)
+        function = getattr(item, 'function', None)
+        try:
+            code = inspect.unwrap(function).__code__ if function is not None else None
+
+        except (AttributeError, ValueError):
+            code = None
+
+        if code is not None and os.path.abspath(code.co_filename) == path:
+            definition = self.get_summary(path).line_index.get(code.co_firstlineno)
+            if definition is not None and definition.toplevel:
+                return definition.name
+
+            if definition is not None and definition.parent_toplevel:
+                return definition.qualified_name
+
+        cls = getattr(item, 'cls', None)
+        if cls is not None:
+            definition = self.get_summary(path).find_definition(getattr(cls, '__qualname__', cls.__name__).split('.')[0])
+            if definition is not None and definition.kind == 'class' and definition.toplevel:
+                return definition.name
+
+        return None
+
+    def is_fixture_affected(self, selection: Selection, node: Node, recorded: bool) -> bool:
+        # fixtures are shared by many tests, so each definition is only looked at once per selection
+        key = (node, recorded)
+        if key not in selection.fixture_verdicts:
+            path, name = node
+            if (path, name) not in selection.graph and '.' in name:  # methods of nested classes aren't nodes of their own
+                name = name.split('.')[0]
+
+            affected = selection.recorded_affected if recorded else selection.affected
+            selection.fixture_verdicts[key] = self.in_scope(path) and self.is_affected((path, name), selection.graph, affected)
+
+        return selection.fixture_verdicts[key]
+
+    def analyse_test(self, selection: Selection, path: str, test_name: str, nodeid: str, fixtures: typing.Union[ListOfNode, None]=None, node_name: StrOrNone=None) -> typing.Tuple[bool, str]:
+        # fixtures are the fixture definitions the test uses, from find_item_fixtures.  Without them, only fixtures that
+        # the test file defines and the test requests by name are considered.  node_name is the test's node in the
+        # graph, from find_test_node_name; without it, the test is looked up by name in its file.
+        # if the test is new, run it anyway
+        if path in selection.changed_files and selection.changed_files[path].change_type == 'A':
+            self.logger.info("Test '%s' is new, so will be run regardless of changes to the code it tests" % nodeid)
+            return True, "New test"
+
+        if nodeid in selection.impacted:
+            self.logger.info("Test '%s' will run because it executed changed code when it was recorded" % nodeid)
+            return True, "Executed changed code"
+
+        graph = selection.graph
+        affected = selection.recorded_affected if nodeid in selection.recorded else selection.affected
+
+        test_node = None
+        if node_name is None or fixtures is None:
+            test_file_summary = self.get_summary(path)
+            toplevel_classes = [d.name for d in test_file_summary.definitions if d.kind == 'class' and d.toplevel]
+
+            for definition in test_file_summary.definitions:
+                if definition.kind == 'function' and definition.name == test_name and (definition.toplevel or definition.parent in toplevel_classes):
+                    test_node = definition
+                    break
+
+            if node_name is None:
                 assert test_node is not None
+                node_name = test_node.qualified_name if test_node.parent else test_name
 
-                if str(test.fspath) not in fixture_map.keys():
-                    fixture_extractor = FixtureExtractor()
-                    fixtures = fixture_extractor.extract(test_file_ast)
-
-                    fixture_map[str(test.fspath)] = fixtures
-
-                found_changed_fixture = False
-                for fixture in fixture_map[str(test.fspath)]:
-                    for arg in test_node.args.args:
-                        if arg.arg == fixture.name and self.dependencies_changed(str(test.fspath), fixture.name, changed_members_and_modules, []):
-                            log_records.append(
-                                ('RUN', test.nodeid, "Uses changed fixture")
-                            )
-                            self.logger.info("Test '%s' will run because it uses a changed fixture (%s)" % (
-                            test.nodeid, fixture.name))
-                            test_count += 1
-                            found_changed_fixture = True
-                            break
-
-                    if found_changed_fixture:
-                        break
-
-                if found_changed_fixture:
-                    continue
+        # check dependencies within any fixtures
+        if fixtures is not None:
+            recorded = nodeid in selection.recorded
+            for fixture in fixtures:
+                if self.is_fixture_affected(selection, fixture, recorded):
+                    self.logger.info("Test '%s' will run because it uses a changed fixture (%s)" % (nodeid, "%s::%s" % fixture))
+                    return True, "Uses changed fixture"
+
+        else:
+            for fixture in test_file_summary.fixtures:
+                if test_node is not None and fixture in test_node.arg_names and self.is_affected((path, fixture), graph, affected):
+                    self.logger.info("Test '%s' will run because it uses a changed fixture (%s)" % (nodeid, fixture))
+                    return True, "Uses changed fixture"
+
+        # otherwise, check the dependency chain from inside the test function
+        if self.is_affected((path, node_name), graph, affected):
+            chain = ' -> '.join(graph.chain(affected, (path, node_name)))
+            self.logger.info("Test '%s' will run because one of it's dependencies changed (%s)" % (nodeid, chain))
+            return True, "Dependency changed: " + chain
 
-                # otherwise, check the dependency chain from inside the test function
-                chain = []
-                if self.dependencies_changed(str(test.fspath), test_name, changed_members_and_modules, chain):
-                    log_records.append(
-                        ('RUN', test.nodeid, "Dependency changed: " + ' -> '.join(chain))
+        return False, "Unchanged"
+
+    def run(self, items) -> ListOfTestItem:
+        # marks unaffected tests as skipped, or returns them if they should be deselected instead
+        deselected = []
+        stats = self.stats
+        report = None
+
+        try:
+            if self.shared_selection is not None:
+                # the controller already diffed and analysed the project, once for all workers
+                selection = self.shared_selection
+                fingerprint = None
+                decisions = {}
+                daemon_decisions = {}
+
+            else:
+                # the analysis of the last run holds for as long as none of its inputs change
+                fingerprint = self.find_selection_fingerprint()
+                decisions = {}
+                if self.cached_selection and self.cached_selection.get('fingerprint') == fingerprint:
+                    decisions = dict(self.cached_selection['decisions'])
+
+                missing = [test for test in items if self.needs_analysis(test, decisions)]
+                daemon_decisions = {}
+                if missing and self.use_daemon:
+                    daemon_decisions = self.find_daemon_decisions(
+                        [(str(test.fspath), test.name.split('[')[0], test.nodeid, self.find_item_fixtures(test), self.find_test_node_name(test)) for test in missing]
                     )
-                    self.logger.info(
-                        "Test '%s' will run because one of it's dependencies changed (%s)" % (
-                        test.nodeid, ' -> '.join(chain)))
-                    test_count += 1
-                    continue
+                    decisions.update(daemon_decisions)
 
-                else:
-                    log_records.append(
-                        ('SKIP', test.nodeid, "Unchanged")
+                selection = None
+                if any(self.needs_analysis(test, decisions) for test in items):
+                    selection = self.prepare_selection()
+
+                elif not missing:
+                    self.logger.info("Nothing changed since the last run, so its selection is reused")
+
+            test_count = 0
+            unselected_count = 0  # only the tests this run deselected or marked to skip, not those skipped anyway
+
+            if self.report:
+                report = SelectionReport(self.report)
+
+            with stats.phase("test analysis"):
+                for test in items:
+                    test_name = test.name.split('[')[0]  # only used when the test can't be found by its code object
+                    analysed = not self.needs_analysis(test, decisions)
+                    selected, reason = self.select_test(
+                        selection, str(test.fspath), test_name, test.nodeid, skip_marked=bool(test.get_marker('skip')), decisions=decisions,
+                        fixtures=self.find_item_fixtures(test) if not analysed else None,
+                        node_name=self.find_test_node_name(test) if not analysed else None
                     )
-                    self.logger.info("Test '%s' doesn't touch new or modified code -- SKIPPING" % test.nodeid)
-                    skip = pytest.mark.skip(reason="This test doesn't touch new or modified code")
-                    test.add_marker(skip)
+                    decision = 'RUN' if selected else 'SKIP'
+                    test.user_properties.append(("smart_collect", "%s: %s" % (decision, reason)))
+                    if report is not None:
+                        report.write(decision, test.nodeid, reason)
+
+                    if selected:
+                        test_count += 1
+
+                    elif selected is not None:
+                        unselected_count += 1
+                        if self.deselect:
+                            self.logger.info("Test '%s' doesn't touch new or modified code -- DESELECTING" % test.nodeid)
+                            deselected.append(test)
+
+                        else:
+                            self.logger.info("Test '%s' doesn't touch new or modified code -- SKIPPING" % test.nodeid)
+                            skip = pytest.mark.skip(reason="This test doesn't touch new or modified code")
+                            test.add_marker(skip)
 
-            # TODO: add option to write to csv
-            import csv
-            with open("results.csv", "w") as csvfile:
-                csvwriter = csv.writer(csvfile)
-                for row in log_records:
-                    csvwriter.writerow(list(row))
+            if fingerprint is not None:
+                # the daemon's answers serve this run only, as the next is only checked against the analysis done here
+                self.cached_selection = {
+                    'fingerprint': fingerprint,
+                    'decisions': {nodeid: analysis for nodeid, analysis in decisions.items() if nodeid not in daemon_decisions}
+                }
 
+            with stats.phase("report"):
+                if report is not None:
+                    report.close()
+                    report = None
+
+                self.summary_cache.save()
+
+            self.record_stats(selection, test_count, unselected_count)
             self.logger.warning("Total tests selected to run: " + str(test_count))
-            self._revert_syspath()
 
         except Exception as e:
             self._handle_exception(str(e))
 
+        finally:
+            if report is not None:
+                report.close()
+
+        return deselected
+
+    def record_stats(self, selection: typing.Union[Selection, None], selected: int, unselected: int):
+        stats = self.stats
+        depths = {}
+        for node, parent in (selection.affected.items() if selection is not None else []):
+            depths[node] = depths[parent] + 1 if parent is not None else 1
+
+        stats.set("max dependency depth", max(depths.values() or [0]))
+        stats.set("summary cache hits", self.summary_cache.hits)
+        stats.set("summary cache misses", self.summary_cache.misses)
+        stats.set("imports resolved", self.resolver.resolved)
+        stats.set("tests selected", selected)
+        stats.set("tests deselected" if self.deselect else "tests skipped", unselected)
+
     def _handle_exception(self, msg):
-        self._revert_syspath()
         raise Exception(msg)
 
-    def _revert_syspath(self):
-        for _ in range(0, len(self.packages)):
-            sys.path.pop(0)
-
 
 
 
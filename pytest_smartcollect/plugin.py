@@ -1,6 +1,9 @@
 # -*- coding: utf-8 -*-
+import os
+import json
+import re
 import pytest
-from pytest_smartcollect.helpers import SmartCollector
+from pytest_smartcollect.helpers import SmartCollector, Selection, SelectionReport, LineTracer, ImpactDatabase, DEFAULT_CACHE_MAX_SIZE, DEFAULT_CACHE_MAX_AGE
 
 
 def pytest_addoption(parser):
@@ -19,7 +22,7 @@ def pytest_addoption(parser):
         const=True,
         metavar='path',
         dest='ignore_source',
-        help='Source code file or folder to ignore during smart collection.  Multiple instances of this flag are supported.'
+        help='Source code file or folder to ignore during smart collection, or a glob pattern (*_pb2.py matches file names anywhere).  Multiple instances of this flag are supported.'
     )
     group.addoption(
         '--commit-range',
@@ -27,14 +30,14 @@ def pytest_addoption(parser):
         default=0,
         type=int,
         dest='commit_range',
-        help='The number of commits before the HEAD commit of the diffed branch (specified with option --diff-current-head-with-branch) to use when calculating diffs for smart collection. Default is 0'
+        help='The number of commits before the merge base of the current HEAD and the diffed branch (specified with option --diff-current-head-with-branch) to use when calculating diffs for smart collection. Default is 0'
     )
     group.addoption(
         '--diff-current-head-with-branch',
         action='store',
         default='master',
         dest='diff_current_head_with_branch',
-        help='The branch to diff the currently checked out head with. Default is "master".'
+        help='The branch to diff the currently checked out head with, starting from the commit at which they diverged. Default is "master".'
     )
     group.addoption(
         '--allow-preemptive-failures',
@@ -43,6 +46,99 @@ def pytest_addoption(parser):
         dest='allow_preemptive_failures',
         help="If any deleted or renamed files are found to be imported in any files under test, collection will fail when using smart collection. Default is False."
     )
+    group.addoption(
+        '--smart-collect-deselect',
+        action='store_true',
+        default=False,
+        dest='smart_collect_deselect',
+        help='Deselect tests that do not touch new or modified code, instead of marking them as skipped.'
+    )
+    group.addoption(
+        '--smart-collect-prune',
+        action='store_true',
+        default=False,
+        dest='smart_collect_prune',
+        help='Skip importing test files whose dependencies are unchanged since the last smart collection run, using the test file index kept in the pytest cache. Files that are new, stale or missing from the index are collected and filtered as usual.'
+    )
+    group.addoption(
+        '--smart-collect-record',
+        action='store_true',
+        default=False,
+        dest='smart_collect_record',
+        help='Record the lines of project code that each test executes in the test impact database kept in the pytest cache. Smart collection looks up the tests that executed the changed lines there, when the database was recorded at the diff base. Record on a clean checkout.'
+    )
+    group.addoption(
+        '--smart-collect-report',
+        action='store',
+        default=None,
+        metavar='PATH',
+        dest='smart_collect_report',
+        help='Write the selection decision and its reason for every collected test to PATH, as CSV or JSON lines depending on its extension (.csv or .jsonl). Default is no report.'
+    )
+    group.addoption(
+        '--smart-collect-stats',
+        action='store',
+        default=None,
+        metavar='PATH',
+        dest='smart_collect_stats',
+        help='Write the time spent in each phase of smart collection, and counters of the work done, to a JSON file at PATH. They are always shown in the terminal summary.'
+    )
+    group.addoption(
+        '--smart-collect-no-daemon',
+        action='store_false',
+        default=True,
+        dest='smart_collect_daemon',
+        help='Analyse the tests in process, even when a smart collection daemon (python -m pytest_smartcollect.daemon) is serving the repository.  The daemon is only used on platforms with unix sockets.'
+    )
+    group.addoption(
+        '--smart-collect-tracked-only',
+        action='store_false',
+        default=True,
+        dest='smart_collect_untracked',
+        help='Only analyse the python files tracked by git.  By default, untracked files that git does not ignore are part of the project too.'
+    )
+    group.addoption(
+        '--smart-collect-monorepo',
+        action='store_true',
+        default=False,
+        dest='smart_collect_monorepo',
+        help='Only diff and analyse the pytest rootdir, and the source roots given with --smart-collect-source-root, instead of the whole git repository. Code elsewhere in the repository is treated like third party code.'
+    )
+    group.addoption(
+        '--smart-collect-source-root',
+        action='append',
+        default=[],
+        metavar='PATH',
+        dest='smart_collect_source_roots',
+        help='A source root outside of the pytest rootdir, like a shared library, that the tests depend on, relative to the rootdir. Implies --smart-collect-monorepo. Multiple instances of this flag are supported.'
+    )
+    group.addoption(
+        '--smart-collect-workers',
+        action='store',
+        default=0,
+        type=int,
+        metavar='N',
+        dest='smart_collect_workers',
+        help='Read and summarise source files in N worker processes. Useful on a fresh clone, before the module analysis cache is populated. Default is 0 (no worker processes).'
+    )
+    group.addoption(
+        '--smart-collect-cache-max-size',
+        action='store',
+        default=DEFAULT_CACHE_MAX_SIZE // (1024 * 1024),
+        type=int,
+        metavar='MB',
+        dest='smart_collect_cache_max_size',
+        help='The maximum size in megabytes of the module analysis cache kept in the pytest cache directory. Least recently used entries are evicted first. Default is %d.' % (DEFAULT_CACHE_MAX_SIZE // (1024 * 1024))
+    )
+    group.addoption(
+        '--smart-collect-cache-max-age',
+        action='store',
+        default=DEFAULT_CACHE_MAX_AGE // (24 * 60 * 60),
+        type=int,
+        metavar='DAYS',
+        dest='smart_collect_cache_max_age',
+        help='Entries of the module analysis cache that have not been used for this many days are evicted. Default is %d.' % (DEFAULT_CACHE_MAX_AGE // (24 * 60 * 60))
+    )
 
 
 @pytest.fixture
@@ -50,29 +146,289 @@ def smart_collect(request):
     return request.config.option.smart_collect
 
 
+TEST_FILE_INDEX_KEY = "smartcollect/test_file_index"
+SELECTION_CACHE_KEY = "smartcollect/selection"
+SHARED_SELECTION_KEY = "smartcollect_selection"
+SHARED_PRUNABLE_KEY = "smartcollect_prunable"
+PYTEST_VERSION = tuple(int(re.match(r"\d*", part).group() or 0) for part in pytest.__version__.split(".")[:2])
+
+
+def get_workerinput(config):
+    # the input pytest-xdist gives each of its workers, or None in the controller and without xdist
+    return getattr(config, 'workerinput', getattr(config, 'slaveinput', None))
+
+
+def worker_path(config, path):
+    # workers write their own copy of per run files, named after the worker
+    workerinput = get_workerinput(config)
+    if path is None or workerinput is None:
+        return path
+
+    root, ext = os.path.splitext(path)
+    return "%s.%s%s" % (root, workerinput.get('workerid', workerinput.get('slaveid')), ext)
+
+
+def load_shared_selection(config, logger):
+    workerinput = get_workerinput(config)
+    path = workerinput.get(SHARED_SELECTION_KEY) if workerinput is not None else None
+    if path is None:
+        return None
+
+    try:
+        with open(path) as f:
+            return Selection.from_dict(json.load(f))
+
+    except Exception as e:  # e.g. a remote worker, that doesn't share the controller's file system
+        logger.info("Couldn't load the selection shared by the xdist controller, preparing it again -- %s" % str(e))
+        return None
+
+
+class XdistController(object):
+    # Prepares the selection once in the pytest-xdist controller, which collects nothing itself, and hands it to every
+    # worker through a file, so that workers only apply it to the tests they collect.  The test files it pruned at the
+    # start of the session are handed to the workers too, and it indexes the test files they collected.
+    def __init__(self, config):
+        self.config = config
+        self.path = None
+        self.collected = set()
+
+    def share_selection(self) -> str:
+        smart_collector = get_smart_collector(self.config)
+        try:
+            selection = smart_collector.prepare_selection()
+            smart_collector.summary_cache.save()  # the workers read the summaries of the test files from the cache
+
+        except Exception as e:  # the workers prepare the selection themselves, and report the problem properly
+            smart_collector.logger.warning("Couldn't prepare the selection for the xdist workers: %s" % str(e))
+            return ''
+
+        path = os.path.join(smart_collector.cache_dir, "xdist-selection-%d.json" % os.getpid())
+        with open(path, "w") as f:
+            json.dump(selection.to_dict(), f)
+
+        return path
+
+    @pytest.hookimpl(optionalhook=True)
+    def pytest_configure_node(self, node):
+        if self.path is None:
+            self.path = self.share_selection()
+
+        workerinput = getattr(node, 'workerinput', None)
+        if workerinput is None:
+            workerinput = node.slaveinput
+
+        if self.path:
+            workerinput[SHARED_SELECTION_KEY] = self.path
+
+        if self.config.option.smart_collect_prune:
+            workerinput[SHARED_PRUNABLE_KEY] = sorted(self.config._smart_collect_prunable)
+
+    @pytest.hookimpl(optionalhook=True)
+    def pytest_xdist_node_collection_finished(self, node, ids):
+        rootdir = str(self.config.rootdir)
+        self.collected.update(os.path.join(rootdir, *nodeid.split("::")[0].split('/')) for nodeid in ids)
+
+    def pytest_sessionfinish(self):
+        if self.path:
+            os.unlink(self.path)
+
+        smart_collector = get_smart_collector(self.config)
+        if self.config.option.smart_collect_prune and self.collected and smart_collector.graph is not None:
+            # the workers that applied the shared selection have no graph to index their test files with
+            index = smart_collector.build_test_file_index(
+                smart_collector.graph, sorted(self.collected), self.config.cache.get(TEST_FILE_INDEX_KEY, {})
+            )
+            self.config.cache.set(TEST_FILE_INDEX_KEY, index)
+
+
+def check_report_path(path):
+    # a report that can't be written would only fail once every test has been analysed
+    if SelectionReport.find_format(path) is None:
+        raise pytest.UsageError("--smart-collect-report: couldn't determine the report format of '%s' -- use a .csv or .jsonl file" % path)
+
+    directory = os.path.dirname(os.path.abspath(path))
+    try:
+        os.makedirs(directory, exist_ok=True)
+
+    except OSError as e:
+        raise pytest.UsageError("--smart-collect-report: couldn't create the directory of '%s' -- %s" % (path, str(e)))
+
+    if not os.access(directory, os.W_OK):
+        raise pytest.UsageError("--smart-collect-report: the directory of '%s' isn't writable" % path)
+
+
+def pytest_configure(config):
+    if config.option.smart_collect and config.option.smart_collect_report:
+        check_report_path(config.option.smart_collect_report)
+
+    xdist_controller = getattr(config.option, 'dist', 'no') != 'no' and get_workerinput(config) is None
+    if config.option.smart_collect and xdist_controller:
+        config.pluginmanager.register(XdistController(config), "smartcollect-xdist")
+
+
+def get_smart_collector(config):
+    # one collector per session, so the diff and module analysis are shared between the session and collection hooks
+    smart_collector = getattr(config, '_smart_collector', None)
+    if smart_collector is None:
+        from logging import getLogger
+        logger = getLogger()
+        logger.setLevel(config.option.log_level or 'WARNING')
+
+        source_roots = None
+        if config.option.smart_collect_monorepo or config.option.smart_collect_source_roots:
+            source_roots = config.option.smart_collect_source_roots
+
+        smart_collector = config._smart_collector = SmartCollector(
+            str(config.rootdir),
+            config.cache.get("cache/lastfailed", {}),
+            config.option.ignore_source,
+            config.option.commit_range,
+            config.option.diff_current_head_with_branch,
+            config.option.allow_preemptive_failures,
+            logger,
+            cache_dir=str(config.cache.makedir("smartcollect")),
+            cache_max_size=config.option.smart_collect_cache_max_size * 1024 * 1024,
+            cache_max_age=config.option.smart_collect_cache_max_age * 24 * 60 * 60,
+            workers=config.option.smart_collect_workers,
+            deselect=config.option.smart_collect_deselect,
+            report=worker_path(config, config.option.smart_collect_report),
+            cached_selection=config.cache.get(SELECTION_CACHE_KEY, None),
+            use_daemon=config.option.smart_collect_daemon,
+            shared_selection=load_shared_selection(config, logger),
+            untracked=config.option.smart_collect_untracked,
+            source_roots=source_roots
+        )
+
+    return smart_collector
+
+
+def pytest_sessionstart(session):
+    config = session.config
+    config._smart_collect_prunable = set()
+    workerinput = get_workerinput(config)
+
+    if config.option.smart_collect_record:
+        smart_collector = get_smart_collector(config)
+        impact_db = ImpactDatabase(smart_collector.impact_db_path)
+        if workerinput is None:
+            # the xdist controller sets the database up before it starts its workers, which only record into it
+            commits = smart_collector.find_commit_range(smart_collector.git_repo_root)
+            if commits.git("status", "--porcelain", "--untracked-files=no"):
+                smart_collector.logger.warning("Recording test impact with uncommitted changes; line numbers may not match %s" % commits.head)
+
+            if impact_db.commit != commits.head:
+                impact_db.reset(commits.head)
+
+        config._smart_collect_recorder = (LineTracer(smart_collector.git_repo_root), impact_db, set())
+
+    if config.option.smart_collect and config.option.smart_collect_prune and workerinput is not None:
+        # the controller diffed the project and found the prunable test files once, for all of its workers
+        config._smart_collect_prunable = set(workerinput.get(SHARED_PRUNABLE_KEY, []))
+
+    elif config.option.smart_collect and config.option.smart_collect_prune:
+        smart_collector = get_smart_collector(config)
+        try:
+            config._smart_collect_prunable = smart_collector.find_prunable_test_files(
+                config.cache.get(TEST_FILE_INDEX_KEY, {})
+            )
+
+        except Exception as e:
+            # collection falls back to filtering items, which reports the problem properly
+            smart_collector.logger.warning("Couldn't prune test files: %s" % str(e))
+
+
+@pytest.hookimpl(hookwrapper=True)
+def pytest_runtest_protocol(item, nextitem):
+    recorder = getattr(item.config, '_smart_collect_recorder', None)
+    if recorder is None:
+        yield
+        return
+
+    tracer, impact_db, skipped = recorder
+    tracer.start()
+    try:
+        yield
+
+    finally:
+        lines = tracer.stop()
+
+    # a skipped test didn't get to execute the code it tests, so whatever was recorded for it before is kept
+    if item.nodeid not in skipped:
+        relpath = get_smart_collector(item.config).summary_cache.relpath
+        impact_db.record(item.nodeid, {relpath(f): file_lines for f, file_lines in lines.items()})
+
+
+@pytest.hookimpl(hookwrapper=True)
+def pytest_runtest_makereport(item, call):
+    outcome = yield
+    recorder = getattr(item.config, '_smart_collect_recorder', None)
+    if recorder is not None and outcome.get_result().skipped:
+        recorder[2].add(item.nodeid)
+
+
+def pytest_sessionfinish(session):
+    config = session.config
+    recorder = getattr(config, '_smart_collect_recorder', None)
+    if recorder is not None:
+        recorder[1].close()
+        config._smart_collect_recorder = None
+
+    smart_collector = getattr(config, '_smart_collector', None)
+    if smart_collector is not None and config.option.smart_collect_stats:
+        with open(worker_path(config, config.option.smart_collect_stats), "w") as f:
+            json.dump(smart_collector.stats.to_dict(), f, indent=2)
+
+
+def pytest_terminal_summary(terminalreporter):
+    smart_collector = getattr(terminalreporter.config, '_smart_collector', None)
+    if smart_collector is None or not smart_collector.stats.phases:
+        return
+
+    stats = smart_collector.stats
+    terminalreporter.write_sep("-", "smart collection")
+    for name, (wall, cpu) in stats.phases.items():
+        terminalreporter.write_line("%-24s %8.3fs wall %8.3fs cpu" % (name, wall, cpu))
+
+    for name, value in stats.counters.items():
+        terminalreporter.write_line("%-24s %8d" % (name, value))
+
+
+def ignore_collect(path, config):
+    # pytest_ignore_collect is firstresult, so only ever answer True and leave every other decision to pytest
+    if str(path) in getattr(config, '_smart_collect_prunable', ()):
+        return True
+
+
+if PYTEST_VERSION >= (7, 0):
+    def pytest_ignore_collect(collection_path, config):
+        return ignore_collect(collection_path, config)
+
+else:
+    def pytest_ignore_collect(path, config):  # the argument newer versions of pytest no longer accept
+        return ignore_collect(path, config)
+
+
 @pytest.hookimpl(trylast=True) # I don't want to interfere with the functionality of other plugins that might implement this hook
 def pytest_collection_modifyitems(config, items):
     smart_collect = config.option.smart_collect
-    ignore_source = config.option.ignore_source
-    commit_range = config.option.commit_range
-    diff_current_head_with_branch = config.option.diff_current_head_with_branch
-    allow_preemptive_failures = config.option.allow_preemptive_failures
-    log_level = config.option.log_level or 'WARNING'
-
-    from logging import getLogger
-    logger = getLogger()
-    logger.setLevel(log_level)
 
     # TODO: review compatibility with other plugins; fail if a plugin is found to be both active and incompatible
 
     if smart_collect:
-        smart_collector = SmartCollector(
-            str(config.rootdir),
-            config.cache.get("cache/lastfailed", {}),
-            ignore_source,
-            commit_range,
-            diff_current_head_with_branch,
-            allow_preemptive_failures,
-            logger
-        )
-        smart_collector.run(items)
\ No newline at end of file
+        smart_collector = get_smart_collector(config)
+        deselected = smart_collector.run(items)
+        if smart_collector.shared_selection is None:
+            config.cache.set(SELECTION_CACHE_KEY, smart_collector.cached_selection)
+
+        if deselected:
+            deselected_ids = set(id(item) for item in deselected)
+            config.hook.pytest_deselected(items=deselected)
+            items[:] = [item for item in items if id(item) not in deselected_ids]
+
+        if config.option.smart_collect_prune and smart_collector.graph is not None:
+            # refresh the index for every file that was collected, keeping the entries of the files that were pruned
+            test_files = sorted(set(str(item.fspath) for item in items) | set(str(item.fspath) for item in deselected))
+            index = smart_collector.build_test_file_index(
+                smart_collector.graph, test_files, config.cache.get(TEST_FILE_INDEX_KEY, {})
+            )
+            config.cache.set(TEST_FILE_INDEX_KEY, index)
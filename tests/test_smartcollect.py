@@ -1,6 +1,9 @@
 # -*- coding: utf-8 -*-
 import os
+import sys
+import json
 import typing
+import threading
 import pytest
 from importlib import import_module
 from _pytest.pytester import Testdir
@@ -193,6 +196,42 @@ def test_DefinitionNodeExtractor(testdir):
     )
 
 
+def test_decode_source_encodings(testdir):
+    Repo.init(".")
+
+    with open("cookie.py", "wb") as f:
+        f.write("# -*- coding: latin-1 -*-\nname = 'caf\u00e9'\n".encode('latin-1'))
+
+    with open("bom.py", "wb") as f:
+        f.write(b"\xef\xbb\xbf" + "name = 'caf\u00e9'\r\nother = 1".encode('utf-8'))
+
+    with open("guessed.py", "wb") as f:
+        f.write("name = 'caf\u00e9 \u00e0 la cr\u00e8me br\u00fbl\u00e9e, tr\u00e8s d\u00e9licieuse'\n".encode('latin-1'))
+
+    testdir.makepyfile("""
+        from pytest_smartcollect.helpers import decode_source
+        def test_decode_source_encodings():
+            import os
+            root = r"%s"
+            def read(name):
+                with open(os.path.join(root, name), "rb") as f:
+                    return decode_source(f.read())
+            contents, linecount = read("cookie.py")
+            assert u"caf\\u00e9" in contents and linecount == 2
+            contents, linecount = read("bom.py")
+            assert contents == u"name = 'caf\\u00e9'\\nother = 1" and linecount == 2
+            contents, linecount = read("guessed.py")
+            assert u"cr\\u00e8me" in contents and linecount == 1
+    """ % os.path.abspath("."))
+
+    _check_result(
+        testdir,
+        [],
+        ['*1 passed in * seconds*'],
+        lambda x: x == 0
+    )
+
+
 def test_find_git_repo_root(testdir):
     Repo.init(".")
     testdir.mkpydir("foo")
@@ -317,6 +356,65 @@ def test_find_changed_files(testdir):
     )
 
 
+def test_find_changed_files_merge_base(testdir):
+    temp_repo_folder = str(testdir.tmpdir)
+    temp_git_repo = Repo.init(temp_repo_folder)
+
+    for name in ("feature.py", "master.py"):
+        with open(os.path.join(temp_repo_folder, name), 'w') as f:
+            f.write("def hello():\n\tpass\n")
+
+    temp_git_repo.index.add(["feature.py", "master.py"])
+    temp_git_repo.index.commit("initial commit")
+    temp_git_repo.git.checkout("-b", "feature")
+
+    with open(os.path.join(temp_repo_folder, "feature.py"), 'w') as f:
+        f.write("def hello():\n\treturn 42\n")
+    temp_git_repo.index.add(["feature.py"])
+    temp_git_repo.index.commit("feature commit")
+
+    temp_git_repo.git.checkout("master")
+    with open(os.path.join(temp_repo_folder, "master.py"), 'w') as f:
+        f.write("def hello():\n\treturn 43\n")
+    temp_git_repo.index.add(["master.py"])
+    temp_git_repo.index.commit("master commit")
+    temp_git_repo.git.checkout("feature")
+
+    testdir.makepyfile("""
+        import logging
+        import pytest
+        from pytest_smartcollect.helpers import SmartCollector
+        @pytest.fixture
+        def smart_collector():
+            return SmartCollector(
+                r"%s",
+                [],
+                [],
+                0,
+                'master',
+                False,
+                logging.getLogger()
+            )
+        def test_find_changed_files_merge_base(smart_collector):
+            from git import Repo
+            repo_path = r"%s"
+            repo = Repo(repo_path)
+            commits = smart_collector.find_commit_range(repo_path)
+            assert commits.merge_base == repo.commit("master~1").hexsha
+            assert commits.is_root_commit(commits.merge_base)
+            assert not commits.diff_everything()
+            _, m, _, _, _ = smart_collector.find_changed_files(repo, repo_path)
+            assert list(m.keys()) == [r"%s"]
+    """ % (temp_repo_folder, temp_repo_folder, os.path.join(temp_repo_folder, "feature.py")))
+
+    _check_result(
+        testdir,
+        [],
+        ['*1 passed in * seconds*'],
+        lambda x: x == 0
+    )
+
+
 def test_find_changed_members(testdir):
     # temp_repo_folder = testdir.tmpdir.dirpath()
     temp_repo_folder = str(testdir.tmpdir)
@@ -366,6 +464,80 @@ def test_find_changed_members(testdir):
     )
 
 
+def test_line_intervals():
+    intervals = helpers.LineIntervals([range(10, 12), range(1, 3), range(2, 5), range(5, 6), range(20, 20)])
+    assert list(intervals) == [range(1, 6), range(10, 12)]
+    assert len(intervals) == 2
+
+    assert intervals.overlaps(1, 2)
+    assert intervals.overlaps(5, 10)
+    assert not intervals.overlaps(6, 10)
+    assert intervals.overlaps(11, 30)
+    assert not intervals.overlaps(12, 30)
+    assert not helpers.LineIntervals().overlaps(1, 100)
+
+
+def test_find_changed_files_multiple_hunks(testdir):
+    temp_repo_folder = str(testdir.tmpdir)
+    temp_git_repo = Repo.init(temp_repo_folder)
+
+    filename = os.path.join(temp_repo_folder, "foo.py")
+    with open(filename, 'w') as f:
+        f.write("def first():\n\treturn 1\n\n\ndef second():\n\treturn 2\n\n\ndef third():\n\treturn 3\n")
+    temp_git_repo.index.add([filename])
+    temp_git_repo.index.commit("initial commit")
+
+    with open(filename, 'w') as f:
+        f.write("def first():\n\treturn 10\n\n\ndef second():\n\treturn 2\n\n\ndef third():\n\treturn 30\n")
+    temp_git_repo.index.add([filename])
+    temp_git_repo.index.commit("second commit")
+
+    testdir.makepyfile("""
+        import io
+        import logging
+        import pytest
+        from pytest_smartcollect.helpers import SmartCollector, GitDiffReader
+        @pytest.fixture
+        def smart_collector():
+            return SmartCollector(
+                r"%s",
+                [],
+                [],
+                1,
+                'master',
+                False,
+                logging.getLogger()
+            )
+        def test_find_changed_files_multiple_hunks(smart_collector):
+            from git import Repo
+            repo_path = r"%s"
+            _, m, _, _, _ = smart_collector.find_changed_files(Repo(repo_path), repo_path)
+            changed = m[r"%s"]
+            assert changed.changed_lines == [range(2, 3), range(10, 11)]
+            assert changed.removed_lines == [range(2, 3), range(10, 11)]
+            assert smart_collector.find_changed_members(changed, repo_path) == ['first', 'third']
+
+        def test_GitDiffReader():
+            raw = (
+                b":100644 100644 abc def R090\\0old.py\\0new.py\\0:100644 100644 abc def M\\0x.py\\0\\0"
+                b"diff --git a/old.py b/new.py\\nrename from old.py\\nrename to new.py\\n--- a/old.py\\n+++ b/new.py\\n@@ -3 +3,2 @@\\n-a\\n+b\\n+c\\n"
+                b"diff --git a/x.py b/x.py\\n--- a/x.py\\n+++ b/x.py\\n@@ -4,2 +3,0 @@\\n-d\\n-e\\n@@ -9,0 +8 @@ foo\\n+f\\n"
+            )
+            diff = GitDiffReader(io.BytesIO(raw), chunk_size=7).read()
+            assert diff == [
+                ('R', 'old.py', 'new.py', [(3, 1, 3, 2)]),
+                ('M', 'x.py', 'x.py', [(4, 2, 3, 0), (9, 0, 8, 1)])
+            ]
+    """ % (temp_repo_folder, temp_repo_folder, filename))
+
+    _check_result(
+        testdir,
+        [],
+        ['*2 passed in * seconds*'],
+        lambda x: x == 0
+    )
+
+
 def test_find_fully_qualified_module_name(testdir):
     testdir.mkpydir("foo")
     testdir.makepyfile(bar="""
@@ -405,144 +577,1494 @@ def test_find_fully_qualified_module_name(testdir):
     )
 
 
-def test_filter_ignore_sources(testdir):
-    Repo.init(".")
+def test_find_repo_files(testdir):
+    import logging
+    r = Repo.init(".")
+    root = os.path.abspath(".")
 
-    testdir.makepyfile(test_foo="""
-        def test_foo():
-            from foo import foo
-    """)
+    testdir.mkpydir("pkg")
+    testdir.mkpydir(os.path.join("pkg", "sub"))
+    testdir.makepyfile(mod="x = 1", gone="y = 2")
+    move("mod.py", os.path.join("pkg", "sub", "mod.py"))
+    os.makedirs(os.path.join(".venv", "lib"))
+    with open(os.path.join(".venv", "lib", "site.py"), "w") as f:
+        f.write("z = 3")
 
-    r = Repo(".")
-    r.index.add(["test_foo.py"])
+    with open(".gitignore", "w") as f:
+        f.write(".venv/\n")
+
+    r.index.add([".gitignore", "gone.py", os.path.join("pkg", "__init__.py")])
     r.index.commit("initial commit")
+    os.remove("gone.py")  # tracked, but deleted from the working tree
 
-    testdir.makepyfile(foo="""
-        def foo():
-            pass
-    """)
+    smart_collector = helpers.SmartCollector(root, [], [], 0, 'master', False, logging.getLogger())
+    assert sorted(smart_collector.find_project_files(root)) == [
+        os.path.join(root, "pkg", "__init__.py"),
+        os.path.join(root, "pkg", "sub", "__init__.py"),
+        os.path.join(root, "pkg", "sub", "mod.py")
+    ]
+    assert sorted(smart_collector.find_packages(root)) == [os.path.join(root, "pkg"), os.path.join(root, "pkg", "sub")]
+    assert smart_collector.find_fully_qualified_module_name(os.path.join(root, "pkg", "sub", "mod.py")) == "pkg.sub.mod"
 
-    r.index.add(["foo.py"])
-    r.index.commit("second commit")
+    tracked = helpers.SmartCollector(root, [], [], 0, 'master', False, logging.getLogger(), untracked=False)
+    assert tracked.find_project_files(root) == [os.path.join(root, "pkg", "__init__.py")]
 
-    _check_result(
-        testdir,
-        ["--smart-collect", "--commit-range", "1", "--ignore-source", os.path.join(os.path.abspath("."), "test_foo.py")],
-        ["*1 skipped in * seconds*"],
-        lambda x: x == 0,
-        #cover_sources=False
-    )
+    trie = smart_collector.find_repo_files(root)
+    assert os.path.join(root, "pkg", "sub", "mod.py") in trie
+    assert os.path.join(root, ".venv", "lib", "site.py") not in trie
+    assert trie.is_package(os.path.join(root, "pkg", "sub"))
+    assert not trie.is_package(root)
+    assert trie.module_name(os.path.join(os.path.dirname(root), "elsewhere.py")) is None
 
 
-def test_run_smart_collection(testdir):
+def test_summary_cache(testdir):
     Repo.init(".")
 
-    testdir.makepyfile(hello="""
-        def hello():
+    testdir.makepyfile(foo="""
+        class Foo(object):
+            def bar(self):
+                return baz()
+
+        def baz():
             return 42
     """)
 
-    testdir.makepyfile(goodbye="""
-        def goodbye():
-            return 43
-    """)
+    testdir.makepyfile("""
+        import ast
+        import logging
+        import pytest
+        from pytest_smartcollect.helpers import SmartCollector
 
-    testdir.makepyfile(hello_goodbye="""
-        from hello import hello
-        from goodbye import goodbye
+        def make_smart_collector(cache_dir):
+            return SmartCollector(
+                r"%s",
+                [],
+                [],
+                1,
+                'master',
+                False,
+                logging.getLogger(),
+                cache_dir=cache_dir
+            )
 
-        def hello_goodbye(select):
-            if select == 'hello':
-                return hello()
+        def test_summary_cache(tmpdir, monkeypatch):
+            cold = make_smart_collector(str(tmpdir))
+            summary = cold.get_summary(r"%s")
+            cold.summary_cache.save()
+            assert cold.summary_cache.misses == 1
+            assert [d.name for d in summary.definitions] == ['Foo', 'bar', 'baz']
 
-            else:
-                return goodbye()
-    """)
+            def fail(*args, **kwargs):
+                raise AssertionError("ast.parse called on a warm cache")
 
-    testdir.makepyfile(test_hello="""
-        def test_hello():
-            from hello import hello
-            assert hello() == 42
-    """)
+            monkeypatch.setattr(ast, "parse", fail)
+            warm = make_smart_collector(str(tmpdir))
+            cached = warm.get_summary(r"%s")
+            assert warm.summary_cache.hits == 1
+            assert cached.digest == summary.digest
+            assert cached.find_definition('bar').used_names == ['baz']
+    """ % (os.path.abspath("."), os.path.abspath("foo.py"), os.path.abspath("foo.py")))
 
-    testdir.makepyfile(test_goodbye="""
-        def test_goodbye():
-            from goodbye import goodbye
-            assert goodbye() == 43\n
+    _check_result(
+        testdir,
+        [],
+        ['*1 passed in * seconds*'],
+        lambda x: x == 0
+    )
+
+
+def test_symbol_graph_cycles(testdir):
+    Repo.init(".")
+
+    testdir.makepyfile(ping="""
+        def ping(n):
+            from pong import pong
+            return pong(n - 1) if n else 0
     """)
 
-    testdir.makepyfile(test_hello_goodbye="""
-        def test_hello_goodbye():
-            from hello_goodbye import hello_goodbye
-            assert hello_goodbye('hello') == 42
-            assert hello_goodbye('goodbye') == 43
+    testdir.makepyfile(pong="""
+        def pong(n):
+            from ping import ping
+            return ping(n - 1) if n else changed()
+
+        def changed():
+            return 42
     """)
 
-    r = Repo(".")
-    r.index.add(["hello.py", "goodbye.py", "hello_goodbye.py"])
-    r.index.commit("initial commit")
+    testdir.makepyfile("""
+        import logging
+        import pytest
+        from pytest_smartcollect.helpers import SmartCollector
+        @pytest.fixture
+        def smart_collector():
+            return SmartCollector(
+                r"%s",
+                [],
+                [],
+                1,
+                'master',
+                False,
+                logging.getLogger()
+            )
+        def test_symbol_graph_cycles(smart_collector):
+            ping = r"%s"
+            pong = r"%s"
+            graph = smart_collector.build_symbol_graph([ping, pong])
+
+            # mutual recursion between modules terminates
+            assert (ping, 'ping') not in smart_collector.find_affected(graph, {})
+
+            affected = smart_collector.find_affected(graph, {pong: ['changed']})
+            assert (ping, 'ping') in affected
+            assert graph.chain(affected, (ping, 'ping')) == ['%%s::ping' %% ping, '%%s::pong' %% pong, '%%s::changed' %% pong]
+    """ % (os.path.abspath("."), os.path.abspath("ping.py"), os.path.abspath("pong.py")))
 
-    # case 1: all tests are new, and therefore should run
     _check_result(
         testdir,
-        ["--smart-collect"],
-        ["*3 passed in * seconds*"],
+        [],
+        ['*1 passed in * seconds*'],
         lambda x: x == 0
     )
 
-    # case 2: one direct dependency (of test_hello) and one indirect dependency (of test_hello_goodbye) has changed
-    with open("hello.py", "w") as f:
-        f.write("def hello():\n\treturn 44")
 
-    r.index.add(["hello.py"])
-    r.index.commit("second commit")
+def test_static_import_resolution(testdir):
+    Repo.init(".")
+    testdir.mkpydir("pkg")
 
-    _check_result(
-        testdir,
-        ["--smart-collect", "--commit-range", "1"],
-        ["*2 failed, 1 skipped in * seconds*"],
-        lambda x: x != 0
-    )
+    with open(os.path.join("pkg", "__init__.py"), "w") as f:
+        f.write("from .impl import thing as renamed\nfrom pkg.stars import *\n")
 
-    # test the lastfailed functionality -- test_hello and test_hello_goodbye should still fail, but it should also still run those tests even though changes to their dependencies didn't occur
-    _check_result(
-        testdir,
-        ["--smart-collect", "--commit-range", "1"],
-        ["*2 failed, 1 skipped in * seconds*"],
-        lambda x: x != 0
-    )
+    with open(os.path.join("pkg", "impl.py"), "w") as f:
+        f.write("raise RuntimeError('project code was executed')\ndef thing():\n    return 42\n")
 
-    # test deleted paths with references still existing  TODO: move this to a separate test in order to improve coverage
-    os.remove("hello.py")
-    os.remove("test_hello.py")
-    r.index.remove(["hello.py"])
-    r.index.commit("")
+    with open(os.path.join("pkg", "stars.py"), "w") as f:
+        f.write("raise RuntimeError('project code was executed')\n__all__ = ['public']\ndef public():\n    pass\ndef hidden():\n    pass\n")
+
+    testdir.makepyfile(user="""
+        from pkg import renamed, public
+        from pkg.stars import *
+
+        def use():
+            return renamed() + public()
+    """)
+
+    testdir.makepyfile("""
+        import logging
+        import pytest
+        from pytest_smartcollect.helpers import SmartCollector
+        @pytest.fixture
+        def smart_collector():
+            return SmartCollector(
+                r"%s",
+                [],
+                [],
+                1,
+                'master',
+                False,
+                logging.getLogger()
+            )
+        def test_static_import_resolution(smart_collector):
+            import os
+            root = r"%s"
+            pkg = os.path.join(root, "pkg")
+            imported = smart_collector.find_imported_names(os.path.join(root, "user.py"))
+            assert imported['renamed'] == [(os.path.join(pkg, "__init__.py"), 'renamed'), (os.path.join(pkg, "impl.py"), 'thing')]
+            assert imported['public'] == [(os.path.join(pkg, "__init__.py"), 'public'), (os.path.join(pkg, "stars.py"), 'public')]
+            assert 'hidden' not in imported
+            graph = smart_collector.build_symbol_graph(smart_collector.find_project_files(root))
+            assert (os.path.join(root, "user.py"), 'use') in smart_collector.find_affected(graph, {os.path.join(pkg, "impl.py"): ['thing']})
+    """ % (os.path.abspath("."), os.path.abspath(".")))
 
     _check_result(
         testdir,
-        ["--smart-collect", "--commit-range", "1", "--allow-preemptive-failures"],
         [],
-        lambda x: x != 0,
-        cover_sources=False
+        ['*1 passed in * seconds*'],
+        lambda x: x == 0
     )
 
-    # now remove the references
-    with open("hello_goodbye.py", "w") as f:
-        f.write("from goodbye import goodbye\ndef hello_goodbye():\n\treturn goodbye()")
 
-    with open("test_hello_goodbye.py", "w") as f:
-        f.write("def test_hello_goodbye():\n\tfrom hello_goodbye import hello_goodbye\n\tassert hello_goodbye() == 43")
+def test_symbol_graph_propagation(testdir):
+    Repo.init(".")
 
-    r.index.add(["hello_goodbye.py"])
-    r.index.commit("")
+    testdir.makepyfile(base="""
+        def base():
+            return 42
 
-    _check_result(
-        testdir,
-        ["--smart-collect", "--commit-range", "1"],
+        def unrelated():
+            return 43
+    """)
+
+    testdir.makepyfile(middle="""
+        from base import base
+
+        class Middle(object):
+            def value(self):
+                return base()
+    """)
+
+    testdir.makepyfile(top="""
+        from middle import Middle
+
+        def top():
+            return Middle().value()
+
+        def other():
+            return len([])
+    """)
+
+    testdir.makepyfile("""
+        import logging
+        import pytest
+        from pytest_smartcollect.helpers import SmartCollector
+        @pytest.fixture
+        def smart_collector():
+            return SmartCollector(
+                r"%s",
+                [],
+                [],
+                1,
+                'master',
+                False,
+                logging.getLogger()
+            )
+        def test_symbol_graph_propagation(smart_collector):
+            import os
+            root = r"%s"
+            base, middle, top = [os.path.join(root, f) for f in ("base.py", "middle.py", "top.py")]
+            graph = smart_collector.build_symbol_graph(smart_collector.find_project_files(root))
+            assert (middle, 'Middle') in graph.dependents[(base, 'base')]
+            affected = smart_collector.find_affected(graph, {base: ['base']})
+            assert (top, 'top') in affected
+            assert (top, 'other') not in affected
+            assert (base, 'unrelated') not in affected
+            assert graph.chain(affected, (top, 'top')) == ['%%s::top' %% top, '%%s::Middle' %% middle, '%%s::base' %% base]
+    """ % (os.path.abspath("."), os.path.abspath(".")))
+
+    _check_result(
+        testdir,
+        [],
+        ['*1 passed in * seconds*'],
+        lambda x: x == 0
+    )
+
+
+def test_parallel_summaries(testdir):
+    Repo.init(".")
+
+    for i in range(8):
+        testdir.makepyfile(**{"mod%d" % i: """
+            from mod0 import f0
+
+            def f%d():
+                return f0()
+        """ % i})
+
+    testdir.makepyfile("""
+        import logging
+        import pytest
+        from pytest_smartcollect.helpers import SmartCollector
+
+        def make_smart_collector(cache_dir, workers):
+            return SmartCollector(
+                r"%s",
+                [],
+                [],
+                1,
+                'master',
+                False,
+                logging.getLogger(),
+                cache_dir=cache_dir,
+                workers=workers
+            )
+
+        def test_parallel_summaries(tmpdir):
+            root = r"%s"
+            serial = make_smart_collector(str(tmpdir.join("serial")), 0)
+            parallel = make_smart_collector(str(tmpdir.join("parallel")), 3)
+            files = sorted(serial.find_project_files(root))
+
+            serial.prefetch_summaries(files)
+            parallel.prefetch_summaries(files)
+            assert parallel.summary_cache.misses == len(files)
+
+            for f in files:
+                assert parallel.summaries[f].digest == serial.summaries[f].digest
+                assert parallel.summaries[f].to_dict() == serial.summaries[f].to_dict()
+
+            assert sorted(parallel.find_all_files(root)) == files
+    """ % (os.path.abspath("."), os.path.abspath(".")))
+
+    _check_result(
+        testdir,
+        [],
+        ['*1 passed in * seconds*'],
+        lambda x: x == 0
+    )
+
+
+def test_filter_ignore_sources(testdir):
+    Repo.init(".")
+
+    testdir.makepyfile(test_foo="""
+        def test_foo():
+            from foo import foo
+    """)
+
+    r = Repo(".")
+    r.index.add(["test_foo.py"])
+    r.index.commit("initial commit")
+
+    testdir.makepyfile(foo="""
+        def foo():
+            pass
+    """)
+
+    r.index.add(["foo.py"])
+    r.index.commit("second commit")
+
+    _check_result(
+        testdir,
+        ["--smart-collect", "--commit-range", "1", "--ignore-source", os.path.join(os.path.abspath("."), "test_foo.py")],
+        ["*1 skipped in * seconds*"],
+        lambda x: x == 0,
+        #cover_sources=False
+    )
+
+
+def test_source_filter(testdir):
+    import logging
+    root = os.path.abspath(".")
+    source_filter = helpers.SourceFilter([
+        "vendor", os.path.join(root, "vendor", "nested"), os.path.join(root, "a", "b"), "*_pb2.py", os.path.join("gen", "*.py"), True
+    ])
+
+    assert source_filter.entries == [
+        os.path.join(root, "a", "b"), os.path.join(root, "vendor"), os.path.join(root, "gen", "*.py"), "*_pb2.py"
+    ]
+    assert source_filter.matches(os.path.join(root, "vendor", "lib", "x.py"))
+    assert source_filter.matches(os.path.join(root, "a", "b", "c.py"))
+    assert not source_filter.matches(os.path.join(root, "a", "b!", "c.py"))
+    assert not source_filter.matches(os.path.join(root, "vendored.py"))
+    assert source_filter.matches(os.path.join(root, "proto", "api_pb2.py"))
+    assert source_filter.matches(os.path.join(root, "gen", "deep", "api.py"))
+    assert not source_filter.matches(os.path.join(root, "api.py"))
+    assert not helpers.SourceFilter([True])
+
+    # the ignored paths are left out of the diff
+    r = Repo.init(".")
+    testdir.makepyfile(mod="x = 1", api_pb2="y = 1")
+    os.makedirs(os.path.join("vendor", "lib"))
+    move("mod.py", os.path.join("vendor", "lib", "mod.py"))
+    testdir.makepyfile(keep="z = 1")
+    r.index.add(["keep.py", "api_pb2.py", os.path.join("vendor", "lib", "mod.py")])
+    r.index.commit("initial commit")
+
+    for path in ("keep.py", "api_pb2.py", os.path.join("vendor", "lib", "mod.py")):
+        with open(path, "a") as f:
+            f.write("\nw = 2\n")
+
+    r.index.add(["keep.py", "api_pb2.py", os.path.join("vendor", "lib", "mod.py")])
+    r.index.commit("second commit")
+
+    assert source_filter.pathspecs(root) == [
+        ":(top,exclude,literal)a/b", ":(top,exclude,literal)vendor", ":(top,exclude,glob)gen/*.py", ":(top,exclude,glob)**/*_pb2.py"
+    ]
+    assert [path for _, path, _, _ in helpers.SmartCollector.read_diff(root, "HEAD~1", "HEAD", ["--", "."] + source_filter.pathspecs(root))] == ["keep.py"]
+
+    smart_collector = helpers.SmartCollector(root, [], ["vendor", "*_pb2.py"], 1, 'master', False, logging.getLogger())
+    assert list(smart_collector.find_changed_files(r, root)[1]) == [os.path.join(root, "keep.py")]
+
+
+def test_monorepo_scope(testdir):
+    import logging
+    r = Repo.init(".")
+    root = os.path.abspath(".")
+    for directory in ("svc_a", "svc_b", "libs"):
+        os.makedirs(directory)
+
+    files = {
+        os.path.join("svc_a", "conftest.py"): "import os, sys\nsys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'libs'))\n",
+        os.path.join("svc_a", "app.py"): "def local():\n    return 1\n",
+        os.path.join("svc_a", "test_a.py"): (
+            "def test_common():\n    from common import value\n    assert value() == 2\n\n\n"
+            "def test_local():\n    from app import local\n    assert local() == 1\n"
+        ),
+        os.path.join("svc_b", "b.py"): "def b():\n    return 1\n",
+        os.path.join("libs", "common.py"): "def value():\n    return 1\n"
+    }
+    for path, contents in files.items():
+        with open(path, "w") as f:
+            f.write(contents)
+
+    r.index.add(list(files))
+    r.index.commit("initial commit")
+
+    for path in (os.path.join("libs", "common.py"), os.path.join("svc_b", "b.py")):
+        with open(path, "w") as f:
+            f.write(files[path].replace("return 1", "return 2"))
+
+    r.index.add([os.path.join("libs", "common.py"), os.path.join("svc_b", "b.py")])
+    r.index.commit("second commit")
+
+    # only the service and the shared library are listed, diffed and analysed
+    svc_a = os.path.join(root, "svc_a")
+    smart_collector = helpers.SmartCollector(svc_a, [], [], 1, 'master', False, logging.getLogger(), source_roots=["../libs"])
+    assert smart_collector.scope == [svc_a, os.path.join(root, "libs")]
+    assert sorted(smart_collector.find_project_files(root)) == sorted(
+        os.path.join(root, p) for p in files if not p.startswith("svc_b")
+    )
+    assert list(smart_collector.find_changed_files(r, root)[1]) == [os.path.join(root, "libs", "common.py")]
+    assert not smart_collector.in_scope(os.path.join(root, "svc_b", "b.py"))
+
+    _check_result(
+        testdir,
+        ["--smart-collect", "--commit-range", "1", "--rootdir", "svc_a", "--smart-collect-source-root", "../libs", "svc_a"],
+        ["*1 passed, 1 skipped in * seconds*"],
+        lambda x: x == 0
+    )
+
+    # each subproject keeps a stat index of its own
+    indexes = [f for _, _, fs in os.walk(os.path.join("svc_a", ".pytest_cache")) for f in fs if f.startswith("index")]
+    assert len(indexes) == 1 and indexes[0] != "index.json"
+
+
+def test_run_smart_collection(testdir):
+    Repo.init(".")
+
+    testdir.makepyfile(hello="""
+        def hello():
+            return 42
+    """)
+
+    testdir.makepyfile(goodbye="""
+        def goodbye():
+            return 43
+    """)
+
+    testdir.makepyfile(hello_goodbye="""
+        from hello import hello
+        from goodbye import goodbye
+
+        def hello_goodbye(select):
+            if select == 'hello':
+                return hello()
+
+            else:
+                return goodbye()
+    """)
+
+    testdir.makepyfile(test_hello="""
+        def test_hello():
+            from hello import hello
+            assert hello() == 42
+    """)
+
+    testdir.makepyfile(test_goodbye="""
+        def test_goodbye():
+            from goodbye import goodbye
+            assert goodbye() == 43\n
+    """)
+
+    testdir.makepyfile(test_hello_goodbye="""
+        def test_hello_goodbye():
+            from hello_goodbye import hello_goodbye
+            assert hello_goodbye('hello') == 42
+            assert hello_goodbye('goodbye') == 43
+    """)
+
+    r = Repo(".")
+    r.index.add(["hello.py", "goodbye.py", "hello_goodbye.py"])
+    r.index.commit("initial commit")
+
+    # case 1: all tests are new, and therefore should run
+    _check_result(
+        testdir,
+        ["--smart-collect"],
+        ["*3 passed in * seconds*"],
+        lambda x: x == 0
+    )
+
+    # case 2: one direct dependency (of test_hello) and one indirect dependency (of test_hello_goodbye) has changed
+    with open("hello.py", "w") as f:
+        f.write("def hello():\n\treturn 44")
+
+    r.index.add(["hello.py"])
+    r.index.commit("second commit")
+
+    _check_result(
+        testdir,
+        ["--smart-collect", "--commit-range", "1"],
+        ["*2 failed, 1 skipped in * seconds*"],
+        lambda x: x != 0
+    )
+
+    # test the lastfailed functionality -- test_hello and test_hello_goodbye should still fail, but it should also still run those tests even though changes to their dependencies didn't occur
+    _check_result(
+        testdir,
+        ["--smart-collect", "--commit-range", "1"],
+        ["*2 failed, 1 skipped in * seconds*"],
+        lambda x: x != 0
+    )
+
+    # test deleted paths with references still existing  TODO: move this to a separate test in order to improve coverage
+    os.remove("hello.py")
+    os.remove("test_hello.py")
+    r.index.remove(["hello.py"])
+    r.index.commit("")
+
+    _check_result(
+        testdir,
+        ["--smart-collect", "--commit-range", "1", "--allow-preemptive-failures"],
+        [],
+        lambda x: x != 0,
+        cover_sources=False
+    )
+
+    # now remove the references
+    with open("hello_goodbye.py", "w") as f:
+        f.write("from goodbye import goodbye\ndef hello_goodbye():\n\treturn goodbye()")
+
+    with open("test_hello_goodbye.py", "w") as f:
+        f.write("def test_hello_goodbye():\n\tfrom hello_goodbye import hello_goodbye\n\tassert hello_goodbye() == 43")
+
+    r.index.add(["hello_goodbye.py"])
+    r.index.commit("")
+
+    _check_result(
+        testdir,
+        ["--smart-collect", "--commit-range", "1"],
         ["*1 passed, 1 skipped in * seconds*"],
         lambda x: x == 0
     )
 
+def test_deselect_unaffected(testdir):
+    Repo.init(".")
+
+    testdir.makepyfile(hello="""
+        def hello():
+            return 42
+    """)
+
+    testdir.makepyfile(test_hello="""
+        def test_hello():
+            from hello import hello
+            assert hello() == 42
+    """)
+
+    testdir.makepyfile(test_other="""
+        def test_other():
+            assert len([]) == 0
+
+        def test_another():
+            assert len([1]) == 1
+    """)
+
+    r = Repo(".")
+    r.index.add(["hello.py", "test_hello.py", "test_other.py"])
+    r.index.commit("initial commit")
+
+    with open("hello.py", "w") as f:
+        f.write("def hello():\n\treturn 44")
+
+    r.index.add(["hello.py"])
+    r.index.commit("second commit")
+
+    _check_result(
+        testdir,
+        ["--smart-collect", "--commit-range", "1", "--smart-collect-deselect"],
+        ["*1 failed, 2 deselected in * seconds*"],
+        lambda x: x != 0
+    )
+
+
+def test_prune_unaffected_test_files(testdir):
+    Repo.init(".")
+
+    testdir.makepyfile(hello="""
+        def hello():
+            return 42
+    """)
+
+    testdir.makepyfile(test_hello="""
+        def test_hello():
+            from hello import hello
+            assert hello() == 42
+    """)
+
+    testdir.makepyfile(test_other="""
+        def test_other():
+            assert len([]) == 0
+
+        def test_another():
+            assert len([1]) == 1
+    """)
+
+    r = Repo(".")
+    r.index.add(["hello.py", "test_hello.py", "test_other.py"])
+    r.index.commit("initial commit")
+
+    with open("hello.py", "w") as f:
+        f.write("def hello():\n\treturn 44")
+
+    r.index.add(["hello.py"])
+    r.index.commit("second commit")
+
+    # the first run has no index yet, so everything is collected and the index is built
+    _check_result(
+        testdir,
+        ["--smart-collect", "--commit-range", "1", "--smart-collect-prune"],
+        ["*collected 3 items*", "*1 failed, 2 skipped in * seconds*"],
+        lambda x: x != 0
+    )
+
+    # test_other.py depends on nothing that changed, so it isn't even imported
+    _check_result(
+        testdir,
+        ["--smart-collect", "--commit-range", "1", "--smart-collect-prune"],
+        ["*collected 1 item*", "*1 failed in * seconds*"],
+        lambda x: x != 0
+    )
+
+    # a change to the test file since it was indexed makes its entry stale
+    with open("test_other.py", "a") as f:
+        f.write("\n\ndef test_new():\n    assert True\n")
+
+    _check_result(
+        testdir,
+        ["--smart-collect", "--commit-range", "1", "--smart-collect-prune"],
+        ["*collected 4 items*", "*1 failed, 3 skipped in * seconds*"],
+        lambda x: x != 0
+    )
+
+
+def test_prune_conftest_fixture_dependencies(testdir):
+    Repo.init(".")
+
+    testdir.makepyfile(hello="""
+        def hello():
+            return 42
+    """)
+
+    testdir.makeconftest("""
+        import pytest
+        from hello import hello
+
+        @pytest.fixture
+        def value():
+            return hello()
+    """)
+
+    testdir.makepyfile(test_value="""
+        def test_value(value):
+            assert value == 42
+    """)
+
+    testdir.makepyfile(test_other="""
+        def test_other():
+            assert True
+    """)
+
+    r = Repo(".")
+    r.index.add(["hello.py", "conftest.py", "test_value.py", "test_other.py"])
+    r.index.commit("initial commit")
+
+    testdir.makepyfile(test_other="""
+        def test_other():
+            assert len([]) == 0
+    """)
+
+    r.index.add(["test_other.py"])
+    r.index.commit("second commit")
+
+    # the index is built while only test_other.py is changed
+    args = ["--smart-collect", "--commit-range", "1", "--smart-collect-prune"]
+    _check_result(testdir, list(args), ["*collected 2 items*", "*1 passed, 1 skipped in * seconds*"], lambda x: x == 0)
+
+    with open("hello.py", "w") as f:
+        f.write("def hello():\n\treturn 44")
+
+    r.index.add(["hello.py"])
+    r.index.commit("third commit")
+
+    # hello.py is only reached through the conftest fixture, which keeps the test files under it from being pruned
+    _check_result(testdir, list(args), ["*collected 2 items*", "*1 failed, 1 skipped in * seconds*"], lambda x: x != 0)
+
+
+def test_plugin_hooks_match_pytest():
+    # every hook the plugin implements takes only arguments that the installed version of pytest passes to it
+    from _pytest.config import PytestPluginManager
+    plugin_manager = PytestPluginManager()
+    plugin_manager.register(plugin)
+    plugin_manager.check_pending()
+
+
+def test_record_test_impact(testdir):
+    Repo.init(".")
+
+    testdir.makepyfile(greetings="""
+        def hello():
+            return "hello"
+
+        def goodbye():
+            return "goodbye"
+    """)
+
+    testdir.makepyfile(test_greetings="""
+        import greetings
+
+        def test_hello():
+            assert greetings.hello() == "hello"
+
+        def test_goodbye():
+            assert greetings.goodbye() == "goodbye"
+    """)
+
+    r = Repo(".")
+    r.index.add(["greetings.py", "test_greetings.py"])
+    r.index.commit("initial commit")
+
+    _check_result(
+        testdir,
+        ["--smart-collect-record"],
+        ["*2 passed in * seconds*"],
+        lambda x: x == 0
+    )
+
+    impact_db_path = [os.path.join(d, helpers.IMPACT_DB_NAME) for d, _, files in os.walk(".pytest_cache") if helpers.IMPACT_DB_NAME in files]
+    impact_db = helpers.ImpactDatabase(impact_db_path[0])
+    assert impact_db.commit == r.head.commit.hexsha
+    assert impact_db.recorded_tests() == {"test_greetings.py::test_hello", "test_greetings.py::test_goodbye"}
+    assert impact_db.find_tests("greetings.py", [range(5, 6), range(6, 7)]) == {
+        range(5, 6): {"test_greetings.py::test_goodbye"},
+        range(6, 7): set()
+    }
+    impact_db.close()
+
+    assert helpers.ImpactDatabase.spans([7, 3, 4, 5, 9]) == [(3, 5), (7, 7), (9, 9)]
+
+    with open("greetings.py", "w") as f:
+        f.write('def hello():\n    return "hello"\n\ndef goodbye():\n    return "farewell"\n')
+
+    r.index.add(["greetings.py"])
+    r.index.commit("second commit")
+
+    # both tests import greetings, but only test_goodbye executed the changed line
+    _check_result(
+        testdir,
+        ["--smart-collect", "--commit-range", "1"],
+        ["*test_greetings.py sF*", "*1 failed, 1 skipped in * seconds*"],
+        lambda x: x != 0
+    )
+
+
+def test_line_tracer_chains_trace_function():
+    events = []
+
+    def previous_trace(frame, event, arg):
+        if frame.f_code.co_name == "traced":
+            events.append(event)
+            return previous_trace
+
+    def traced():
+        value = 1
+        return value
+
+    tracer = helpers.LineTracer(os.path.dirname(os.path.abspath(__file__)))
+    trace = sys.gettrace()
+    sys.settrace(previous_trace)
+    try:
+        tracer.start()
+        traced()
+        lines = tracer.stop()
+        assert sys.gettrace() is previous_trace
+
+    finally:
+        sys.settrace(trace)
+
+    # the trace function that was already set, e.g. coverage's, still saw every line
+    assert events == ["call", "line", "line", "return"]
+    first_line = traced.__code__.co_firstlineno
+    assert {first_line + 1, first_line + 2} <= lines[traced.__code__.co_filename]
+
+
+def test_method_level_changes(testdir):
+    Repo.init(".")
+
+    testdir.makepyfile(service="""
+        class Service(object):
+            greeting = "hello"
+
+            def __init__(self, name):
+                self.name = name
+
+            def greet(self):
+                return self.greeting + " " + self.name
+
+            def leave(self):
+                return "goodbye " + self.name
+    """)
+
+    testdir.makepyfile(test_service="""
+        from service import Service
+
+        def test_greet():
+            assert Service("world").greet() == "hello world"
+
+        def test_leave():
+            service = Service("world")
+            assert service.leave() == "goodbye world"
+
+        class TestService(object):
+            def test_name(self):
+                assert Service("world").name == "world"
+    """)
+
+    r = Repo(".")
+    r.index.add(["service.py", "test_service.py"])
+    r.index.commit("initial commit")
+
+    summary = helpers.ModuleSummary.from_source("service.py", "", open("service.py").read(), 11)
+    assert [part[0] for part in summary.member_parts["Service"]] == [
+        "Service", "Service", "Service.__init__", "Service.greet", "Service.leave"
+    ]
+    assert summary.implicit_methods("Service") == ["Service.__init__"]
+
+    contents = open("service.py").read().replace('"goodbye "', '"farewell "')
+    with open("service.py", "w") as f:
+        f.write(contents)
+
+    r.index.add(["service.py"])
+    r.index.commit("second commit")
+
+    # only the test calling the changed method runs
+    _check_result(
+        testdir,
+        ["--smart-collect", "--commit-range", "1"],
+        ["*test_service.py sFs*", "*1 failed, 2 skipped in * seconds*"],
+        lambda x: x != 0
+    )
+
+    contents = open("service.py").read().replace('self.name = name', 'self.name = name.upper()')
+    with open("service.py", "w") as f:
+        f.write(contents)
+
+    r.index.add(["service.py"])
+    r.index.commit("third commit")
+
+    # __init__ runs whenever the class is used, so every test that uses it runs
+    _check_result(
+        testdir,
+        ["--smart-collect", "--commit-range", "1"],
+        ["*3 failed in * seconds*"],
+        lambda x: x != 0
+    )
+
+
+def test_collection_stats(testdir):
+    Repo.init(".")
+
+    testdir.makepyfile(hello="""
+        def hello():
+            return 42
+    """)
+
+    testdir.makepyfile(test_hello="""
+        import pytest
+
+        def test_hello():
+            from hello import hello
+            assert hello() == 42
+
+        def test_other():
+            assert True
+
+        @pytest.mark.skip
+        def test_marked():
+            assert True
+    """)
+
+    r = Repo(".")
+    r.index.add(["hello.py", "test_hello.py"])
+    r.index.commit("initial commit")
+
+    with open("hello.py", "w") as f:
+        f.write("def hello():\n\treturn 44")
+
+    r.index.add(["hello.py"])
+    r.index.commit("second commit")
+
+    # the test that was marked to skip already isn't counted as skipped by the selection
+    _check_result(
+        testdir,
+        ["--smart-collect", "--commit-range", "1", "--smart-collect-stats", "stats.json"],
+        ["*- smart collection -*", "diff * wall * cpu", "*tests selected * 1", "*tests skipped * 1"],
+        lambda x: x != 0
+    )
+
+    with open("stats.json") as f:
+        stats = json.load(f)
+
+    assert list(stats["phases"]) == [
+        "repo discovery", "find_packages", "diff", "changed members", "symbol graph", "impact database", "test analysis", "report"
+    ]
+    assert stats["counters"]["files read"] == stats["counters"]["asts parsed"] == 2
+    assert stats["counters"]["tests selected"] == 1
+    assert stats["counters"]["tests skipped"] == 1
+
+
+def test_selection_report(testdir):
+    Repo.init(".")
+
+    testdir.makepyfile(hello="""
+        def hello():
+            return 42
+    """)
+
+    testdir.makepyfile(test_hello="""
+        def test_hello():
+            from hello import hello
+            assert hello() == 42
+
+        def test_other():
+            assert True
+    """)
+
+    r = Repo(".")
+    r.index.add(["hello.py", "test_hello.py"])
+    r.index.commit("initial commit")
+
+    with open("hello.py", "w") as f:
+        f.write("def hello():\n\treturn 44")
+
+    r.index.add(["hello.py"])
+    r.index.commit("second commit")
+
+    _check_result(
+        testdir,
+        ["--smart-collect", "--commit-range", "1", "--smart-collect-report", "report.jsonl", "--junitxml", "junit.xml"],
+        ["*1 failed, 1 skipped in * seconds*"],
+        lambda x: x != 0
+    )
+
+    with open("report.jsonl") as f:
+        records = [json.loads(line) for line in f]
+
+    assert [(r["decision"], r["nodeid"]) for r in records] == [("RUN", "test_hello.py::test_hello"), ("SKIP", "test_hello.py::test_other")]
+    assert records[0]["reason"].startswith("Dependency changed: ")
+    assert not os.path.exists("results.csv")
+
+    with open("junit.xml") as f:
+        assert '<property name="smart_collect" value="SKIP: Unchanged"/>' in f.read()
+
+    _check_result(
+        testdir,
+        ["--smart-collect", "--commit-range", "1", "--smart-collect-report", "report.csv"],
+        ["*1 failed, 1 skipped in * seconds*"],
+        lambda x: x != 0
+    )
+
+    with open("report.csv") as f:
+        assert f.read().splitlines()[1] == "SKIP,test_hello.py::test_other,Unchanged"
+
+    # the report is checked before any test is analysed, and its directory is created
+    result = testdir.runpytest("--smart-collect", "--commit-range", "1", "--smart-collect-report", "report.txt")
+    result.stderr.fnmatch_lines(["*couldn't determine the report format of 'report.txt'*"])
+    assert result.ret == 4
+
+    _check_result(
+        testdir,
+        ["--smart-collect", "--commit-range", "1", "--smart-collect-report", os.path.join("reports", "report.csv")],
+        ["*1 failed, 1 skipped in * seconds*"],
+        lambda x: x != 0
+    )
+
+    assert os.path.exists(os.path.join("reports", "report.csv"))
+
+
+def test_selection_cache(testdir):
+    Repo.init(".")
+
+    testdir.makepyfile(hello="""
+        def hello():
+            return 42
+    """)
+
+    testdir.makepyfile(test_hello="""
+        def test_hello():
+            from hello import hello
+            assert hello() == 42
+
+        def test_other():
+            assert True
+    """)
+
+    r = Repo(".")
+    r.index.add(["hello.py", "test_hello.py"])
+    r.index.commit("initial commit")
+
+    with open("hello.py", "w") as f:
+        f.write("def hello():\n\treturn 44")
+
+    r.index.add(["hello.py"])
+    r.index.commit("second commit")
+
+    def phases():
+        with open("stats.json") as f:
+            return list(json.load(f)["phases"])
+
+    args = ["--smart-collect", "--commit-range", "1", "--smart-collect-stats", "stats.json"]
+    _check_result(testdir, list(args), ["*1 failed, 1 skipped in * seconds*"], lambda x: x != 0)
+    assert "diff" in phases()
+
+    # nothing changed, so the selection is reused without looking at the diff
+    _check_result(testdir, list(args), ["*1 failed, 1 skipped in * seconds*"], lambda x: x != 0)
+    assert "diff" not in phases()
+
+    # an uncommitted change to a python file invalidates it
+    with open("hello.py", "a") as f:
+        f.write("\n\ndef goodbye():\n\treturn 0\n")
+
+    _check_result(testdir, list(args), ["*1 failed, 1 skipped in * seconds*"], lambda x: x != 0)
+    assert "diff" in phases()
+
+    # and so does leaving untracked files out, which changes the files that are analysed
+    _check_result(testdir, args + ["--smart-collect-tracked-only"], ["*1 failed, 1 skipped in * seconds*"], lambda x: x != 0)
+    assert "diff" in phases()
+
+
+def test_daemon(testdir, monkeypatch):
+    from pytest_smartcollect.daemon import SmartCollectDaemon
+    Repo.init(".")
+
+    testdir.makepyfile(hello="""
+        def hello():
+            return 42
+
+        def other():
+            return 0
+    """)
+
+    testdir.makepyfile(test_hello="""
+        def test_hello():
+            from hello import hello
+            assert hello() == 42
+
+        def test_other():
+            from hello import other
+            assert other() == 0
+    """)
+
+    r = Repo(".")
+    r.index.add(["hello.py", "test_hello.py"])
+    r.index.commit("initial commit")
+
+    with open("hello.py") as f:
+        contents = f.read()
+
+    with open("hello.py", "w") as f:
+        f.write(contents.replace("return 42", "return 44"))
+
+    r.index.add(["hello.py"])
+    r.index.commit("second commit")
+
+    def daemon_decisions():
+        with open("stats.json") as f:
+            return json.load(f)["counters"].get("daemon decisions")
+
+    daemon = SmartCollectDaemon(str(testdir.tmpdir), poll_interval=3600)  # so that only requests catch up with changes
+    thread = threading.Thread(target=daemon.serve_forever)
+    thread.start()
+    args = ["--smart-collect", "--commit-range", "1", "--smart-collect-stats", "stats.json", "--cache-clear"]
+    try:
+        _check_result(testdir, list(args), ["*1 failed, 1 skipped in * seconds*"], lambda x: x != 0)
+        assert daemon_decisions() == 2
+
+        # the socket is only accessible to the user, and sockets of other users are never trusted
+        assert os.stat(os.path.dirname(daemon.socket_path)).st_mode & 0o077 == 0
+        uid = os.getuid()
+        monkeypatch.setattr(os, "getuid", lambda: uid + 1)
+        with pytest.raises(Exception, match="another user"):
+            helpers.query_daemon(daemon.socket_path, {'command': 'ping'})
+
+        monkeypatch.undo()
+
+        # the daemon notices that other now calls the changed function before it answers
+        with open("hello.py", "w") as f:
+            f.write(contents.replace("return 42", "return 44").replace("return 0", "return hello() - 44"))
+
+        _check_result(testdir, list(args), ["*1 failed, 1 passed in * seconds*"], lambda x: x != 0)
+        assert daemon_decisions() == 2
+
+    finally:
+        daemon.shutdown()
+        thread.join()
+
+    # without the daemon, the tests are analysed in process, as the daemon's answers aren't kept for the next run
+    assert not os.path.exists(daemon.socket_path)
+    _check_result(testdir, [a for a in args if a != "--cache-clear"], ["*1 failed, 1 passed in * seconds*"], lambda x: x != 0)
+    assert daemon_decisions() is None
+    with open("stats.json") as f:
+        assert "diff" in json.load(f)["phases"]
+
+
+def test_daemon_fallback(testdir, monkeypatch):
+    import logging
+    Repo.init(".")
+
+    def make_collector():
+        return helpers.SmartCollector(str(testdir.tmpdir), [], [], 1, 'master', False, logging.getLogger(), use_daemon=True)
+
+    # platforms without unix sockets never look for a daemon
+    monkeypatch.setattr(helpers, "DAEMON_SUPPORTED", False)
+    assert not make_collector().use_daemon
+    monkeypatch.undo()
+
+    # and failing to find its socket falls back to analysing in process
+    def no_socket(git_repo_root):
+        raise AttributeError("module 'os' has no attribute 'getuid'")
+
+    monkeypatch.setattr(helpers, "find_daemon_socket", no_socket)
+    assert make_collector().find_daemon_decisions([]) == {}
+
+
+def test_daemon_watchers_skip_ignored_directories(testdir):
+    from pytest_smartcollect.daemon import PollingWatcher, InotifyWatcher
+    Repo.init(".")
+
+    root = str(testdir.tmpdir)
+    for directory in ("pkg", os.path.join(".venv", "lib"), "build"):
+        os.makedirs(os.path.join(root, directory))
+
+    for path in ("pkg/mod.py", ".venv/lib/site.py", "build/out.py"):
+        open(os.path.join(root, *path.split("/")), "w").close()
+
+    with open(os.path.join(root, ".gitignore"), "w") as f:
+        f.write(".venv/\nbuild/\n")
+
+    poller = PollingWatcher(root, lambda paths: None)
+    assert sorted(poller.take_snapshot()) == [os.path.join(root, "pkg", "mod.py")]
+    poller.snapshot = poller.take_snapshot()
+
+    # directories created later are checked against .gitignore as well
+    os.makedirs(os.path.join(root, "pkg", "sub"))
+    os.makedirs(os.path.join(root, "build", "more"))
+    open(os.path.join(root, "pkg", "sub", "new.py"), "w").close()
+    open(os.path.join(root, "build", "more", "out.py"), "w").close()
+    assert sorted(poller.take_snapshot()) == [os.path.join(root, "pkg", "mod.py"), os.path.join(root, "pkg", "sub", "new.py")]
+
+    try:
+        watcher = InotifyWatcher(root, lambda paths: None)
+
+    except (OSError, AttributeError):
+        return
+
+    try:
+        assert sorted(watcher.watches.values()) == [root, os.path.join(root, "pkg"), os.path.join(root, "pkg", "sub")]
+
+    finally:
+        os.close(watcher.fd)
+
+
+def test_xdist_shared_selection(testdir):
+    pytest.importorskip("xdist")
+    Repo.init(".")
+
+    testdir.makepyfile(hello="""
+        def hello():
+            return 42
+    """)
+
+    testdir.makepyfile(test_hello="""
+        def test_hello():
+            from hello import hello
+            assert hello() == 42
+
+        def test_other():
+            assert True
+    """)
+
+    r = Repo(".")
+    r.index.add(["hello.py", "test_hello.py"])
+    r.index.commit("initial commit")
+
+    with open("hello.py") as f:
+        contents = f.read()
+
+    with open("hello.py", "w") as f:
+        f.write(contents.replace("return 42", "return 44"))
+
+    r.index.add(["hello.py"])
+    r.index.commit("second commit")
+
+    def phases(path):
+        with open(path) as f:
+            return list(json.load(f)["phases"])
+
+    _check_result(
+        testdir,
+        ["--smart-collect", "--commit-range", "1", "--smart-collect-stats", "stats.json", "-n", "2"],
+        ["*1 failed, 1 skipped in * seconds*"],
+        lambda x: x != 0
+    )
+
+    # the controller diffed the project once, and the workers only applied its selection
+    assert "diff" in phases("stats.json")
+    for worker in ("gw0", "gw1"):
+        assert "diff" not in phases("stats.%s.json" % worker)
+        assert "test analysis" in phases("stats.%s.json" % worker)
+
+    assert not [f for _, _, files in os.walk(".pytest_cache") for f in files if f.startswith("xdist-selection")]
+
+    # the controller finds the test files to prune, once the index is built, and the workers don't diff to prune either
+    testdir.makepyfile(test_other="""
+        def test_unrelated():
+            assert True
+    """)
+
+    r.index.add(["test_other.py"])
+    r.index.commit("third commit")
+
+    with open("hello.py", "w") as f:
+        f.write(contents.replace("return 42", "return 45"))
+
+    r.index.add(["hello.py"])
+    r.index.commit("fourth commit")
+
+    args = ["--smart-collect", "--commit-range", "1", "--smart-collect-prune", "--smart-collect-stats", "stats.json", "-n", "2"]
+    _check_result(testdir, list(args), ["*1 failed, 2 skipped in * seconds*"], lambda x: x != 0)
+    _check_result(testdir, list(args), ["*1 failed, 1 skipped in * seconds*"], lambda x: x != 0)
+    for worker in ("gw0", "gw1"):
+        assert "diff" not in phases("stats.%s.json" % worker)
+
+
+def test_conftest_fixtures(testdir):
+    r = Repo.init(".")
+    os.makedirs("sub")
+
+    files = {
+        "conftest.py": (
+            "import pytest\n\n\n"
+            "@pytest.fixture\ndef base():\n    return 1\n\n\n"
+            "@pytest.fixture\ndef derived(base):\n    return base + 1\n\n\n"
+            "@pytest.fixture\ndef marked():\n    return 1\n\n\n"
+            "@pytest.fixture\ndef unused():\n    return 1\n"
+        ),
+        os.path.join("sub", "conftest.py"): "import pytest\n\n\n@pytest.fixture(autouse=True)\ndef auto():\n    return 1\n",
+        "test_a.py": (
+            "import pytest\n\n\n"
+            "def test_derived(derived):\n    assert derived > 1\n\n\n"
+            "@pytest.mark.usefixtures('marked')\ndef test_marked():\n    assert True\n\n\n"
+            "def test_plain(unused):\n    assert True\n"
+        ),
+        os.path.join("sub", "test_b.py"): "def test_auto():\n    assert True\n"
+    }
+    for path, contents in files.items():
+        with open(path, "w") as f:
+            f.write(contents)
+
+    r.index.add(list(files))
+    r.index.commit("initial commit")
+
+    # base is only used through derived, marked through a marker and auto by every test under sub
+    for path, name in (("conftest.py", "base"), ("conftest.py", "marked"), (os.path.join("sub", "conftest.py"), "auto")):
+        with open(path) as f:
+            contents = f.read()
+
+        with open(path, "w") as f:
+            f.write(contents.replace("def %s():\n    return 1" % name, "def %s():\n    return 2" % name))
+
+    r.index.add(["conftest.py", os.path.join("sub", "conftest.py")])
+    r.index.commit("second commit")
+
+    _check_result(
+        testdir,
+        ["--smart-collect", "--commit-range", "1", "--smart-collect-report", "report.jsonl"],
+        ["*3 passed, 1 skipped in * seconds*"],
+        lambda x: x == 0
+    )
+
+    with open("report.jsonl") as f:
+        decisions = {d["nodeid"]: (d["decision"], d["reason"]) for d in map(json.loads, f)}
+
+    assert decisions == {
+        "test_a.py::test_derived": ("RUN", "Uses changed fixture"),
+        "test_a.py::test_marked": ("RUN", "Uses changed fixture"),
+        "test_a.py::test_plain": ("SKIP", "Unchanged"),
+        "sub/test_b.py::test_auto": ("RUN", "Uses changed fixture")
+    }
+
+
+def test_locate_tests_by_code(testdir):
+    r = Repo.init(".")
+
+    files = {
+        "lib.py": "def changed():\n    return 1\n\n\ndef unchanged():\n    return 1\n",
+        "test_a.py": (
+            "import pytest\n"
+            "from lib import changed, unchanged\n\n\n"
+            "class TestSame(object):\n"
+            "    def test_same(self):\n        assert unchanged()\n\n\n"
+            "class TestOuter(object):\n"
+            "    class TestInner(object):\n"
+            "        def test_inner(self):\n            assert changed()\n\n\n"
+            "def test_same():\n    assert changed()\n\n\n"
+            "@pytest.mark.parametrize('x', [1, 2])\n"
+            "def test_decorated(x):\n    assert unchanged()\n"
+        )
+    }
+    for path, contents in files.items():
+        with open(path, "w") as f:
+            f.write(contents)
+
+    r.index.add(list(files))
+    r.index.commit("initial commit")
+
+    with open("lib.py", "w") as f:
+        f.write(files["lib.py"].replace("def changed():\n    return 1", "def changed():\n    return 2"))
+
+    r.index.add(["lib.py"])
+    r.index.commit("second commit")
+
+    _check_result(
+        testdir,
+        ["--smart-collect", "--commit-range", "1", "--smart-collect-report", "report.jsonl"],
+        ["*2 passed, 3 skipped in * seconds*"],
+        lambda x: x == 0
+    )
+
+    with open("report.jsonl") as f:
+        decisions = {d["nodeid"]: d["decision"] for d in map(json.loads, f)}
+
+    # the module level test_same is told apart from the method of the same name, and the nested class is analysed as
+    # part of its top level class
+    assert decisions == {
+        "test_a.py::TestSame::()::test_same": "SKIP",
+        "test_a.py::TestOuter::()::TestInner::()::test_inner": "RUN",
+        "test_a.py::test_same": "RUN",
+        "test_a.py::test_decorated[1]": "SKIP",
+        "test_a.py::test_decorated[2]": "SKIP"
+    }
+
+
+def test_skip_marked_unresolved_test(testdir):
+    r = Repo.init(".")
+
+    # test_generated can't be found in the file's definitions, but it's skip marked, so it's never analysed
+    files = {
+        "hello.py": "def hello():\n    return 42\n",
+        "test_hello.py": (
+            "import pytest\n\n\n"
+            "def make():\n    def inner():\n        assert True\n\n    return inner\n\n\n"
+            "test_generated = pytest.mark.skip(reason='generated')(make())\n\n\n"
+            "def test_hello():\n    from hello import hello\n    assert hello() == 42\n"
+        )
+    }
+    for path, contents in files.items():
+        with open(path, "w") as f:
+            f.write(contents)
+
+    r.index.add(list(files))
+    r.index.commit("initial commit")
+
+    with open("hello.py", "w") as f:
+        f.write("def hello():\n    return 44\n")
+
+    r.index.add(["hello.py"])
+    r.index.commit("second commit")
+
+    _check_result(testdir, ["--smart-collect", "--commit-range", "1"], ["*1 failed, 1 skipped in * seconds*"], lambda x: x == 1)
+
+
+def test_removed_method(testdir):
+    r = Repo.init(".")
+
+    files = {
+        "service.py": (
+            "class Service(object):\n"
+            "    def greet(self):\n        return 'hello'\n\n"
+            "    def leave(self):\n        return 'goodbye'\n\n\n"
+            "def unrelated():\n    return 0\n"
+        ),
+        "test_service.py": (
+            "from service import Service, unrelated\n\n\n"
+            "def test_leave():\n    assert Service().leave() == 'goodbye'\n\n\n"
+            "def test_unrelated():\n    assert unrelated() == 0\n"
+        )
+    }
+    for path, contents in files.items():
+        with open(path, "w") as f:
+            f.write(contents)
+
+    r.index.add(list(files))
+    r.index.commit("initial commit")
+
+    # only the old version of service.py shows that Service.leave is gone
+    with open("service.py", "w") as f:
+        f.write(files["service.py"].replace("    def leave(self):\n        return 'goodbye'\n\n", ""))
+
+    r.index.add(["service.py"])
+    r.index.commit("second commit")
+
+    _check_result(
+        testdir,
+        ["--smart-collect", "--commit-range", "1", "--smart-collect-report", "report.jsonl"],
+        ["*1 failed, 1 skipped in * seconds*"],
+        lambda x: x != 0
+    )
+
+    with open("report.jsonl") as f:
+        decisions = {d["nodeid"]: d["decision"] for d in map(json.loads, f)}
+
+    assert decisions == {"test_service.py::test_leave": "RUN", "test_service.py::test_unrelated": "SKIP"}
+
+
+def test_attribute_calls_resolve_through_classes(testdir):
+    Repo.init(".")
+
+    testdir.makepyfile(foo="""
+        class Base(object):
+            def get(self):
+                return 1
+
+        class Foo(Base):
+            pass
+    """)
+
+    testdir.makepyfile(bar="""
+        def lookup(d):
+            return d.get("x")
+    """)
+
+    testdir.makepyfile(test_attributes="""
+        from foo import Foo
+        from bar import lookup
+
+        def test_foo():
+            assert Foo().get() == 1
+
+        def test_lookup():
+            assert lookup({"x": 1}) == 1
+    """)
+
+    r = Repo(".")
+    r.index.add(["foo.py", "bar.py", "test_attributes.py"])
+    r.index.commit("initial commit")
+
+    contents = open("foo.py").read().replace("return 1", "return 2")
+    with open("foo.py", "w") as f:
+        f.write(contents)
+
+    r.index.add(["foo.py"])
+    r.index.commit("second commit")
+
+    # d.get() in bar.py is not a call of Base.get, which only reaches test_foo through Foo
+    _check_result(
+        testdir,
+        ["--smart-collect", "--commit-range", "1"],
+        ["*test_attributes.py Fs*", "*1 failed, 1 skipped in * seconds*"],
+        lambda x: x != 0
+    )
+
 def test_recursive_base_dependencies(testdir):
     Repo.init(".")
 